@@ -1,4 +1,5 @@
 import { EventSourceData } from '@type/api';
+import { MessageInterface } from '@type/chat';
 
 export const parseEventSource = (
   data: string
@@ -22,16 +23,26 @@ export const parseEventSource = (
   return result;
 };
 
-export const fetchRAGContext = async (query: string, n_results: number = 3) => {
+export const fetchRAGContext = async (
+  query: string,
+  max_tokens: number = 1000,
+  history: MessageInterface[] = [],
+  chatId?: string
+): Promise<string> => {
   try {
-    const response = await fetch('http://localhost:8000/query', {
+    const response = await fetch('http://localhost:8000/context', {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
       },
       body: JSON.stringify({
         query,
-        n_results,
+        max_tokens,
+        // Earlier turns disambiguate short follow-ups; the server embeds them with the query
+        history: history
+          .filter((message) => message.role !== 'system')
+          .map(({ role, content }) => ({ role, content })),
+        boost_chat_id: chatId,
       }),
     });
 
@@ -40,10 +51,10 @@ export const fetchRAGContext = async (query: string, n_results: number = 3) => {
     }
 
     const data = await response.json();
-    return data.results || [];
+    return data.context || '';
   } catch (error) {
     console.error('Error fetching RAG context:', error);
-    return [];
+    return '';
   }
 };
 
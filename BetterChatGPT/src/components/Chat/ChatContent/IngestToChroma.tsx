@@ -4,6 +4,30 @@ import useStore from '@store/store';
 import PopupModal from '@components/PopupModal';
 import FileTextIcon from '@icon/FileTextIcon';
 
+const ASYNC_INGEST_THRESHOLD = 100;
+
+// Poll an asynchronous ingest job until the server reports it finished
+const waitForIngestJob = async (
+  jobId: string,
+  onProgress: (message: string) => void
+) => {
+  while (true) {
+    await new Promise((resolve) => setTimeout(resolve, 1000));
+    const response = await fetch(`http://localhost:8000/ingest/jobs/${jobId}`);
+    if (!response.ok) {
+      throw new Error(`Failed to fetch ingest job: ${await response.text()}`);
+    }
+    const { job } = await response.json();
+    if (job.status === 'failed') {
+      throw new Error(job.errors.join('; '));
+    }
+    if (job.status === 'done') {
+      return job;
+    }
+    onProgress(`Ingesting... ${job.processed}/${job.total} messages`);
+  }
+};
+
 const IngestToChroma = React.memo(() => {
   const { t } = useTranslation();
   const [isModalOpen, setIsModalOpen] = useState<boolean>(false);
@@ -38,24 +62,35 @@ const IngestToChroma = React.memo(() => {
         }
       }));
       
+      // Large chats are ingested in the background to avoid request timeouts
+      const useAsync = formattedMessages.length > ASYNC_INGEST_THRESHOLD;
+      
       // Make POST request to the ChromaDB server
-      const response = await fetch('http://localhost:8000/ingest', {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          documents: formattedMessages
-        }),
-      });
+      const response = await fetch(
+        `http://localhost:8000/ingest${useAsync ? '?async=1' : ''}`,
+        {
+          method: 'POST',
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          body: JSON.stringify({
+            documents: formattedMessages
+          }),
+        }
+      );
       
       if (!response.ok) {
         const error = await response.text();
         throw new Error(`Failed to ingest chat: ${error}`);
       }
       
-      const result = await response.json();
-      setIngestResult('Chat successfully ingested to ChromaDB');
+      let result = await response.json();
+      if (useAsync) {
+        result = await waitForIngestJob(result.job_id, setIngestResult);
+      }
+      setIngestResult(
+        `Chat successfully ingested to ChromaDB (${result.inserted} new, ${result.updated} updated, ${result.skipped} unchanged)`
+      );
     } catch (error) {
       console.error('Error ingesting chat to ChromaDB:', error);
       // @ts-ignore
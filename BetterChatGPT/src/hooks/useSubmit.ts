@@ -86,16 +86,20 @@ const useSubmit = () => {
         if (lastUserMessageIndex !== undefined) {
           const lastUserMessage = messages[lastUserMessageIndex];
           
-          // Fetch context from RAG
-          const ragResults = await fetchRAGContext(lastUserMessage.content);
+          // Fetch context from RAG, already deduplicated and packed to a token budget,
+          // searching with the preceding turns so follow-ups keep their topic
+          const ragContext = await fetchRAGContext(
+            lastUserMessage.content,
+            1000,
+            messages.slice(Math.max(0, lastUserMessageIndex - 4), lastUserMessageIndex),
+            chats[currentChatIndex].id
+          );
           
-          if (ragResults.length > 0) {
+          if (ragContext) {
             // Create a system message with the retrieved context
-            // @ts-ignore
-            const contextTexts = ragResults.map(result => result.text);
             const contextMessage: MessageInterface = {
               role: 'system',
-              content: `Here is relevant information from the knowledge base that may help with the user's query:\n\n${contextTexts.join('\n\n')}\n\nUse this information to enhance your response if relevant.`
+              content: `Here is relevant information from the knowledge base that may help with the user's query:\n\n${ragContext}\n\nUse this information to enhance your response if relevant.`
             };
             
             // Insert context as a system message before the last user message
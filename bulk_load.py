@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Bulk-load BetterChatGPT chat exports into the ChromaDB server.
+
+Reads one or more files written by BetterChatGPT's Export button and streams
+their messages to /ingest/stream as gzip-compressed NDJSON, using the same ids
+and metadata as the Ingest to ChromaDB button.
+"""
+
+import sys
+import json
+import zlib
+import argparse
+from datetime import datetime
+
+import requests
+
+def load_chats(path):
+    """Return the chats of a BetterChatGPT export (version 1 or a bare list)."""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        return data
+    return data.get("chats") or []
+
+def iter_documents(paths):
+    """Yield one ingest document per chat message, as IngestToChroma builds them."""
+    timestamp = datetime.now().isoformat()
+    for path in paths:
+        for chat in load_chats(path):
+            for index, message in enumerate(chat.get("messages", [])):
+                yield {
+                    "id": f"{chat['id']}_{index}",
+                    "text": message["content"],
+                    "metadata": {
+                        "role": message["role"],
+                        "chatId": chat["id"],
+                        "title": chat.get("title", ""),
+                        "timestamp": timestamp,
+                        "messageIndex": index
+                    }
+                }
+
+def gzip_ndjson(documents, chunk_size=1 << 16):
+    """Encode documents as gzip-compressed NDJSON, yielding compressed chunks."""
+    compressor = zlib.compressobj(wbits=31)  # 31 selects the gzip container
+    buffer = []
+    buffered = 0
+    for doc in documents:
+        line = (json.dumps(doc) + "\n").encode("utf-8")
+        buffer.append(line)
+        buffered += len(line)
+        if buffered >= chunk_size:
+            yield compressor.compress(b"".join(buffer))
+            buffer, buffered = [], 0
+    yield compressor.compress(b"".join(buffer)) + compressor.flush()
+
+def main():
+    """Main function to stream exports to the server."""
+    parser = argparse.ArgumentParser(description='Bulk-load BetterChatGPT exports into ChromaDB')
+    parser.add_argument('exports', nargs='+', help='BetterChatGPT export JSON files')
+    parser.add_argument('--server', default='http://localhost:8000',
+                        help='URL of the ChromaDB server (default: http://localhost:8000)')
+
+    args = parser.parse_args()
+
+    response = requests.post(
+        f"{args.server}/ingest/stream",
+        data=gzip_ndjson(iter_documents(args.exports)),
+        headers={"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"}
+    )
+    summary = response.json()
+
+    if response.status_code != 200:
+        print(f"❌ Bulk load failed: {summary.get('error')}")
+        sys.exit(1)
+
+    print(f"✅ Loaded {summary['count']} messages in {summary['seconds']}s "
+          f"({summary['docs_per_second']} docs/s): {summary['inserted']} new, "
+          f"{summary['updated']} updated, {summary['skipped']} unchanged, "
+          f"{summary['deduplicated']} deduplicated, {summary['invalid']} invalid")
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,1586 @@
 #!/usr/bin/env python3
 """
 Simple Flask server to handle ChromaDB ingestion and retrieval from BetterChatGPT.
+
+Run with --production to serve through waitress instead of the Flask
+development server. The embedding model and HNSW index are warmed up at
+startup; /healthz reports liveness and /readyz readiness.
 """
 
 import os
+import sys
+import gzip
 import json
-from flask import Flask, request, jsonify
+import time
+import signal
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import Flask, request, jsonify, send_file, g, has_request_context
 from flask_cors import CORS
+import numpy as np
 import chromadb
 from chromadb.config import Settings
+from query_cache import QueryCache
+from embedding_cache import EmbeddingCache
+from ingest_jobs import IngestQueue, QueueFull, QueueClosed
+from chunking import split_message, merge_chunks
+from embeddings import create_embedding_function, DEFAULT_MODEL_ID
+from reranker import create_reranker
+from partitions import PartitionRouter, DEFAULT_TENANT, validate_tenant
+from context_builder import mmr_order, pack_context
+from metrics import MetricsRegistry
+from response_format import negotiate, encode, pack_embeddings
+from snapshot import SnapshotWriter, read_snapshot
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
+DB_PATH = "./db"
+
+# Seconds spent in each startup phase, reported by /readyz
+startup_timings = {}
+startup_state = {"phase": "open_client", "error": None}
+ready = threading.Event()
+_phase_started = time.perf_counter()
+
 # Initialize ChromaDB client
 client = chromadb.PersistentClient(
-    path="./db",
+    path=DB_PATH,
     settings=Settings(
         allow_reset=True,
         anonymized_telemetry=False
     )
 )
 
-# Create or get the collection
-collection = client.get_or_create_collection(
-    name="chat_history",
-    metadata={"hnsw:space": "cosine"}
+# One model instance for the whole process. Chroma's DefaultEmbeddingFunction
+# builds a new ONNX session on every call; these backends load theirs once.
+embedding_function = create_embedding_function(
+    os.environ.get("EMBEDDING_BACKEND", "onnx"),
+    model_name=os.environ.get("EMBEDDING_MODEL"),
+    batch_size=int(os.environ.get("EMBEDDING_BATCH_SIZE", 32)),
+    threads=int(os.environ.get("EMBEDDING_THREADS", 0))
+)
+
+# Optional cross-encoder that re-ranks the top CROSS_ENCODER_CANDIDATES hits of
+# each query; CROSS_ENCODER names the backend, unset disables re-ranking.
+# With CROSS_ENCODER_BUDGET_MS, re-ranking is skipped when it would make the
+# request take longer than that.
+CROSS_ENCODER = os.environ.get("CROSS_ENCODER")
+reranker = create_reranker(
+    CROSS_ENCODER,
+    model_name=os.environ.get("CROSS_ENCODER_MODEL"),
+    batch_size=int(os.environ.get("CROSS_ENCODER_BATCH_SIZE", 16)),
+    threads=int(os.environ.get("EMBEDDING_THREADS", 0))
+) if CROSS_ENCODER else None
+CROSS_ENCODER_CANDIDATES = int(os.environ.get("CROSS_ENCODER_CANDIDATES", 30))
+CROSS_ENCODER_BUDGET_MS = float(os.environ.get("CROSS_ENCODER_BUDGET_MS", 0))
+
+def update_collection_metadata(collection, **fields):
+    """Set fields in a collection's metadata, keeping the others."""
+    # Chroma refuses to change the hnsw: keys of an existing collection
+    collection.modify(metadata={
+        **{key: value for key, value in (collection.metadata or {}).items() if not key.startswith("hnsw:")},
+        **fields
+    })
+
+def sync_embedding_model(collection):
+    """
+    Record the backend in the collection metadata and warn when it differs
+    from the one that embedded the vectors already stored.
+    """
+    stored_model = (collection.metadata or {}).get("embedding_model")
+    if stored_model != embedding_function.model_id:
+        if stored_model and collection.count():
+            print(f"Warning: collection {collection.name} was embedded with {stored_model}, "
+                  f"now embedding with {embedding_function.model_id}", flush=True)
+        update_collection_metadata(collection, embedding_model=embedding_function.model_id)
+
+# HNSW parameters for new collections, passed to Chroma as collection
+# metadata. Unset variables keep Chroma's defaults.
+HNSW_SETTINGS = {
+    "HNSW_M": "hnsw:M",
+    "HNSW_CONSTRUCTION_EF": "hnsw:construction_ef",
+    "HNSW_SEARCH_EF": "hnsw:search_ef",
+    "HNSW_BATCH_SIZE": "hnsw:batch_size",
+    "HNSW_SYNC_THRESHOLD": "hnsw:sync_threshold",
+    "HNSW_NUM_THREADS": "hnsw:num_threads"
+}
+hnsw_metadata = {key: int(os.environ[var]) for var, key in HNSW_SETTINGS.items() if os.environ.get(var)}
+
+# Chroma applies these to an existing collection; the graph has to be rebuilt
+# (--reindex) for the fixed ones. Values are the collection configuration names.
+HNSW_UPDATABLE = {
+    "hnsw:search_ef": "ef_search",
+    "hnsw:batch_size": "batch_size",
+    "hnsw:sync_threshold": "sync_threshold",
+    "hnsw:num_threads": "num_threads"
+}
+HNSW_FIXED = {"hnsw:M": "max_neighbors", "hnsw:construction_ef": "ef_construction"}
+
+def hnsw_configuration(collection):
+    return (getattr(collection, "configuration_json", None) or {}).get("hnsw") or {}
+
+def hnsw_outdated(collection):
+    """Return {parameter: (current, configured)} for fixed HNSW parameters that differ."""
+    current = hnsw_configuration(collection)
+    return {
+        name: (current.get(name), hnsw_metadata[key])
+        for key, name in HNSW_FIXED.items()
+        if key in hnsw_metadata and current.get(name) != hnsw_metadata[key]
+    }
+
+def sync_hnsw_parameters(collection):
+    """
+    Apply the configured search-time HNSW parameters to an existing collection
+    and warn about build-time ones that need a reindex.
+    """
+    current = hnsw_configuration(collection)
+    updates = {
+        name: hnsw_metadata[key]
+        for key, name in HNSW_UPDATABLE.items()
+        if key in hnsw_metadata and current.get(name) != hnsw_metadata[key]
+    }
+    if updates:
+        collection.modify(configuration={"hnsw": updates})
+    outdated = hnsw_outdated(collection)
+    if outdated:
+        changes = ", ".join(f"{name} {old} -> {new}" for name, (old, new) in outdated.items())
+        print(f"Warning: collection {collection.name} was built with different HNSW parameters ({changes}); "
+              f"run `python chroma_server.py --reindex` to rebuild it", flush=True)
+
+def parse_timestamp(value):
+    """Convert an ISO timestamp string or epoch number into epoch seconds."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    # fromisoformat only accepts a trailing "Z" from Python 3.11
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+def timestamp_epoch(metadata):
+    """Return the epoch seconds of a message's timestamp metadata, or None if it has no valid one."""
+    value = metadata.get("timestamp")
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        return None
+    try:
+        return parse_timestamp(value)
+    except ValueError:
+        return None
+
+def backfill_timestamps(collection, batch_size=1000):
+    """
+    Add timestampEpoch to the collection's records that have a timestamp but
+    not its numeric copy, then mark the collection as done. Returns the
+    number of records updated.
+    """
+    # Runs while the router opens the collection, so it cannot wait for
+    # write_lock; the update only adds a value derived from the record itself,
+    # and Chroma ignores ids deleted in the meantime
+    updated = 0
+    for offset in range(0, collection.count(), batch_size):
+        records = collection.get(limit=batch_size, offset=offset, include=["metadatas"])
+        ids, metadatas = [], []
+        for record_id, metadata in zip(records["ids"], records["metadatas"]):
+            epoch = timestamp_epoch(metadata or {})
+            if epoch is not None and (metadata or {}).get("timestampEpoch") != epoch:
+                ids.append(record_id)
+                metadatas.append({"timestampEpoch": epoch})
+        # Chroma merges updated metadata into the stored one
+        if ids:
+            collection.update(ids=ids, metadatas=metadatas)
+            updated += len(ids)
+    update_collection_metadata(collection, timestamps_backfilled=True)
+    if updated:
+        print(f"Added timestampEpoch to {updated} records in {collection.name}", flush=True)
+    return updated
+
+def open_collection(collection):
+    """Bring a collection's metadata and HNSW settings up to date when it is first opened."""
+    sync_embedding_model(collection)
+    sync_hnsw_parameters(collection)
+    # router.check_shard_count() has already refused a conflicting value
+    if (collection.metadata or {}).get("shard_count") != router.shard_count:
+        update_collection_metadata(collection, shard_count=router.shard_count)
+    # Records stored before timestampEpoch existed, or with a numeric
+    # timestamp, get it before since/until and retention read the collection;
+    # a new collection has none to fill in
+    if not (collection.metadata or {}).get("timestamps_backfilled"):
+        backfill_timestamps(collection)
+
+# VECTOR_STORE=int8 serves vector searches from int8-quantized embeddings in
+# memory, re-ranking the best RERANK_CANDIDATES with the full-precision
+# vectors kept on disk; hnsw searches Chroma's own index
+VECTOR_STORE = os.environ.get("VECTOR_STORE", "hnsw")
+if VECTOR_STORE not in ("hnsw", "int8"):
+    raise ValueError(f"Unknown VECTOR_STORE {VECTOR_STORE!r}, expected 'hnsw' or 'int8'")
+RERANK_CANDIDATES = int(os.environ.get("RERANK_CANDIDATES", 100))
+
+# One partition (collection plus keyword index) per tenant and shard. With the
+# defaults everything is stored in the original chat_history collection.
+router = PartitionRouter(
+    client,
+    DB_PATH,
+    base_name="chat_history",
+    metadata={"hnsw:space": "cosine", **hnsw_metadata},
+    shard_count=int(os.environ.get("SHARD_COUNT", 1)),
+    shard_key=os.environ.get("SHARD_KEY", "chatId"),
+    on_open=open_collection,
+    quantize=VECTOR_STORE == "int8"
 )
 
+# rebuild_partition() copies a collection into "<name>.compacting", renames
+# the original to "<name>.replaced", renames the copy into place and only then
+# deletes the original, so a complete copy always exists under one of the names
+REBUILDING_SUFFIX = ".compacting"
+REPLACED_SUFFIX = ".replaced"
+
+def recover_interrupted_rebuilds():
+    """Finish or undo the collection swaps of a rebuild that was interrupted."""
+    names = {getattr(collection, "name", collection) for collection in client.list_collections()}
+    for name in sorted(names):
+        if name.endswith(REPLACED_SUFFIX):
+            original = name[:-len(REPLACED_SUFFIX)]
+            if original in names:
+                # The copy was already in place
+                client.delete_collection(name)
+            else:
+                client.get_collection(name).modify(name=original)
+                names.add(original)
+                print(f"Startup: restored {original} from an interrupted rebuild", flush=True)
+    for name in sorted(names):
+        if name.endswith(REBUILDING_SUFFIX):
+            original = name[:-len(REBUILDING_SUFFIX)]
+            if original in names:
+                # The copy may be incomplete; the original is intact
+                client.delete_collection(name)
+            else:
+                # Only a finished copy is left without its original
+                client.get_collection(name).modify(name=original)
+                print(f"Startup: restored {original} from its rebuilt copy", flush=True)
+
+recover_interrupted_rebuilds()
+try:
+    router.check_shard_count()
+except ValueError as e:
+    raise ValueError(f"{e}. Start with the SHARD_COUNT the database was written with; to change it, "
+                     f"export a snapshot (--export) and import it (--import) into a new database") from None
+router.get(DEFAULT_TENANT)
+startup_timings["open_client"] = round(time.perf_counter() - _phase_started, 3)
+
+# Queries that span several partitions search them concurrently
+partition_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("QUERY_PARALLELISM", 8)),
+    thread_name_prefix="partition-query"
+)
+
+# Embeddings are computed here rather than inside Chroma so that identical
+# texts are served from the cache on both the ingest and the query path
+embedding_cache = EmbeddingCache(
+    embedding_function,
+    max_size=int(os.environ.get("EMBEDDING_CACHE_SIZE", 10000)),
+    path=(os.path.join(DB_PATH, "embedding_cache", embedding_function.model_id.replace("/", "_"))
+          if os.environ.get("EMBEDDING_CACHE_DISK") == "1" else None),
+    namespace=embedding_function.model_id
+)
+
+# Formatted /query results, invalidated whenever /ingest writes
+query_cache = QueryCache(
+    max_size=int(os.environ.get("QUERY_CACHE_SIZE", 256)),
+    ttl=float(os.environ.get("QUERY_CACHE_TTL", 300))
+)
+
+# Held by everything that changes stored records, so a snapshot export sees
+# no half-applied write
+write_lock = threading.RLock()
+
+# Messages older than RETENTION_MAX_AGE_DAYS, or beyond the newest
+# RETENTION_MAX_PER_CHAT of a chat, are deleted every RETENTION_INTERVAL
+# seconds; 0 disables either limit
+RETENTION_MAX_AGE_DAYS = float(os.environ.get("RETENTION_MAX_AGE_DAYS", 0))
+RETENTION_MAX_PER_CHAT = int(os.environ.get("RETENTION_MAX_PER_CHAT", 0))
+RETENTION_INTERVAL = float(os.environ.get("RETENTION_INTERVAL", 3600))
+
+# A message at least DEDUP_THRESHOLD cosine-similar to a stored one is linked
+# to it instead of stored (0 disables deduplication). DEDUP_SCOPE "chat" only
+# compares messages of the same chat, "all" the whole partition.
+DEDUP_THRESHOLD = float(os.environ.get("DEDUP_THRESHOLD", 0))
+DEDUP_SCOPE = os.environ.get("DEDUP_SCOPE", "chat")
+if DEDUP_SCOPE not in ("chat", "all"):
+    raise ValueError(f"Unknown DEDUP_SCOPE {DEDUP_SCOPE!r}, expected 'chat' or 'all'")
+
+# Long messages are split into overlapping chunks before embedding
+CHUNK_SIZE = int(os.environ.get("CHUNK_SIZE", 200))
+CHUNK_OVERLAP = int(os.environ.get("CHUNK_OVERLAP", 40))
+CHUNK_MODE = os.environ.get("CHUNK_MODE", "tokens")
+
+# A query sent with the conversation's earlier turns is embedded together with
+# the last QUERY_HISTORY_TURNS of them, the newest weighted QUERY_HISTORY_DECAY
+# relative to the query and each older one by a further factor of it. Hits
+# from the conversation's own chat rank as if CHAT_BOOST closer.
+QUERY_HISTORY_TURNS = int(os.environ.get("QUERY_HISTORY_TURNS", 3))
+QUERY_HISTORY_DECAY = float(os.environ.get("QUERY_HISTORY_DECAY", 0.5))
+CHAT_BOOST = float(os.environ.get("CHAT_BOOST", 0.05))
+
+def run_phase(name, fn):
+    """Run one startup phase, recording and logging how long it took."""
+    startup_state["phase"] = name
+    started = time.perf_counter()
+    result = fn()
+    startup_timings[name] = round(time.perf_counter() - started, 3)
+    print(f"Startup: {name} took {startup_timings[name]:.3f}s", flush=True)
+    return result
+
+def warm_up():
+    """
+    Load the embedding model, run a warm-up embedding and open the HNSW index,
+    so the first real request does not pay for any of it.
+    """
+    try:
+        print(f"Startup: open_client took {startup_timings['open_client']:.3f}s", flush=True)
+        vector = run_phase("load_model", lambda: embedding_function(["warm-up"]))[0]
+        if reranker is not None:
+            run_phase("load_reranker", lambda: reranker("warm-up", ["warm-up"]))
+        
+        partitions = run_phase("open_partitions", router.open_all)
+        counts = run_phase("count_documents", lambda: {p.name: p.collection.count() for p in partitions})
+        
+        # A search loads each collection's HNSW segment into memory; with a
+        # quantized vector store queries never touch it
+        if any(counts.values()) and VECTOR_STORE == "hnsw":
+            run_phase("open_index", lambda: [
+                p.collection.query(query_embeddings=[vector], n_results=1) for p in partitions if counts[p.name]
+            ])
+        
+        # Records stored before the keyword index existed are indexed once
+        unindexed = [p for p in partitions if len(p.keyword_index) < counts[p.name]]
+        if unindexed:
+            run_phase("backfill_keyword_index", lambda: [p.backfill_keyword_index() for p in unindexed])
+        
+        # A vector store that missed writes (made while VECTOR_STORE was
+        # hnsw) is rebuilt from the stored embeddings
+        unsynced = [p for p in partitions if p.vector_store is not None and len(p.vector_store) != counts[p.name]]
+        if unsynced:
+            run_phase("build_vector_store", lambda: [p.rebuild_vector_store() for p in unsynced])
+        
+        startup_state["phase"] = "ready"
+        ready.set()
+        
+        if RETENTION_MAX_AGE_DAYS or RETENTION_MAX_PER_CHAT:
+            threading.Thread(target=retention_worker, name="retention", daemon=True).start()
+    except Exception as e:
+        startup_state["error"] = str(e)
+        print(f"Startup: warm-up failed in {startup_state['phase']}: {e}", flush=True)
+
+def content_hash(text):
+    """Return the hash stored alongside each message to detect edits."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def build_where(data):
+    """
+    Combine a request's "where" filter with its chatId, roles, since and until
+    shorthands into one Chroma where clause, or None when there is no filter.
+    """
+    clauses = []
+    if data.get('where'):
+        clauses.append(data['where'])
+    if data.get('chatId'):
+        chat_ids = data['chatId']
+        clauses.append({"chatId": {"$in": chat_ids}} if isinstance(chat_ids, list) else {"chatId": chat_ids})
+    if data.get('roles'):
+        clauses.append({"role": {"$in": data['roles']}})
+    if data.get('since') is not None:
+        clauses.append({"timestampEpoch": {"$gte": parse_timestamp(data['since'])}})
+    if data.get('until') is not None:
+        clauses.append({"timestampEpoch": {"$lte": parse_timestamp(data['until'])}})
+    
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+def request_tenant(data=None):
+    """
+    Return the tenant a request acts for: its "tenant" field, its ?tenant=
+    argument or X-Tenant-Id header, or the default tenant.
+    """
+    tenant = ((data or {}).get('tenant') or request.args.get('tenant')
+              or request.headers.get('X-Tenant-Id') or DEFAULT_TENANT)
+    return validate_tenant(tenant)
+
+def shard_values(data):
+    """Return the shard key values a query is limited to, or None if it can match any."""
+    key = router.shard_key
+    if key == "chatId" and data.get('chatId'):
+        values = data['chatId']
+    elif isinstance(data.get('where'), dict) and isinstance(data['where'].get(key), (str, int, float)):
+        values = data['where'][key]
+    else:
+        return None
+    return values if isinstance(values, list) else [values]
+
+SEARCH_MODES = ("vector", "keyword", "hybrid")
+
+# Fields a query hit can carry besides its id, and the Chroma include entry
+# each one is loaded with
+RESULT_FIELDS = {"text": "documents", "metadata": "metadatas", "distance": "distances", "embedding": "embeddings"}
+DEFAULT_RESULT_FIELDS = ["text", "metadata", "distance"]
+
+def result_count(data, name, default):
+    """Read a count of results from the request, which must be a positive integer."""
+    count = data.get(name, default)
+    if not isinstance(count, int) or isinstance(count, bool) or count < 1:
+        raise ValueError(f"{name} must be a positive integer")
+    return count
+
+def query_options(data):
+    """Collect the request parameters, besides the query and n_results, that shape results."""
+    mode = data.get('mode', 'vector')
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"mode must be one of {', '.join(SEARCH_MODES)}")
+    
+    # "tenants" searches several tenants at once, otherwise the request's tenant
+    if data.get('tenants') is not None:
+        if not isinstance(data['tenants'], list) or not data['tenants']:
+            raise ValueError("tenants must be a non-empty list")
+        tenants = [validate_tenant(tenant) for tenant in data['tenants']]
+    else:
+        tenants = [request_tenant(data)]
+    
+    # A larger search_ef trades latency for recall; exact skips the index
+    search_ef = data.get('search_ef')
+    if search_ef is not None and (not isinstance(search_ef, int) or isinstance(search_ef, bool) or search_ef < 1):
+        raise ValueError("search_ef must be a positive integer")
+    
+    # Cross-encoder re-ranking is on by default when a re-ranker is configured
+    rerank = None
+    if data.get('rerank', reranker is not None):
+        if reranker is None:
+            raise ValueError("rerank needs a cross-encoder, set CROSS_ENCODER to enable one")
+        candidates = data.get('rerank_candidates', CROSS_ENCODER_CANDIDATES)
+        if not isinstance(candidates, int) or isinstance(candidates, bool) or candidates < 1:
+            raise ValueError("rerank_candidates must be a positive integer")
+        budget_ms = data.get('rerank_budget_ms', CROSS_ENCODER_BUDGET_MS)
+        if not isinstance(budget_ms, (int, float)) or isinstance(budget_ms, bool) or budget_ms < 0:
+            raise ValueError("rerank_budget_ms must be a non-negative number")
+        rerank = {"candidates": candidates, "budget_ms": budget_ms}
+    
+    # Fields left out of "include" are never loaded from Chroma's store
+    include = data.get('include', DEFAULT_RESULT_FIELDS)
+    if not isinstance(include, list) or any(field not in RESULT_FIELDS for field in include):
+        raise ValueError(f"include must be a list of {', '.join(RESULT_FIELDS)}")
+    
+    # Short follow-ups are searched together with the turns they follow
+    history = data.get('history') or []
+    if not isinstance(history, list):
+        raise ValueError("history must be a list of strings or {role, content} messages")
+    turns = []
+    for turn in history:
+        if isinstance(turn, dict):
+            if turn.get('role') == 'system':
+                continue
+            turn = turn.get('content')
+        if not isinstance(turn, str):
+            raise ValueError("history must be a list of strings or {role, content} messages")
+        if turn.strip():
+            turns.append(turn)
+    history_turns = data.get('history_turns', QUERY_HISTORY_TURNS)
+    if not isinstance(history_turns, int) or isinstance(history_turns, bool) or history_turns < 0:
+        raise ValueError("history_turns must be a non-negative integer")
+    decay = data.get('history_decay', QUERY_HISTORY_DECAY)
+    if not isinstance(decay, (int, float)) or isinstance(decay, bool) or not 0 <= decay <= 1:
+        raise ValueError("history_decay must be between 0 and 1")
+    turns = turns[max(len(turns) - history_turns, 0):] if history_turns else []
+    expansion = {"turns": turns, "decay": decay} if turns and decay else None
+    
+    boost_chat_id = data.get('boost_chat_id')
+    chat_boost = data.get('chat_boost', CHAT_BOOST)
+    if not isinstance(chat_boost, (int, float)) or isinstance(chat_boost, bool) or chat_boost < 0:
+        raise ValueError("chat_boost must be a non-negative number")
+    boost = {"chat_id": boost_chat_id, "amount": chat_boost} if boost_chat_id is not None and chat_boost else None
+    
+    return {
+        "mode": mode,
+        "merge_chunks": bool(data.get('merge_chunks', False)),
+        "search_ef": search_ef,
+        "exact": bool(data.get('exact', False)),
+        "rerank": rerank,
+        "include": sorted(set(include)),
+        "history": expansion,
+        "boost": boost,
+        "where": build_where(data),
+        "where_document": data.get('where_document') or None,
+        "partitions": [partition.name for partition in router.route_query(tenants, shard_values(data))]
+    }
+
+def embedding_format(data):
+    """Return how the request wants embeddings serialized: "list" or packed "float32"."""
+    fmt = data.get('embedding_format', 'list')
+    if fmt not in ("list", "float32"):
+        raise ValueError("embedding_format must be list or float32")
+    return fmt
+
+def chroma_include(options):
+    """
+    Return the Chroma include entries, distances aside, that a search has to
+    load: the requested fields plus those chunk merging, chat boosts and
+    re-ranking read.
+    """
+    fields = set(options["include"]) - {"distance"}
+    if options["merge_chunks"]:
+        fields |= {"text", "metadata"}
+    if options["boost"]:
+        fields.add("metadata")
+    if options["rerank"]:
+        fields.add("text")
+    return [RESULT_FIELDS[field] for field in RESULT_FIELDS if field in fields]
+
+def format_results(results, index=0):
+    """Turn the index-th result list of a collection.query call into dicts, with the fields it included."""
+    fields = [(field, key) for field, key in RESULT_FIELDS.items() if results.get(key) is not None]
+    return [
+        {"id": record_id, **{field: results[key][index][i] for field, key in fields}}
+        for i, record_id in enumerate(results["ids"][index])
+    ]
+
+def project(hits, include):
+    """Drop the result fields that were loaded for processing but not requested."""
+    dropped = [field for field in RESULT_FIELDS if field not in include]
+    if not dropped:
+        return hits
+    return [{key: value for key, value in hit.items() if key not in dropped} for hit in hits]
+
+def write_documents(documents, tenant=DEFAULT_TENANT):
+    """
+    Upsert documents into the tenant's partitions, embedding only those that
+    are new or whose text changed.
+    
+    Returns a dict mapping each distinct id to "inserted", "updated",
+    "skipped" or "deduplicated" (linked to a near-duplicate stored message).
+    """
+    outcomes = {}
+    with write_lock:
+        for partition, partition_documents in router.route_documents(documents, tenant).items():
+            outcomes.update(write_partition(partition, partition_documents))
+    
+    for outcome, count in count_outcomes(outcomes).items():
+        documents_ingested.inc(count, outcome=outcome)
+    return outcomes
+
+def write_partition(partition, documents):
+    """Upsert documents that all belong to one partition, as write_documents does."""
+    # Later duplicates of an id win, matching what an upsert would keep
+    latest = {}
+    for doc in documents:
+        latest[doc["id"]] = doc
+    
+    stored = stored_messages(partition, list(latest)) if latest else {}
+    
+    outcomes = {}
+    ids, texts, metadatas = [], [], []
+    stale_ids = set()
+    for doc_id, doc in latest.items():
+        digest = content_hash(doc["text"])
+        previous = stored.get(doc_id)
+        if previous is None:
+            outcomes[doc_id] = "inserted"
+        elif previous["hash"] != digest or previous["model"] != embedding_function.model_id:
+            # Unchanged text embedded by another backend is embedded again
+            outcomes[doc_id] = "updated"
+        else:
+            outcomes[doc_id] = "skipped"
+            continue
+        
+        # A numeric copy of the timestamp lets since/until filters use $gte/$lte
+        message_metadata = {}
+        epoch = timestamp_epoch(doc["metadata"])
+        if epoch is not None:
+            message_metadata["timestampEpoch"] = epoch
+        
+        chunk_ids = set()
+        for chunk_id, chunk_text, chunk_metadata in split_message(
+                doc_id, doc["text"], CHUNK_SIZE, CHUNK_OVERLAP, CHUNK_MODE, embedding_function.count_tokens):
+            chunk_ids.add(chunk_id)
+            ids.append(chunk_id)
+            texts.append(chunk_text)
+            metadatas.append({
+                **doc["metadata"],
+                **message_metadata,
+                **chunk_metadata,
+                "parentId": doc_id,
+                "contentHash": digest,
+                "embeddingModel": embedding_function.model_id
+            })
+        
+        # An edited message may now have fewer chunks than before
+        if previous is not None:
+            stale_ids.update(previous["ids"] - chunk_ids)
+    
+    # Records of edited messages are all either rewritten or deleted
+    rewritten = {doc_id for doc_id, outcome in outcomes.items() if outcome != "skipped"}
+    replaced = {record_id for doc_id in rewritten & stored.keys() for record_id in stored[doc_id]["ids"]}
+    
+    # Only new or edited messages are embedded and written
+    embeddings, links = [], []
+    if ids:
+        with stage("embed"):
+            embeddings = embedding_cache(texts)
+    if ids and DEDUP_THRESHOLD:
+        # The previous versions of edited messages are not duplicates of them
+        with stage("dedup"):
+            duplicates = find_duplicates(partition, ids, embeddings, metadatas, replaced)
+        for i in [i for i, record_id in enumerate(ids) if record_id in duplicates]:
+            links.append((ids[i], duplicates[ids[i]], texts[i], metadatas[i]))
+            outcomes[ids[i]] = "deduplicated"
+            stale_ids.update(stored.get(ids[i], {}).get("ids", ()))
+        keep = [i for i, record_id in enumerate(ids) if record_id not in duplicates]
+        ids, texts, metadatas = [ids[i] for i in keep], [texts[i] for i in keep], [metadatas[i] for i in keep]
+        embeddings = [embeddings[i] for i in keep]
+    
+    # Messages linked to records that change or go away take their place
+    if replaced:
+        promote_duplicates(partition, replaced, excluded=rewritten)
+    relinked = [doc_id for doc_id in rewritten & stored.keys() if stored[doc_id]["linked"]]
+    if relinked:
+        partition.duplicate_links.delete(relinked)
+    if links:
+        partition.duplicate_links.add(links)
+    
+    if stale_ids:
+        stale_ids = sorted(stale_ids)
+        partition.collection.delete(ids=stale_ids)
+        partition.keyword_index.delete(stale_ids)
+        if partition.vector_store is not None:
+            partition.vector_store.delete(stale_ids)
+    if ids:
+        with stage("write"):
+            partition.collection.upsert(
+                ids=ids,
+                embeddings=embeddings,
+                documents=texts,
+                metadatas=metadatas
+            )
+            partition.keyword_index.upsert(ids, texts)
+            if partition.vector_store is not None:
+                partition.vector_store.upsert(ids, embeddings)
+    if ids or stale_ids:
+        query_cache.bump_version()
+    
+    return outcomes
+
+def nearest_records(partition, embeddings, n_results, where=None):
+    """Return up to n_results (id, cosine distance) pairs per embedding among a partition's stored records."""
+    if partition.vector_store is not None:
+        ids = partition.collection.get(where=where, include=[])["ids"] if where else None
+        return partition.vector_store.search(embeddings, n_results, RERANK_CANDIDATES, ids=ids)
+    if not partition.collection.count():
+        return [[] for _ in embeddings]
+    results = partition.collection.query(
+        query_embeddings=embeddings, n_results=n_results, where=where, include=["distances"])
+    return [list(zip(ids, distances)) for ids, distances in zip(results["ids"], results["distances"])]
+
+def find_duplicates(partition, record_ids, embeddings, metadatas, replaced=()):
+    """
+    Return {record_id: canonical record id} for the records that are at least
+    DEDUP_THRESHOLD cosine-similar to a stored record, or to an earlier record
+    of the same write, within DEDUP_SCOPE.
+    
+    Only records that hold a whole message are deduplicated. replaced holds
+    the ids of stored records this write deletes or rewrites, which cannot
+    be canonical.
+    """
+    scopes = {}
+    for position, metadata in enumerate(metadatas):
+        if "chunkIndex" in metadata:
+            continue
+        if DEDUP_SCOPE == "chat":
+            if metadata.get("chatId") is None:
+                continue
+            scopes.setdefault(metadata["chatId"], []).append(position)
+        else:
+            scopes.setdefault(None, []).append(position)
+    
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    duplicates = {}
+    for chat_id, positions in scopes.items():
+        # A few neighbours, in case the nearest ones are being replaced
+        neighbours = nearest_records(partition, [embeddings[i] for i in positions], 3,
+                                     {"chatId": chat_id} if chat_id is not None else None)
+        kept = []
+        for position, hits in zip(positions, neighbours):
+            canonical = next((hit_id for hit_id, distance in hits
+                              if hit_id not in replaced and 1 - distance >= DEDUP_THRESHOLD), None)
+            if canonical is None:
+                canonical = next((record_ids[other] for other in kept
+                                  if vectors[position] @ vectors[other] >= DEDUP_THRESHOLD), None)
+            if canonical is None:
+                kept.append(position)
+            else:
+                duplicates[record_ids[position]] = canonical
+    return duplicates
+
+def promote_duplicates(partition, record_ids, excluded=()):
+    """
+    Before record_ids are deleted or rewritten, store the first message
+    linked to each of them in its place and link the others to that message.
+    Messages in excluded are about to be deleted or rewritten themselves.
+    """
+    dependents = {message_id: link for message_id, link in partition.duplicate_links.linked_to(record_ids).items()
+                  if message_id not in excluded}
+    if not dependents:
+        return
+    by_canonical = {}
+    for message_id in sorted(dependents):
+        by_canonical.setdefault(dependents[message_id]["canonical"], []).append(message_id)
+    promoted = [message_ids[0] for message_ids in by_canonical.values()]
+    for message_ids in by_canonical.values():
+        partition.duplicate_links.repoint(message_ids[1:], message_ids[0])
+    
+    texts = [dependents[message_id]["text"] for message_id in promoted]
+    metadatas = [dependents[message_id]["metadata"] for message_id in promoted]
+    embeddings = embedding_cache(texts)
+    partition.collection.upsert(ids=promoted, embeddings=embeddings, documents=texts, metadatas=metadatas)
+    partition.keyword_index.upsert(promoted, texts)
+    if partition.vector_store is not None:
+        partition.vector_store.upsert(promoted, embeddings)
+    partition.duplicate_links.delete(promoted)
+
+def stored_messages(partition, message_ids):
+    """
+    Return {message_id: {"hash": contentHash, "model": embeddingModel,
+    "ids": record ids, "linked": bool}} for the given messages already in
+    the partition.
+    
+    A message is stored either as a single record with its own id, as chunk
+    records whose parentId metadata points back to it, or, when it was
+    deduplicated, as a link without records.
+    """
+    by_id = partition.collection.get(ids=message_ids, include=["metadatas"])
+    by_parent = partition.collection.get(where={"parentId": {"$in": message_ids}}, include=["metadatas"])
+    
+    stored = {}
+    for record_id, metadata in zip(by_id["ids"] + by_parent["ids"],
+                                   by_id["metadatas"] + by_parent["metadatas"]):
+        metadata = metadata or {}
+        entry = stored.setdefault(metadata.get("parentId", record_id), {
+            "hash": metadata.get("contentHash"),
+            # Records without embeddingModel predate backends and used the default
+            "model": metadata.get("embeddingModel", DEFAULT_MODEL_ID),
+            "ids": set(),
+            "linked": False
+        })
+        entry["ids"].add(record_id)
+    for message_id, link in partition.duplicate_links.get(message_ids).items():
+        stored.setdefault(message_id, {
+            "hash": link["metadata"].get("contentHash"),
+            "model": link["metadata"].get("embeddingModel", DEFAULT_MODEL_ID),
+            "ids": set(),
+            "linked": True
+        })
+    return stored
+
+def count_outcomes(outcomes):
+    """Summarize write_documents outcomes as inserted/updated/skipped/deduplicated counts."""
+    counts = {"inserted": 0, "updated": 0, "skipped": 0, "deduplicated": 0}
+    for outcome in outcomes.values():
+        counts[outcome] += 1
+    return counts
+
+def keyword_search(partition, query_text, limit, options):
+    """Return up to limit formatted BM25 hits from a partition that pass the request's filters."""
+    # Chroma applies the filters and BM25 ranks only the records that pass
+    candidates = None
+    if options["where"] or options["where_document"]:
+        candidates = partition.collection.get(
+            where=options["where"], where_document=options["where_document"], include=[]
+        )["ids"]
+    ranked = partition.keyword_index.search(query_text, limit, candidates)
+    if not ranked:
+        return []
+    
+    # Chroma supplies the requested fields
+    records = partition.collection.get(ids=[record_id for record_id, _ in ranked], include=chroma_include(options))
+    fields = [(field, key) for field, key in RESULT_FIELDS.items() if records.get(key) is not None]
+    found = {record_id: {field: records[key][i] for field, key in fields}
+             for i, record_id in enumerate(records["ids"])}
+    hits = []
+    for record_id, score in ranked:
+        if record_id in found:
+            hits.append({"id": record_id, **found[record_id], "distance": None, "score": score})
+    return hits[:limit]
+
+def fuse_rankings(vector_hits, keyword_hits, k=60):
+    """
+    Combine two ranked hit lists with reciprocal-rank fusion, best first.
+    
+    A hit's score is the sum of 1 / (k + rank) over the lists it appears in;
+    hits found by the vector search keep their cosine distance.
+    """
+    fused = {}
+    for hits in (vector_hits, keyword_hits):
+        for rank, hit in enumerate(hits, start=1):
+            entry = fused.setdefault(hit["id"], {**hit, "score": 0.0})
+            entry["score"] += 1.0 / (k + rank)
+    return sorted(fused.values(), key=lambda hit: hit["score"], reverse=True)
+
+def exact_query(partition, query_embeddings, n_results, where=None, where_document=None, batch_size=5000,
+                include=("documents", "metadatas")):
+    """
+    Brute-force cosine search over every matching record of a partition.
+    
+    Returns the same structure as collection.query, with distances and the
+    include fields, so its results can be compared with, or used instead of,
+    an HNSW search.
+    """
+    queries = np.asarray(query_embeddings, dtype=np.float32)
+    queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+    best_ids = [np.array([], dtype=object) for _ in queries]
+    best_distances = [np.array([], dtype=np.float32) for _ in queries]
+    
+    offset = 0
+    while True:
+        records = partition.collection.get(
+            where=where, where_document=where_document,
+            limit=batch_size, offset=offset, include=["embeddings"]
+        )
+        if len(records["ids"]):
+            vectors = np.asarray(records["embeddings"], dtype=np.float32)
+            vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            distances = 1.0 - queries @ vectors.T
+            ids = np.asarray(records["ids"], dtype=object)
+            for position in range(len(queries)):
+                # Keep a running top n_results across batches
+                merged_ids = np.concatenate([best_ids[position], ids])
+                merged_distances = np.concatenate([best_distances[position], distances[position]])
+                keep = np.argsort(merged_distances, kind="stable")[:n_results]
+                best_ids[position], best_distances[position] = merged_ids[keep], merged_distances[keep]
+        if len(records["ids"]) < batch_size:
+            break
+        offset += batch_size
+    
+    ranked = [list(zip(ids, distances)) for ids, distances in zip(best_ids, best_distances)]
+    return query_results(partition, ranked, include)
+
+def query_results(partition, ranked, include=("documents", "metadatas")):
+    """
+    Build a collection.query-shaped result from one list of (id, distance)
+    pairs per query, fetching the include fields from Chroma.
+    """
+    results = {key: None for key in RESULT_FIELDS.values()}
+    wanted = sorted({record_id for pairs in ranked for record_id, _ in pairs})
+    if include and wanted:
+        found = partition.collection.get(ids=wanted, include=list(include))
+        records = {record_id: i for i, record_id in enumerate(found["ids"])}
+        # Records deleted since they were ranked are left out
+        ranked = [[(record_id, distance) for record_id, distance in pairs if record_id in records]
+                  for pairs in ranked]
+        for key in include:
+            results[key] = [[found[key][records[record_id]] for record_id, _ in pairs] for pairs in ranked]
+    elif include:
+        results.update({key: [[] for _ in ranked] for key in include})
+    results["ids"] = [[record_id for record_id, _ in pairs] for pairs in ranked]
+    results["distances"] = [[float(distance) for _, distance in pairs] for pairs in ranked]
+    return results
+
+def quantized_query(partition, query_embeddings, n_results, options):
+    """Search a partition's int8 vector store, re-ranking candidates at full precision."""
+    ids = None
+    if options["where"] or options["where_document"]:
+        # Chroma evaluates the filters; the store only scores the matching records
+        ids = partition.collection.get(
+            where=options["where"], where_document=options["where_document"], include=[]
+        )["ids"]
+    candidates = max(RERANK_CANDIDATES, options["search_ef"] or 0)
+    ranked = partition.vector_store.search(query_embeddings, n_results, candidates, ids=ids)
+    return query_results(partition, ranked, chroma_include(options))
+
+def widened_query(partition, query_embeddings, n_results, options):
+    """
+    Search a partition's HNSW index for search_ef results, loading the
+    requested fields of only the best n_results.
+    """
+    # hnswlib searches with max(ef_search, k) candidates, so asking for
+    # search_ef results raises the recall of this query alone
+    results = partition.collection.query(
+        query_embeddings=query_embeddings,
+        n_results=options["search_ef"],
+        where=options["where"],
+        where_document=options["where_document"],
+        include=["distances"]
+    )
+    ranked = [list(zip(ids, distances))[:n_results] for ids, distances in zip(results["ids"], results["distances"])]
+    return query_results(partition, ranked, chroma_include(options))
+
+def search_partition(partition, query_texts, query_embeddings, n_results, options):
+    """Return one ranked hit list per query text, searching a single partition."""
+    mode = options["mode"]
+    vector_hits = [[] for _ in query_texts]
+    if mode != "keyword":
+        if options["exact"]:
+            results = exact_query(partition, query_embeddings, n_results,
+                                  options["where"], options["where_document"], include=chroma_include(options))
+        elif partition.vector_store is not None:
+            results = quantized_query(partition, query_embeddings, n_results, options)
+        elif (options["search_ef"] or 0) > n_results:
+            results = widened_query(partition, query_embeddings, n_results, options)
+        else:
+            results = partition.collection.query(
+                query_embeddings=query_embeddings,
+                n_results=n_results,
+                where=options["where"],
+                where_document=options["where_document"],
+                include=chroma_include(options) + ["distances"]
+            )
+        with stage("format"):
+            vector_hits = [boost_chat(format_results(results, position), options["boost"])[:n_results]
+                           for position in range(len(query_texts))]
+    if mode == "vector":
+        return vector_hits
+    
+    partition_hits = []
+    for query_text, hits in zip(query_texts, vector_hits):
+        with stage("keyword_search"):
+            keyword_hits = keyword_search(partition, query_text, n_results, options)
+        partition_hits.append(keyword_hits if mode == "keyword" else fuse_rankings(hits, keyword_hits))
+    return partition_hits
+
+def rerank_hits(query_text, hits, settings):
+    """
+    Return hits ordered by cross-encoder score, best first, each with its
+    rerank_score, or None when scoring them would exceed the request's
+    latency budget (settings["budget_ms"], counted from the request's start).
+    """
+    if not hits:
+        return hits
+    deadline = None
+    if settings["budget_ms"]:
+        started = g.get("started", time.perf_counter()) if has_request_context() else time.perf_counter()
+        deadline = started + settings["budget_ms"] / 1000
+        if time.perf_counter() + reranker.estimate(len(hits)) > deadline:
+            rerank_skipped.inc(reason="predicted")
+            return None
+    scores = reranker(query_text, [hit["text"] for hit in hits], deadline)
+    if scores is None:
+        rerank_skipped.inc(reason="deadline")
+        return None
+    reranked = [dict(hit, rerank_score=score) for hit, score in zip(hits, scores)]
+    return sorted(reranked, key=lambda hit: hit["rerank_score"], reverse=True)
+
+def merge_partition_hits(hit_lists, mode, boost=None):
+    """Merge the ranked hit lists of several partitions into one, best first."""
+    if len(hit_lists) == 1:
+        return hit_lists[0]
+    hits = [hit for hits in hit_lists for hit in hits]
+    if mode == "vector":
+        return boost_chat(hits, boost)
+    return sorted(hits, key=lambda hit: hit["score"], reverse=True)
+
+def boost_chat(hits, boost):
+    """
+    Return vector hits ordered by distance, those from boost["chat_id"] counted
+    boost["amount"] closer; their reported distances are left unchanged.
+    """
+    if boost is None:
+        return sorted(hits, key=lambda hit: hit["distance"])
+    return sorted(hits, key=lambda hit: hit["distance"] - boost["amount"] * (
+        (hit.get("metadata") or {}).get("chatId") == boost["chat_id"]))
+
+def embed_queries(query_texts, history=None):
+    """
+    Return the search vector of each query text. With history (query_options'
+    "history"), each is the normalized mix of the query's embedding and those
+    of the conversation's recent turns, all computed in one batch.
+    """
+    if history is None:
+        return embedding_cache(query_texts)
+    turns = history["turns"]
+    embeddings = np.asarray(embedding_cache(list(query_texts) + turns), dtype=np.float32)
+    embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    # The newest turn weighs decay relative to the query, the one before decay ** 2, ...
+    weights = history["decay"] ** np.arange(len(turns), 0, -1, dtype=np.float32)
+    mixed = embeddings[:len(query_texts)] + weights @ embeddings[len(query_texts):]
+    return (mixed / np.maximum(np.linalg.norm(mixed, axis=1, keepdims=True), 1e-12)).tolist()
+
+def search(query_texts, n_results, options):
+    """
+    Return one formatted result list per query text, using the query cache.
+    
+    Cache misses are embedded in one batch and searched in one collection.query
+    call per partition; the partitions in options are searched in parallel
+    and their top hits merged. options comes from query_options(); its where
+    filters are applied inside Chroma, so only matching records are searched.
+    In keyword and hybrid modes each query also runs against the BM25
+    keyword index. With options["rerank"], the top candidates are re-ranked
+    by the cross-encoder; results it skipped for lack of time are returned
+    in search order and not cached.
+    """
+    batch_results = [query_cache.get(text, n_results, options) for text in query_texts]
+    misses = [i for i, cached in enumerate(batch_results) if cached is None]
+    if not misses:
+        return batch_results
+    
+    version = query_cache.version
+    texts = [query_texts[i] for i in misses]
+    partitions = [router.named(name) for name in options["partitions"]]
+    
+    # Merging collapses chunks of one message, and a boost can lift hits from
+    # just past the top n_results, so fetch extra candidates
+    fetch = n_results * 3 if options["merge_chunks"] else n_results
+    if options["boost"]:
+        fetch = max(fetch, n_results * 2)
+    if options["rerank"]:
+        fetch = max(fetch, options["rerank"]["candidates"])
+    
+    # The whole list is embedded in one forward pass, shared by all partitions
+    query_embeddings = None
+    if options["mode"] != "keyword" and partitions:
+        with stage("embed"):
+            query_embeddings = embed_queries(texts, options["history"])
+    
+    def search_one(partition):
+        return search_partition(partition, texts, query_embeddings, fetch, options)
+    
+    with stage("search"):
+        if len(partitions) == 1:
+            partition_results = [search_one(partitions[0])]
+        else:
+            partition_results = list(partition_pool.map(search_one, partitions))
+    
+    for position, i in enumerate(misses):
+        formatted_results = merge_partition_hits([hits[position] for hits in partition_results], options["mode"],
+                                                 options["boost"])
+        if options["merge_chunks"]:
+            with stage("format"):
+                embeddings = {hit["id"]: hit["embedding"] for hit in formatted_results if "embedding" in hit}
+                formatted_results = merge_chunks(formatted_results)
+                # A merged message is represented by the mean of its chunks' embeddings
+                for hit in formatted_results:
+                    if "chunks" in hit and embeddings:
+                        hit["embedding"] = np.mean([embeddings[chunk] for chunk in hit["chunks"]], axis=0)
+        reranked = None
+        if options["rerank"]:
+            with stage("rerank"):
+                candidates = max(options["rerank"]["candidates"], n_results)
+                reranked = rerank_hits(query_texts[i], formatted_results[:candidates], options["rerank"])
+        formatted_results = (reranked if reranked is not None else formatted_results)[:n_results]
+        formatted_results = project(formatted_results, options["include"])
+        batch_results[i] = formatted_results
+        if reranked is not None or not options["rerank"]:
+            query_cache.put(query_texts[i], n_results, formatted_results, version, options)
+    
+    return batch_results
+
+def matching_messages(partition, where=None, where_document=None, batch_size=1000):
+    """Return the ids of the messages in a partition with a record matching the filters."""
+    message_ids = set()
+    offset = 0
+    while True:
+        records = partition.collection.get(
+            where=where, where_document=where_document,
+            limit=batch_size, offset=offset, include=["metadatas"]
+        )
+        for record_id, metadata in zip(records["ids"], records["metadatas"]):
+            message_ids.add((metadata or {}).get("parentId", record_id))
+        if len(records["ids"]) < batch_size:
+            break
+        offset += batch_size
+    return message_ids | partition.duplicate_links.matching(where, where_document)
+
+def delete_messages(partition, message_ids, dry_run=False, batch_size=500):
+    """
+    Delete messages, with all of their chunk records or duplicate links, from
+    a partition and its indexes. Returns the number of records and links
+    deleted (or that would be).
+    """
+    message_ids = sorted(message_ids)
+    deleted = 0
+    for start in range(0, len(message_ids), batch_size):
+        batch = message_ids[start:start + batch_size]
+        with write_lock:
+            stored = stored_messages(partition, batch)
+            record_ids = sorted({record_id for entry in stored.values() for record_id in entry["ids"]})
+            linked = [message_id for message_id, entry in stored.items() if entry["linked"]]
+            deleted += len(linked)
+            if linked and not dry_run:
+                partition.duplicate_links.delete(linked)
+            if record_ids and not dry_run:
+                promote_duplicates(partition, record_ids, excluded=set(batch))
+                partition.collection.delete(ids=record_ids)
+                partition.keyword_index.delete(record_ids)
+                if partition.vector_store is not None:
+                    partition.vector_store.delete(record_ids)
+        deleted += len(record_ids)
+    if deleted and not dry_run:
+        query_cache.bump_version()
+    return deleted
+
+def delete_where(partitions, where=None, where_document=None, dry_run=False):
+    """Delete every message matching the filters from the partitions; return message and record counts."""
+    counts = {"messages": 0, "records": 0}
+    for partition in partitions:
+        message_ids = matching_messages(partition, where, where_document)
+        counts["messages"] += len(message_ids)
+        counts["records"] += delete_messages(partition, message_ids, dry_run)
+    return counts
+
+def messages_over_chat_limit(partition, max_per_chat, batch_size=1000):
+    """Return the ids of the messages of each chat beyond its newest max_per_chat."""
+    chats = {}
+    offset = 0
+    while True:
+        records = partition.collection.get(limit=batch_size, offset=offset, include=["metadatas"])
+        for record_id, metadata in zip(records["ids"], records["metadatas"]):
+            metadata = metadata or {}
+            if metadata.get("chatId") is None:
+                continue
+            # Newest first by timestamp, then by position in the chat
+            order = (metadata.get("timestampEpoch", 0), metadata.get("messageIndex", 0))
+            chats.setdefault(metadata["chatId"], {})[metadata.get("parentId", record_id)] = order
+        if len(records["ids"]) < batch_size:
+            break
+        offset += batch_size
+    for message_id, metadata in partition.duplicate_links.items():
+        if metadata.get("chatId") is not None:
+            order = (metadata.get("timestampEpoch", 0), metadata.get("messageIndex", 0))
+            chats.setdefault(metadata["chatId"], {})[message_id] = order
+    
+    over_limit = set()
+    for messages in chats.values():
+        newest_first = sorted(messages, key=messages.get, reverse=True)
+        over_limit.update(newest_first[max_per_chat:])
+    return over_limit
+
+def undated_records(partition, cutoff):
+    """Return how many of a partition's records have no timestampEpoch, so no age limit applies to them."""
+    # Chroma has no "field is missing" filter; every dated record is on one side of the cutoff
+    dated = sum(
+        len(partition.collection.get(where={"timestampEpoch": {op: cutoff}}, include=[])["ids"])
+        for op in ("$lt", "$gte")
+    )
+    return partition.collection.count() - dated
+
+def apply_retention(max_age_days=RETENTION_MAX_AGE_DAYS, max_per_chat=RETENTION_MAX_PER_CHAT, dry_run=False):
+    """
+    Delete expired messages and messages beyond each chat's limit, in every
+    partition. Returns the number of messages deleted for each reason and
+    the number of records kept because they have no valid timestamp.
+    
+    Both limits order messages by timestampEpoch, which open_collection()
+    backfills before a partition can be used.
+    """
+    counts = {"expired": 0, "over_limit": 0, "records": 0, "undated": 0}
+    for partition in router.open_all():
+        if max_age_days:
+            cutoff = time.time() - max_age_days * 86400
+            expired = matching_messages(partition, {"timestampEpoch": {"$lt": cutoff}})
+            counts["expired"] += len(expired)
+            counts["records"] += delete_messages(partition, expired, dry_run)
+            counts["undated"] += undated_records(partition, cutoff)
+        if max_per_chat:
+            over_limit = messages_over_chat_limit(partition, max_per_chat)
+            counts["over_limit"] += len(over_limit)
+            counts["records"] += delete_messages(partition, over_limit, dry_run)
+    return counts
+
+def retention_worker():
+    """Apply the retention policy every RETENTION_INTERVAL seconds."""
+    while True:
+        try:
+            counts = apply_retention()
+            if counts["records"]:
+                print(f"Retention: deleted {counts['expired']} expired and "
+                      f"{counts['over_limit']} over-limit messages", flush=True)
+            if counts["undated"]:
+                print(f"Retention: {counts['undated']} records have no valid timestamp and "
+                      f"never expire", flush=True)
+        except Exception as e:
+            print(f"Retention: failed: {e}", flush=True)
+        time.sleep(RETENTION_INTERVAL)
+
+def directory_size(path):
+    """Return the total size in bytes of the files under path."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def rebuild_partition(partition, batch_size=1000):
+    """
+    Copy a partition's records into a freshly built collection that replaces
+    it, dropping the space deleted records still hold in the HNSW files.
+    """
+    old = partition.collection
+    rebuilt = client.create_collection(name=partition.name + REBUILDING_SUFFIX, metadata={
+        **router.metadata,
+        **{key: value for key, value in (old.metadata or {}).items() if not key.startswith("hnsw:")}
+    })
+    for offset in range(0, old.count(), batch_size):
+        records = old.get(limit=batch_size, offset=offset, include=["embeddings", "documents", "metadatas"])
+        rebuilt.add(ids=records["ids"], embeddings=records["embeddings"],
+                    documents=records["documents"], metadatas=records["metadatas"])
+    old.modify(name=partition.name + REPLACED_SUFFIX)
+    rebuilt.modify(name=partition.name)
+    partition.collection = rebuilt
+    client.delete_collection(partition.name + REPLACED_SUFFIX)
+
+def remove_orphaned_segments():
+    """Delete segment directories under DB_PATH that no collection uses any more."""
+    with sqlite3.connect(os.path.join(DB_PATH, "chroma.sqlite3")) as conn:
+        segment_ids = {row[0] for row in conn.execute("SELECT id FROM segments")}
+    for name in os.listdir(DB_PATH):
+        path = os.path.join(DB_PATH, name)
+        # Segment directories are named by UUID
+        if os.path.isdir(path) and len(name) == 36 and name.count("-") == 4 and name not in segment_ids:
+            shutil.rmtree(path, ignore_errors=True)
+
+def reindex():
+    """
+    Rebuild the partitions whose build-time HNSW parameters differ from the
+    configured ones, returning their names. Like compact(), run it while no
+    server is using DB_PATH.
+    """
+    rebuilt = []
+    for partition in router.open_all():
+        if hnsw_outdated(partition.collection):
+            rebuild_partition(partition)
+            rebuilt.append(partition.name)
+    if rebuilt:
+        remove_orphaned_segments()
+    return rebuilt
+
+def measure_recall(partition, sample, k, seed=0):
+    """
+    Return recall@k of the partition's vector search against a brute-force
+    search, over sample synthetic queries.
+    
+    Each query is the sum of two stored embeddings, so it resembles real data
+    without being a stored vector that every method finds at distance 0.
+    A quantized partition samples and searches its own full-precision vectors
+    on disk; otherwise a window of the collection is read from Chroma.
+    """
+    rng = np.random.default_rng(seed)
+    if partition.vector_store is not None:
+        vectors = partition.vector_store.sample(2 * sample, seed)
+    else:
+        offset = int(rng.integers(0, max(partition.collection.count() - 2 * sample, 0) + 1))
+        vectors = np.asarray(partition.collection.get(
+            limit=2 * sample, offset=offset, include=["embeddings"])["embeddings"], dtype=np.float32)
+    if len(vectors) < 2:
+        return None
+    vectors = vectors[rng.permutation(len(vectors))]
+    half = len(vectors) // 2
+    queries = (vectors[:half] + vectors[half:2 * half]).tolist()
+    if partition.vector_store is not None:
+        exact = partition.vector_store.exact_search(queries, k)
+    else:
+        exact = exact_query(partition, queries, k, include=())["ids"]
+    
+    def recall(found):
+        return round(float(np.mean([len(set(ids) & set(truth)) / len(truth) for ids, truth in zip(found, exact)])), 4)
+    
+    measured = {"k": k, "queries": len(queries)}
+    if partition.vector_store is None:
+        measured["hnsw"] = recall(partition.collection.query(query_embeddings=queries, n_results=k, include=[])["ids"])
+    else:
+        first_pass = partition.vector_store.search(queries, k, k, rerank=False)
+        reranked = partition.vector_store.search(queries, k, RERANK_CANDIDATES)
+        measured["int8"] = recall([[record_id for record_id, _ in pairs] for pairs in first_pass])
+        measured["int8_reranked"] = recall([[record_id for record_id, _ in pairs] for pairs in reranked])
+    return measured
+
+def index_stats(sample=0, k=10):
+    """
+    Return vector index statistics per open partition: the record count,
+    the number of messages linked as duplicates, the vector store's memory
+    use when quantized, and with sample > 0 the recall measured by
+    measure_recall().
+    """
+    stats = {}
+    for partition in router.open_partitions():
+        entry = {"records": partition.collection.count(), "duplicates_linked": len(partition.duplicate_links)}
+        if partition.vector_store is not None:
+            entry.update(partition.vector_store.stats())
+        if sample and entry["records"]:
+            entry["recall"] = measure_recall(partition, sample, k)
+        stats[partition.name] = entry
+    return stats
+
+def compact():
+    """
+    Rebuild every partition's collection and keyword index and vacuum the
+    SQLite store, returning the size of DB_PATH before and after.
+    
+    Run it while no server is using DB_PATH: another process would keep
+    serving the replaced collections from memory.
+    """
+    before = directory_size(DB_PATH)
+    partitions = router.open_all()
+    for partition in partitions:
+        rebuild_partition(partition)
+        partition.keyword_index.compact()
+        if partition.vector_store is not None:
+            partition.vector_store.compact()
+    remove_orphaned_segments()
+    with sqlite3.connect(os.path.join(DB_PATH, "chroma.sqlite3"), isolation_level=None) as conn:
+        conn.execute("VACUUM")
+    after = directory_size(DB_PATH)
+    return {
+        "partitions": len(partitions),
+        "bytes_before": before,
+        "bytes_after": after,
+        "bytes_reclaimed": before - after
+    }
+
+def export_snapshot(f, batch_size=1000):
+    """
+    Write a snapshot of every partition's records, with their embeddings, and
+    of its duplicate links to the binary file object f. Writes wait until it
+    is done, so the snapshot is consistent. Returns the counts written.
+    """
+    with write_lock:
+        partitions = router.open_all()
+        writer = SnapshotWriter(f, embedding_function.model_id, stored_dimensions(partitions))
+        for partition in partitions:
+            for offset in range(0, partition.collection.count(), batch_size):
+                records = partition.collection.get(limit=batch_size, offset=offset,
+                                                   include=["embeddings", "documents", "metadatas"])
+                if records["ids"]:
+                    writer.records(partition.tenant, records["ids"], records["documents"],
+                                   records["metadatas"], records["embeddings"])
+            links = partition.duplicate_links.rows()
+            for start in range(0, len(links), batch_size):
+                ids, canonical, texts, metadatas = zip(*links[start:start + batch_size])
+                writer.links(partition.tenant, ids, canonical, texts, metadatas)
+        writer.close()
+    return writer.counts
+
+def import_snapshot(f):
+    """
+    Load a snapshot written by export_snapshot() from the binary file object
+    f, upserting its records with their stored embeddings, so nothing is
+    embedded again. Records are routed by this server's SHARD_COUNT, which
+    may differ from the exporting server's, and links follow their canonical
+    record (those whose record is missing are skipped). Returns the counts
+    imported.
+    """
+    counts = {"records": 0, "links": 0}
+    dimensions = None
+    # Frames before a damaged one are already written and must not be served stale
+    try:
+        for header, columns in read_snapshot(f):
+            if header["kind"] == "manifest":
+                if header["embedding_model"] != embedding_function.model_id:
+                    raise ValueError(f"The snapshot was embedded with {header['embedding_model']}, "
+                                     f"but this server uses {embedding_function.model_id}")
+                dimensions = header.get("dimensions")
+                stored = stored_dimensions(router.open_all())
+                if dimensions is not None and stored is not None and dimensions != stored:
+                    raise ValueError(f"The snapshot holds {dimensions}-dimensional embeddings, "
+                                     f"but this server stores {stored}-dimensional ones")
+            if header["kind"] not in ("records", "links"):
+                continue
+            if header["kind"] == "records" and dimensions is not None and columns["embeddings"].shape[1] != dimensions:
+                raise ValueError(f"The snapshot's manifest lists {dimensions}-dimensional embeddings, "
+                                 f"but a records frame holds {columns['embeddings'].shape[1]}-dimensional ones")
+            tenant = validate_tenant(header["tenant"])
+            if header["kind"] == "links":
+                # A link belongs with its canonical record, imported before it
+                shards = canonical_shards(tenant, set(columns["canonical"]))
+                shard_of = [shards.get(canonical) for canonical in columns["canonical"]]
+            else:
+                shard_of = [router.shard_of((metadata or {}).get(router.shard_key)) for metadata in columns["metadatas"]]
+            groups = {}
+            for i, shard in enumerate(shard_of):
+                if shard is not None:
+                    groups.setdefault(shard, []).append(i)
+            with write_lock:
+                for shard, rows in groups.items():
+                    partition = router.get(tenant, shard)
+                    ids = [columns["ids"][i] for i in rows]
+                    metadatas = [columns["metadatas"][i] for i in rows]
+                    if header["kind"] == "links":
+                        partition.duplicate_links.add(
+                            [(ids[n], columns["canonical"][i], columns["texts"][i], metadatas[n])
+                             for n, i in enumerate(rows)])
+                        continue
+                    documents = [columns["documents"][i] for i in rows]
+                    embeddings = columns["embeddings"][rows]
+                    with stage("write"):
+                        partition.collection.upsert(ids=ids, embeddings=embeddings,
+                                                    documents=documents, metadatas=metadatas)
+                        partition.keyword_index.upsert(ids, documents)
+                        if partition.vector_store is not None:
+                            partition.vector_store.upsert(ids, embeddings)
+            counts[header["kind"]] += sum(len(rows) for rows in groups.values())
+    finally:
+        query_cache.bump_version()
+    return counts
+
+def stored_dimensions(partitions):
+    """Return the length of the embeddings stored in the partitions, or None when they hold no records."""
+    for partition in partitions:
+        embeddings = partition.collection.get(limit=1, include=["embeddings"])["embeddings"]
+        if embeddings is not None and len(embeddings):
+            return len(embeddings[0])
+    return None
+
+def canonical_shards(tenant, record_ids):
+    """Return {record id: shard} for the record_ids stored in the tenant's partitions."""
+    shards = {}
+    for shard in range(router.shard_count):
+        partition = router.get(tenant, shard, create=False)
+        if partition is not None and record_ids:
+            found = partition.collection.get(ids=sorted(record_ids), include=[])["ids"]
+            shards.update((record_id, shard) for record_id in found)
+    return shards
+
+# Every ingest is written by this queue's single worker, which coalesces
+# concurrent requests into shared batches; queries never wait for it. When
+# INGEST_QUEUE_SIZE documents are waiting, further ingests get HTTP 429.
+# On shutdown the queued documents get up to INGEST_DRAIN_TIMEOUT seconds
+# to be written.
+ingest_queue = IngestQueue(
+    write_documents,
+    batch_size=int(os.environ.get("INGEST_BATCH_SIZE", 64)),
+    linger=float(os.environ.get("INGEST_LINGER_MS", 50)) / 1000,
+    max_pending=int(os.environ.get("INGEST_QUEUE_SIZE", 10000))
+)
+INGEST_DRAIN_TIMEOUT = float(os.environ.get("INGEST_DRAIN_TIMEOUT", 30))
+
+def drain_ingest_queue():
+    """Refuse new ingests and write the queued ones before the process exits."""
+    unwritten = ingest_queue.close(INGEST_DRAIN_TIMEOUT)
+    if unwritten:
+        print(f"Shutdown: {unwritten} queued documents were not written "
+              f"within {INGEST_DRAIN_TIMEOUT:g}s", flush=True)
+
+# Exposed by /metrics
+metrics = MetricsRegistry()
+request_count = metrics.counter(
+    "chroma_requests_total", "HTTP requests by route, method and status", ("route", "method", "status"))
+request_errors = metrics.counter(
+    "chroma_request_errors_total", "Requests that failed with a server error, by route", ("route",))
+request_seconds = metrics.histogram(
+    "chroma_request_duration_seconds", "Request latency by route", ("route",))
+stage_seconds = metrics.histogram(
+    "chroma_stage_duration_seconds", "Time spent in each processing stage", ("stage",))
+rerank_skipped = metrics.counter(
+    "chroma_rerank_skipped_total",
+    "Queries returned without re-ranking because of the latency budget, by reason (predicted or deadline)",
+    ("reason",))
+documents_ingested = metrics.counter(
+    "chroma_documents_ingested_total", "Ingested documents by outcome (inserted, updated, skipped or deduplicated)", ("outcome",))
+metrics.gauge(
+    "chroma_collection_records", "Records (messages and chunks) per partition",
+    lambda: {(partition.name,): partition.collection.count() for partition in router.open_partitions()},
+    ("partition",))
+metrics.gauge("chroma_ingest_pending_documents", "Documents waiting in the ingest queue", ingest_queue.pending)
+ingest_rejected = metrics.counter(
+    "chroma_ingest_rejected_total", "Ingest requests refused with HTTP 429 because the ingest queue was full")
+metrics.gauge(
+    "chroma_cache_hits_total", "Cache hits by cache",
+    lambda: {("query",): query_cache.stats()["hits"],
+             ("embedding",): embedding_cache.stats()["memory_hits"] + embedding_cache.stats()["disk_hits"]},
+    ("cache",), kind="counter")
+metrics.gauge(
+    "chroma_cache_misses_total", "Cache misses by cache",
+    lambda: {("query",): query_cache.stats()["misses"], ("embedding",): embedding_cache.stats()["misses"]},
+    ("cache",), kind="counter")
+metrics.gauge(
+    "chroma_cache_hit_ratio", "Share of cache lookups that hit, by cache",
+    lambda: {("query",): query_cache.stats()["hit_rate"], ("embedding",): embedding_cache.stats()["hit_rate"]},
+    ("cache",))
+
+metrics.gauge(
+    "chroma_vector_store_memory_bytes", "Memory held by quantized vectors per partition",
+    lambda: {(partition.name,): partition.vector_store.stats()["memory_bytes"]
+             for partition in router.open_partitions() if partition.vector_store is not None},
+    ("partition",))
+metrics.gauge(
+    "chroma_vector_store_search_saved_bytes",
+    "Memory the quantized first-pass search saves compared with float32 vectors, per partition",
+    lambda: {(partition.name,): partition.vector_store.stats()["search_memory_saved_bytes"]
+             for partition in router.open_partitions() if partition.vector_store is not None},
+    ("partition",))
+
+# Set SERVER_TIMING=1 to send a Server-Timing header with every response,
+# not only those requested with ?timing=1
+SERVER_TIMING = os.environ.get("SERVER_TIMING") == "1"
+
+@contextmanager
+def stage(name):
+    """Time a processing stage for /metrics and the request's Server-Timing header."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage=name)
+        if has_request_context():
+            timings = g.setdefault("timings", {})
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+@app.before_request
+def start_request_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    """Count the request and, when asked for, report its stage timings."""
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    elapsed = time.perf_counter() - g.get("started", time.perf_counter())
+    request_count.inc(route=route, method=request.method, status=response.status_code)
+    if response.status_code >= 500:
+        request_errors.inc(route=route)
+    request_seconds.observe(elapsed, route=route)
+    
+    if SERVER_TIMING or request.args.get('timing') in ('1', 'true'):
+        entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in g.get("timings", {}).items()]
+        entries.append(f"total;dur={elapsed * 1000:.2f}")
+        response.headers["Server-Timing"] = ", ".join(entries)
+        # Lets the browser show the timings for cross-origin requests
+        response.headers["Timing-Allow-Origin"] = "*"
+    return response
+
+def is_valid_document(doc):
+    """Check that an ingest document has the fields write_documents needs."""
+    return (
+        isinstance(doc, dict)
+        and isinstance(doc.get("id"), str)
+        and isinstance(doc.get("text"), str)
+        and isinstance(doc.get("metadata"), dict)
+    )
+
 @app.route('/ingest', methods=['POST'])
 def ingest():
     """
     Ingest chat messages into ChromaDB.
     
+    Messages are upserted by id. A content hash is kept in each message's
+    metadata so re-ingesting a chat only embeds new or edited messages.
+    Messages longer than CHUNK_SIZE tokens are stored as overlapping chunks
+    with ids "<id>#<n>" and a parentId metadata field pointing at the message.
+    
+    Documents are written by the single ingest worker, together with those
+    of concurrent requests. The request waits for them to be written, or
+    with ?async=1 returns a job id straight away (HTTP 202); poll
+    /ingest/jobs/<job_id> for progress. When the ingest queue is full the
+    request is refused with HTTP 429 and a Retry-After header.
+    
+    Documents are stored in the partitions of the request's tenant, given as
+    a "tenant" field, a ?tenant= argument or an X-Tenant-Id header.
+    
     Expected format:
     {
+        "tenant": "alice",  # optional, defaults to the default tenant
         "documents": [
             {
                 "id": "unique_id",
@@ -50,36 +1596,190 @@ def ingest():
             ...
         ]
     }
+    
+    Returns:
+    {
+        "success": true,
+        "count": 10,     # documents received
+        "inserted": 2,   # new ids
+        "updated": 1,    # existing ids whose text changed
+        "skipped": 7,    # existing ids with unchanged text
+        "deduplicated": 0  # linked to a near-duplicate stored message (DEDUP_THRESHOLD)
+    }
     """
     try:
-        data = request.json
+        with stage("parse"):
+            data = request.json
         
         if not data or 'documents' not in data:
             return jsonify({"error": "Invalid request format"}), 400
         
         documents = data['documents']
+        tenant = request_tenant(data)
+        if not isinstance(documents, list) or not all(is_valid_document(doc) for doc in documents):
+            return jsonify({"error": "Each document needs an id, text and metadata"}), 400
         
-        # Extract data for ChromaDB ingestion
-        ids = [doc["id"] for doc in documents]
-        texts = [doc["text"] for doc in documents]
-        metadatas = [doc["metadata"] for doc in documents]
+        job = ingest_queue.submit(documents, tenant)
+        if request.args.get('async') in ('1', 'true'):
+            return jsonify({
+                "success": True,
+                "job_id": job.id,
+                "status_url": f"/ingest/jobs/{job.id}",
+                "count": len(documents)
+            }), 202
         
-        # Add documents to collection
-        collection.add(
-            ids=ids,
-            documents=texts,
-            metadatas=metadatas
-        )
+        with stage("queue"):
+            job.done.wait()
+        if job.errors:
+            return jsonify({"error": job.errors[0]}), 500
         
+        with stage("serialize"):
+            response = jsonify({
+                "success": True,
+                "message": f"Successfully ingested {len(documents)} messages",
+                "count": len(documents),
+                **{outcome: count for outcome, count in job.counts.items() if outcome != "failed"}
+            })
+        return response
+        
+    except QueueFull as e:
+        return queue_full(e)
+    except QueueClosed as e:
+        return jsonify({"error": str(e)}), 503
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def queue_full(error):
+    """Return the HTTP 429 response for an ingest refused by a full queue."""
+    ingest_rejected.inc()
+    return jsonify({"error": str(error)}), 429, {"Retry-After": str(error.retry_after)}
+
+def iter_ndjson(stream):
+    """Yield (line_number, document or None) for each non-empty NDJSON line."""
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            doc = json.loads(line)
+        except ValueError:
+            doc = None
+        yield line_number, doc if is_valid_document(doc) else None
+
+@app.route('/ingest/stream', methods=['POST'])
+def ingest_stream():
+    """
+    Bulk-ingest newline-delimited JSON, one document per line.
+    
+    Each line has the same shape as an entry of /ingest's "documents" list.
+    The body may be gzip-compressed (Content-Encoding: gzip or
+    Content-Type: application/gzip). Lines are parsed as they arrive and
+    queued for the ingest worker in batches of INGEST_BATCH_SIZE, so memory
+    use does not depend on the size of the upload; while the queue is full,
+    reading the upload pauses. Invalid lines are counted and skipped.
+    
+    Returns:
+    {
+        "success": true,
+        "count": 10000,   # valid documents received
+        "inserted": 9000, "updated": 0, "skipped": 1000, "deduplicated": 0,
+        "invalid": 2,
+        "invalid_lines": [17, 2048],  # first few line numbers that failed to parse
+        "batches": 157,
+        "seconds": 41.2,
+        "docs_per_second": 242.7
+    }
+    """
+    try:
+        started = time.perf_counter()
+        tenant = request_tenant()
+        stream = request.stream
+        if (request.headers.get('Content-Encoding') == 'gzip'
+                or request.mimetype in ('application/gzip', 'application/x-gzip')):
+            stream = gzip.GzipFile(fileobj=stream, mode='rb')
+        
+        counts = {"inserted": 0, "updated": 0, "skipped": 0, "deduplicated": 0}
+        received = batches = invalid = 0
+        invalid_lines = []
+        batch = []
+        jobs = []
+        
+        def flush():
+            # Parsing goes on while the worker writes; a full queue blocks here
+            jobs.append(ingest_queue.submit(list(batch), tenant, block=True))
+            batch.clear()
+        
+        for line_number, doc in iter_ndjson(stream):
+            if doc is None:
+                invalid += 1
+                if len(invalid_lines) < 10:
+                    invalid_lines.append(line_number)
+                continue
+            received += 1
+            batch.append(doc)
+            if len(batch) >= ingest_queue.batch_size:
+                flush()
+                batches += 1
+        if batch:
+            flush()
+            batches += 1
+        
+        with stage("queue"):
+            for job in jobs:
+                job.done.wait()
+                if job.errors:
+                    raise RuntimeError(job.errors[0])
+                for outcome in counts:
+                    counts[outcome] += job.counts[outcome]
+        
+        seconds = time.perf_counter() - started
         return jsonify({
             "success": True,
-            "message": f"Successfully ingested {len(documents)} messages",
-            "count": len(documents)
+            "count": received,
+            **counts,
+            "invalid": invalid,
+            "invalid_lines": invalid_lines,
+            "batches": batches,
+            "seconds": round(seconds, 3),
+            "docs_per_second": round(received / seconds, 1) if seconds else 0.0
         })
         
+    except QueueClosed as e:
+        return jsonify({"error": str(e)}), 503
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/ingest/jobs/<job_id>', methods=['GET'])
+def ingest_job(job_id):
+    """
+    Report the progress of an asynchronous ingest job.
+    
+    Returns:
+    {
+        "success": true,
+        "job": {
+            "id": "job_id",
+            "status": "queued/running/done/failed",
+            "total": 10,
+            "processed": 4,
+            "inserted": 3, "updated": 0, "skipped": 1, "deduplicated": 0, "failed": 0,
+            "errors": [],
+            "created": 1700000000.0,
+            "finished": null
+        }
+    }
+    """
+    job = ingest_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job id"}), 404
+    return jsonify({
+        "success": True,
+        "job": job.to_dict()
+    })
+
 @app.route('/query', methods=['POST'])
 def query():
     """
@@ -88,7 +1788,33 @@ def query():
     Expected format:
     {
         "query": "user query text",
-        "n_results": 5  # optional, defaults to 3
+        "n_results": 5,  # optional, defaults to 3
+        "merge_chunks": false,  # optional, merge hits from the same long message
+        "mode": "vector",  # optional, "vector", "keyword" (BM25) or "hybrid"
+        "search_ef": 200,  # optional, HNSW candidate list size for this query; higher is slower but finds more
+        "exact": false,  # optional, brute-force search instead of HNSW, for offline evaluation
+        "rerank": true,  # optional, re-rank with the cross-encoder, on by default when CROSS_ENCODER is set
+        "rerank_candidates": 30,  # optional, hits re-ranked, defaults to CROSS_ENCODER_CANDIDATES
+        "rerank_budget_ms": 250,  # optional, skip re-ranking past this request time, defaults to CROSS_ENCODER_BUDGET_MS
+        "history": ["earlier turn", {"role": "assistant", "content": "..."}],  # optional, the conversation's
+                                                      # earlier turns, oldest first, mixed into the search vector
+        "history_turns": 3,  # optional, recent turns used, defaults to QUERY_HISTORY_TURNS
+        "history_decay": 0.5,  # optional, weight of the newest turn relative to the query, defaults to QUERY_HISTORY_DECAY
+        "boost_chat_id": "chat_id",  # optional, rank this chat's hits as if chat_boost closer
+        "chat_boost": 0.05,  # optional, defaults to CHAT_BOOST
+        "include": ["text", "metadata", "distance"],  # optional, fields to return, any of text, metadata,
+                                                      # distance and embedding; unrequested fields are not loaded
+        "embedding_format": "list",  # optional, "float32" sends embeddings as packed little-endian buffers
+        "tenant": "alice",  # optional, as for /ingest
+        "tenants": ["alice", "team"],  # optional, search several tenants and merge their top hits
+        
+        # Optional filters, all combined with $and and applied inside Chroma
+        "where": {...},           # Chroma metadata filter
+        "where_document": {...},  # Chroma document filter, e.g. {"$contains": "ESP32"}
+        "chatId": "chat_id",      # or a list of chat ids
+        "roles": ["assistant"],
+        "since": "ISO timestamp or epoch seconds",
+        "until": "ISO timestamp or epoch seconds"
     }
     
     Returns:
@@ -99,46 +1825,525 @@ def query():
                 "id": "document_id",
                 "text": "document text",
                 "metadata": {...},
-                "distance": 0.123  # cosine distance score
+                "distance": 0.123,  # cosine distance score, null for keyword-only hits
+                "score": 4.2,       # keyword and hybrid modes only, higher is better
+                "rerank_score": 7.9,  # when re-ranked, the cross-encoder score, higher is better
+                "embedding": [...]    # only when included; the mean of the chunks' embeddings for merged hits
             },
             ...
-        ]
+        ],
+        "reranked": true  # false when re-ranking was off or skipped for the latency budget
     }
+    
+    Hybrid mode fuses the vector and keyword rankings with reciprocal-rank
+    fusion; its score is the fused score. Hits are chunks for long messages (metadata carries parentId and
+    chunkIndex). With merge_chunks, chunks of the same message are stitched
+    into one result whose id is the message id and whose "chunks" field lists
+    the chunk ids that were merged.
+    
+    With history, the query is searched with a vector mixing its embedding
+    with those of the recent turns, so a follow-up such as "and on ESP32?"
+    finds what the conversation is about. boost_chat_id only reorders vector
+    rankings; reported distances stay true cosine distances.
+    
+    The response is JSON unless Accept asks for application/msgpack (with the
+    msgpack package installed), and is gzip-compressed when Accept-Encoding
+    allows it. Packed float32 embeddings are base64 text in JSON.
     """
     try:
-        data = request.json
+        with stage("parse"):
+            data = request.json
         
-        if not data or 'query' not in data:
+        if not data or not isinstance(data.get('query'), str):
             return jsonify({"error": "Invalid request format"}), 400
         
         query_text = data['query']
-        n_results = data.get('n_results', 3)  # Default to 3 if not specified
+        n_results = result_count(data, 'n_results', 3)
+        options = query_options(data)
+        packed = embedding_format(data) == "float32"
         
-        # Query the collection
-        results = collection.query(
-            query_texts=[query_text],
-            n_results=n_results,
-            include=["documents", "metadatas", "distances"]
-        )
+        query_results = search([query_text], n_results, options)[0]
         
-        # Format the results
-        formatted_results = []
-        if results["documents"][0]:  # Check if any results were found
-            for i, doc in enumerate(results["documents"][0]):
-                formatted_results.append({
-                    "id": results["ids"][0][i],
-                    "text": doc,
-                    "metadata": results["metadatas"][0][i],
-                    "distance": results["distances"][0][i]
-                })
+        with stage("serialize"):
+            response = encoded_response({
+                "success": True,
+                "results": pack_embeddings(query_results) if packed else query_results,
+                "reranked": is_reranked(query_results, options)
+            })
+        return response
         
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/query/batch', methods=['POST'])
+def query_batch():
+    """
+    Query ChromaDB with several queries in a single embedding and search pass.
+    
+    Expected format:
+    {
+        "queries": ["first query", "second query", ...],
+        "n_results": 5,  # optional, defaults to 3, applies to every query
+        "merge_chunks": false,  # optional, as for /query
+        ...                     # optional filters, include and embedding_format, as for /query
+    }
+    
+    Returns:
+    {
+        "success": true,
+        "results": [
+            [ {...}, ... ],  # results for "first query", same shape as /query
+            [ {...}, ... ],  # results for "second query"
+            ...
+        ],
+        "reranked": [true, true, ...]  # per query, as for /query
+    }
+    
+    The response encoding is negotiated as for /query.
+    """
+    try:
+        with stage("parse"):
+            data = request.json
+        
+        if not data or not isinstance(data.get('queries'), list):
+            return jsonify({"error": "Invalid request format"}), 400
+        if not all(isinstance(text, str) for text in data['queries']):
+            return jsonify({"error": "Each query must be a string"}), 400
+        
+        query_texts = data['queries']
+        n_results = result_count(data, 'n_results', 3)
+        options = query_options(data)
+        packed = embedding_format(data) == "float32"
+        
+        batch_results = search(query_texts, n_results, options)
+        
+        with stage("serialize"):
+            response = encoded_response({
+                "success": True,
+                "results": [pack_embeddings(results) for results in batch_results] if packed else batch_results,
+                "reranked": [is_reranked(results, options) for results in batch_results]
+            })
+        return response
+        
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def encoded_response(body):
+    """Return body as a response in the encoding negotiated from the request headers."""
+    mimetype, compress = negotiate(request.accept_mimetypes, request.accept_encodings)
+    data, headers = encode(body, mimetype, compress)
+    return app.response_class(data, headers=headers)
+
+def is_reranked(hits, options):
+    """Return whether a result list was re-ranked by the cross-encoder."""
+    return bool(options["rerank"]) and all("rerank_score" in hit for hit in hits)
+
+def hit_vectors(hits, partitions):
+    """Return the stored embedding of each hit, averaging the chunks of merged hits."""
+    record_ids = {hit["id"]: hit.get("chunks") or [hit["id"]] for hit in hits}
+    wanted = sorted({record_id for ids in record_ids.values() for record_id in ids})
+    stored = {}
+    for partition in partitions:
+        records = partition.collection.get(ids=wanted, include=["embeddings"])
+        stored.update(zip(records["ids"], records["embeddings"]))
+    return [np.mean([stored[record_id] for record_id in record_ids[hit["id"]]], axis=0) for hit in hits]
+
+@app.route('/context', methods=['POST'])
+def context():
+    """
+    Build a prompt context for a query that fits in a token budget.
+    
+    Expected format:
+    {
+        "query": "text to search for",
+        "max_tokens": 1000,  # optional, token budget for the context
+        "n_candidates": 20,  # optional, hits retrieved before packing
+        "mmr_lambda": 0.7,  # optional, 1 ranks by relevance only, lower favours diversity
+        "duplicate_threshold": 0.95,  # optional, cosine similarity at which a hit is dropped
+        "merge_chunks": true,  # optional, as for /query but on by default
+        ...                    # optional mode, history, boost, re-ranking and filters, as for /query
+    }
+    
+    Returns:
+    {
+        "success": true,
+        "context": "[1] first snippet\n\n[2] second snippet",
+        "citations": [
+            {
+                "ref": 1,
+                "id": "message_id",
+                "chatId": "...", "title": "...", "role": "...", "messageIndex": 0,
+                "distance": 0.123,
+                "tokens": 42,
+                "truncated": false
+            },
+            ...
+        ],
+        "tokens": 97,
+        "candidates": 20,
+        "duplicates": 3
+    }
+    """
+    try:
+        with stage("parse"):
+            data = request.json
+        
+        if not data or not isinstance(data.get('query'), str):
+            return jsonify({"error": "Invalid request format"}), 400
+        
+        max_tokens = int(data.get('max_tokens', 1000))
+        n_candidates = result_count(data, 'n_candidates', 20)
+        options = query_options({"merge_chunks": True, **data, "include": DEFAULT_RESULT_FIELDS})
+        
+        hits = search([data['query']], n_candidates, options)[0]
+        with stage("embed"):
+            query_vector = embed_queries([data['query']], options["history"])[0]
+        relevance = None
+        if hits and is_reranked(hits, options):
+            # Cross-encoder scores are logits; scaled to [0, 1] they weigh like similarities
+            scores = np.array([hit["rerank_score"] for hit in hits], dtype=np.float32)
+            relevance = (scores - scores.min()) / max(float(scores.max() - scores.min()), 1e-12)
+        bonus = None
+        if options["boost"]:
+            bonus = [options["boost"]["amount"] * (hit["metadata"].get("chatId") == options["boost"]["chat_id"])
+                     for hit in hits]
+        with stage("pack"):
+            order, duplicates = mmr_order(
+                query_vector,
+                hit_vectors(hits, [router.named(name) for name in options["partitions"]]) if hits else [],
+                float(data.get('mmr_lambda', 0.7)),
+                float(data.get('duplicate_threshold', 0.95)),
+                relevance,
+                bonus
+            )
+            context_text, citations, tokens = pack_context([hits[i] for i in order], max_tokens)
+        
+        with stage("serialize"):
+            response = jsonify({
+                "success": True,
+                "context": context_text,
+                "citations": citations,
+                "tokens": tokens,
+                "candidates": len(hits),
+                "duplicates": len(duplicates)
+            })
+        return response
+        
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/chats/<chat_id>', methods=['DELETE'])
+def delete_chat(chat_id):
+    """
+    Delete every message of a chat, for the request's tenant.
+    
+    Returns:
+    {
+        "success": true,
+        "messages": 12,  # messages deleted
+        "records": 15    # records deleted, counting each chunk of long messages
+    }
+    """
+    try:
+        partitions = router.route_query([request_tenant()], shard_values({"chatId": chat_id}))
+        return jsonify({"success": True, **delete_where(partitions, {"chatId": chat_id})})
+        
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/delete', methods=['POST'])
+def delete_by_filter():
+    """
+    Delete every message matching a filter, for the request's tenant.
+    
+    Accepts the same filters as /query (where, where_document, chatId, roles,
+    since, until); at least one is required. A message is deleted whole when
+    any of its chunks matches. With "dry_run": true nothing is deleted and the
+    counts say what would have been.
+    
+    Returns:
+    {
+        "success": true,
+        "dry_run": false,
+        "messages": 120,
+        "records": 131
+    }
+    """
+    try:
+        data = request.json
+        
+        if not data:
+            return jsonify({"error": "Invalid request format"}), 400
+        
+        where = build_where(data)
+        where_document = data.get('where_document') or None
+        if where is None and where_document is None:
+            return jsonify({"error": "A filter is required"}), 400
+        
+        dry_run = bool(data.get('dry_run', False))
+        partitions = router.route_query([request_tenant(data)], shard_values(data))
+        return jsonify({
+            "success": True,
+            "dry_run": dry_run,
+            **delete_where(partitions, where, where_document, dry_run)
+        })
+        
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/retention', methods=['POST'])
+def run_retention():
+    """
+    Apply the retention policy now, across all tenants.
+    
+    The body may override the configured limits:
+    {
+        "max_age_days": 90,   # optional, defaults to RETENTION_MAX_AGE_DAYS
+        "max_per_chat": 500,  # optional, defaults to RETENTION_MAX_PER_CHAT
+        "dry_run": false
+    }
+    
+    Returns:
+    {
+        "success": true,
+        "expired": 40,     # messages older than max_age_days
+        "over_limit": 12,  # messages beyond the newest max_per_chat of their chat
+        "records": 55,
+        "undated": 3       # records without a valid timestamp, which never expire
+    }
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        return jsonify({
+            "success": True,
+            **apply_retention(
+                float(data.get('max_age_days', RETENTION_MAX_AGE_DAYS)),
+                int(data.get('max_per_chat', RETENTION_MAX_PER_CHAT)),
+                bool(data.get('dry_run', False))
+            )
+        })
+        
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness probe: the process is up and serving requests."""
+    return jsonify({"status": "ok"})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """
+    Readiness probe: 200 once the embedding model is loaded and the index is
+    open, 503 while warm-up is still running or if it failed.
+    """
+    body = {
+        "ready": ready.is_set(),
+        "embedding_model": embedding_function.model_id,
+        "phase": startup_state["phase"],
+        "error": startup_state["error"],
+        "timings": startup_timings
+    }
+    return jsonify(body), 200 if ready.is_set() else 503
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Report query and embedding cache hit/miss counters for sizing the caches."""
+    return jsonify({
+        "success": True,
+        "query_cache": query_cache.stats(),
+        "embedding_cache": embedding_cache.stats()
+    })
+
+@app.route('/index/stats', methods=['GET'])
+def index_stats_endpoint():
+    """
+    Report the vector index of each partition. With ?recall=1, also measure
+    recall@k against exact search on ?sample= queries (default 20, k=10).
+    
+    Returns:
+    {
+        "success": true,
+        "vector_store": "int8",
+        "dedup_threshold": 0.97,
+        "partitions": {
+            "chat_history": {
+                "records": 120000,
+                "duplicates_linked": 3500,     # messages stored as links to a near-duplicate
+                "memory_bytes": 46680000,       # int8 codes and scales in memory
+                "float32_bytes": 184320000,     # the same vectors as float32
+                "search_memory_saved_bytes": 137640000,  # on the search path only; Chroma's HNSW index is kept
+                "recall": {"k": 10, "queries": 20, "int8": 0.965, "int8_reranked": 1.0},
+                ...
+            }
+        }
+    }
+    """
+    try:
+        sample = int(request.args.get('sample', 20)) if request.args.get('recall') == '1' else 0
+        k = int(request.args.get('k', 10))
+        if sample < 0 or k < 1:
+            raise ValueError("sample must be non-negative and k positive")
         return jsonify({
             "success": True,
-            "results": formatted_results
+            "vector_store": VECTOR_STORE,
+            "dedup_threshold": DEDUP_THRESHOLD,
+            "partitions": index_stats(sample, k)
         })
         
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/snapshot', methods=['GET'])
+def snapshot_export():
+    """
+    Download a snapshot of every partition: ids, documents, metadata and
+    embeddings, plus the duplicate links, in the format of snapshot.py.
+    
+    The snapshot is written to a temporary file while writes wait, then
+    streamed, so a slow download does not hold up ingestion.
+    """
+    try:
+        f = tempfile.TemporaryFile(dir=DB_PATH)
+        try:
+            export_snapshot(f)
+            f.seek(0)
+        except Exception:
+            f.close()
+            raise
+        return send_file(f, mimetype="application/octet-stream", as_attachment=True,
+                         download_name="chroma-snapshot.bin")
+        
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/snapshot', methods=['POST'])
+def snapshot_import():
+    """
+    Restore a snapshot downloaded from GET /snapshot, sent as the request body.
+    
+    Records are upserted with their stored embeddings, so a restore is bound
+    by disk speed rather than by the embedding model. The snapshot must come
+    from a server with the same embedding model.
+    
+    Returns:
+    {
+        "success": true,
+        "records": 1200,  # records upserted
+        "links": 15       # duplicate links restored
+    }
+    """
+    try:
+        if not ready.is_set():
+            return jsonify({"error": "Server is still warming up"}), 503
+        return jsonify({"success": True, **import_snapshot(request.stream)})
+        
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics: request counts and latencies, stage timings, ingest and cache counters."""
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+def serve(host, port, threads):
+    """
+    Serve the app with waitress using a pool of request threads.
+    
+    A single process owns the PersistentClient and performs every write, while
+    its threads serve queries concurrently. Chroma keeps the HNSW index in
+    process memory, so several processes sharing ./db would not see each
+    other's writes. SIGINT and SIGTERM stop accepting connections, let
+    in-flight requests finish and write the queued ingests before exiting.
+    """
+    from waitress import create_server
+    
+    server = create_server(app, host=host, port=port, threads=threads)
+    
+    # waitress shuts its worker threads down cleanly on SystemExit
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    print(f"Serving on http://{host}:{port} with {threads} threads")
+    try:
+        server.run()
+    finally:
+        server.close()
+        drain_ingest_queue()
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8000, debug=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='ChromaDB server for BetterChatGPT')
+    parser.add_argument('--production', action='store_true',
+                        help='Serve with waitress instead of the Flask development server')
+    parser.add_argument('--host', default='0.0.0.0', help='Interface to bind (default: 0.0.0.0)')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on (default: 8000)')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get("SERVER_THREADS", 8)),
+                        help='Request threads in production mode (default: 8)')
+    parser.add_argument('--warmup', default='background', choices=['background', 'blocking'],
+                        help='Warm up while already serving (background, default) or before listening (blocking)')
+    parser.add_argument('--compact', action='store_true',
+                        help='Rebuild the collections and reclaim disk space, then exit (stop the server first)')
+    parser.add_argument('--reindex', action='store_true',
+                        help='Rebuild collections built with other HNSW_* parameters, then exit (stop the server first)')
+    parser.add_argument('--export', metavar='PATH',
+                        help='Write a snapshot of the stored records and embeddings to PATH, then exit')
+    parser.add_argument('--import', dest='import_path', metavar='PATH',
+                        help='Load a snapshot written by --export without re-embedding, then exit (stop the server first)')
+    
+    args = parser.parse_args()
+    
+    if args.export:
+        with open(args.export, 'wb') as f:
+            counts = export_snapshot(f)
+        print(f"Exported {counts['records']} records and {counts['links']} duplicate links to {args.export}")
+        sys.exit(0)
+    
+    if args.import_path:
+        with open(args.import_path, 'rb') as f:
+            counts = import_snapshot(f)
+        print(f"Imported {counts['records']} records and {counts['links']} duplicate links")
+        sys.exit(0)
+    
+    if args.reindex:
+        rebuilt = reindex()
+        print(f"Rebuilt {', '.join(rebuilt)}" if rebuilt else "All collections already use the configured HNSW parameters")
+        sys.exit(0)
+    
+    if args.compact:
+        sizes = compact()
+        print(f"Compacted {sizes['partitions']} partitions: "
+              f"{sizes['bytes_before'] / 1e6:.1f} MB -> {sizes['bytes_after'] / 1e6:.1f} MB "
+              f"({sizes['bytes_reclaimed'] / 1e6:.1f} MB reclaimed)")
+        sys.exit(0)
+    
+    # With the dev reloader only the child process (WERKZEUG_RUN_MAIN) serves
+    if args.production or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        if args.warmup == 'blocking':
+            warm_up()
+        else:
+            threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    
+    if args.production:
+        serve(args.host, args.port, args.threads)
+    else:
+        try:
+            app.run(host=args.host, port=args.port, debug=True)
+        finally:
+            drain_ingest_queue()
\ No newline at end of file
@@ -0,0 +1,170 @@
+"""
+Split long messages into overlapping chunks and stitch retrieved chunks back
+together.
+
+Chunks are described by character spans into the original message, so the
+stored chunk text keeps the message's own formatting (code blocks, newlines).
+Chunks are cut between whitespace-separated words. Their size is counted in
+the embedding model's tokens when a count_tokens function is given (the
+embedding backends provide one), and in words otherwise.
+"""
+
+import re
+
+# Metadata keys added to each chunk of a split message
+CHUNK_FIELDS = ("chunkIndex", "chunkCount", "chunkStart", "chunkEnd")
+
+_TOKEN = re.compile(r"\S+")
+_SENTENCE = re.compile(r"\S[^.!?\n]*(?:[.!?]+|\n+|$)")
+
+def _word_sizes(words, count_tokens):
+    # A word the tokenizer splits into several pieces counts as that many tokens
+    if not words:
+        return []
+    return list(count_tokens(words)) if count_tokens else [1] * len(words)
+
+def _token_spans(text, size, overlap, count_tokens=None):
+    words = [match.span() for match in _TOKEN.finditer(text)]
+    sizes = _word_sizes([text[start:end] for start, end in words], count_tokens)
+    if sum(sizes) <= size:
+        return [(0, len(text))]
+    spans = []
+    first = 0
+    while True:
+        # Take words up to the budget, but always at least one
+        last, used = first, sizes[first]
+        while last + 1 < len(words) and used + sizes[last + 1] <= size:
+            last += 1
+            used += sizes[last]
+        spans.append((words[first][0], words[last][1]))
+        if last == len(words) - 1:
+            break
+
+        # Start the next chunk with trailing words worth up to overlap tokens
+        next_first, carried = last + 1, 0
+        while next_first - 1 > first and carried + sizes[next_first - 1] <= overlap:
+            next_first -= 1
+            carried += sizes[next_first]
+        first = next_first
+    return spans
+
+def _sentence_spans(text, size, overlap, count_tokens=None):
+    sentences = []
+    for match in _SENTENCE.finditer(text):
+        tokens = sum(_word_sizes(_TOKEN.findall(match.group()), count_tokens))
+        if tokens <= size:
+            sentences.append((match.start(), match.end(), tokens))
+            continue
+        # A sentence longer than a whole chunk is cut at word boundaries
+        for start, end in _token_spans(match.group(), size, 0, count_tokens):
+            piece = match.group()[start:end]
+            sentences.append((match.start() + start, match.start() + end,
+                              sum(_word_sizes(_TOKEN.findall(piece), count_tokens))))
+    if sum(tokens for _, _, tokens in sentences) <= size:
+        return [(0, len(text))]
+
+    spans = []
+    first = 0
+    while first < len(sentences):
+        # Take whole sentences up to the budget, but always at least one
+        last, words = first, sentences[first][2]
+        while last + 1 < len(sentences) and words + sentences[last + 1][2] <= size:
+            last += 1
+            words += sentences[last][2]
+        spans.append((sentences[first][0], sentences[last][1]))
+        if last == len(sentences) - 1:
+            break
+
+        # Start the next chunk with trailing sentences worth up to overlap
+        # tokens, leaving room for at least one new sentence
+        next_first, carried = last + 1, 0
+        room = min(overlap, size - sentences[last + 1][2])
+        while next_first - 1 > first and carried + sentences[next_first - 1][2] <= room:
+            next_first -= 1
+            carried += sentences[next_first][2]
+        first = next_first
+    return spans
+
+def chunk_spans(text, size=200, overlap=40, mode="tokens", count_tokens=None):
+    """
+    Return (start, end) character spans covering text in chunks of at most
+    size tokens, each sharing up to overlap tokens with the previous one.
+
+    mode "tokens" cuts at word boundaries, "sentences" keeps sentences whole.
+    count_tokens, given a list of words, returns the number of tokens in each;
+    without it every word counts as one token. Only a single word longer than
+    size makes a chunk exceed it. A size of 0 disables chunking.
+    """
+    if size <= 0:
+        return [(0, len(text))]
+    if mode == "sentences":
+        return _sentence_spans(text, size, overlap, count_tokens)
+    return _token_spans(text, size, overlap, count_tokens)
+
+def split_message(message_id, text, size=200, overlap=40, mode="tokens", count_tokens=None):
+    """
+    Yield (id, text, chunk metadata) for each chunk of a message.
+
+    A message that fits in one chunk keeps its own id and gets no chunk
+    metadata; otherwise chunks are named "<message_id>#<index>".
+    """
+    spans = chunk_spans(text, size, overlap, mode, count_tokens)
+    if len(spans) == 1:
+        yield message_id, text, {}
+        return
+    for index, (start, end) in enumerate(spans):
+        yield f"{message_id}#{index}", text[start:end], {
+            "chunkIndex": index,
+            "chunkCount": len(spans),
+            "chunkStart": start,
+            "chunkEnd": end
+        }
+
+def merge_chunks(hits):
+    """
+    Merge query hits that are chunks of the same message into one hit.
+
+    hits are formatted results ordered best first. Each merged hit takes the
+    parent message id, the best distance (and score) of its chunks and the
+    text of the chunks joined in message order, with overlaps removed and
+    " … " marking gaps between chunks that were not retrieved.
+    """
+    groups = {}
+    for hit in hits:
+        parent = (hit["metadata"] or {}).get("parentId", hit["id"])
+        groups.setdefault(parent, []).append(hit)
+
+    merged = []
+    for parent, group in groups.items():
+        if "chunkIndex" not in (group[0]["metadata"] or {}):
+            merged.extend(group)
+            continue
+
+        group.sort(key=lambda hit: hit["metadata"]["chunkStart"])
+        text, covered_to, previous_index = "", None, None
+        for hit in group:
+            start, end = hit["metadata"]["chunkStart"], hit["metadata"]["chunkEnd"]
+            index = hit["metadata"]["chunkIndex"]
+            if covered_to is None:
+                text = hit["text"]
+            elif end <= covered_to:
+                continue
+            elif start < covered_to:
+                text += hit["text"][covered_to - start:]
+            else:
+                text += (" " if index == previous_index + 1 else " … ") + hit["text"]
+            covered_to, previous_index = end, index
+
+        metadata = {key: value for key, value in group[0]["metadata"].items() if key not in CHUNK_FIELDS}
+        distances = [hit["distance"] for hit in group if hit["distance"] is not None]
+        merged_hit = {
+            "id": parent,
+            "text": text,
+            "metadata": metadata,
+            "distance": min(distances) if distances else None,
+            "chunks": [hit["id"] for hit in group]
+        }
+        if "score" in group[0]:
+            merged_hit["score"] = max(hit["score"] for hit in group)
+        merged.append(merged_hit)
+    return merged
@@ -0,0 +1,130 @@
+"""
+Assemble retrieved messages into a prompt context that fits a token budget.
+
+Candidates are reordered with maximal marginal relevance (MMR), so snippets
+that repeat an already chosen one are demoted or dropped, and then packed
+best first until the budget is spent. Tokens are counted with tiktoken's
+cl100k_base encoding, the one BetterChatGPT uses for its own limits, when
+the optional tiktoken package is installed; otherwise they are estimated
+from words and punctuation.
+"""
+
+import re
+
+import numpy as np
+
+_ESTIMATE_TOKEN = re.compile(r"\w+|[^\w\s]")
+
+# Smallest remainder of the budget worth filling with a truncated snippet
+MIN_SNIPPET_TOKENS = 32
+
+_encoding = None
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            # Not installed, or the encoding could not be downloaded
+            _encoding = False
+    return _encoding
+
+def count_tokens(text):
+    """Return the number of tokens in text."""
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(_ESTIMATE_TOKEN.findall(text))
+
+def truncate_tokens(text, max_tokens):
+    """Return the longest prefix of text that is at most max_tokens tokens."""
+    encoding = _get_encoding()
+    if encoding:
+        tokens = encoding.encode(text, disallowed_special=())
+        return encoding.decode(tokens[:max_tokens])
+    matches = list(_ESTIMATE_TOKEN.finditer(text))
+    if len(matches) <= max_tokens:
+        return text
+    return text[:matches[max_tokens - 1].end()] if max_tokens > 0 else ""
+
+def mmr_order(query_vector, vectors, lambda_=0.7, duplicate_threshold=0.95, relevance=None, bonus=None):
+    """
+    Return (order, duplicates): candidate indices in MMR order, and the
+    indices dropped as near-duplicates of an earlier pick.
+
+    Each step picks the candidate maximising
+    lambda_ * sim(query, c) - (1 - lambda_) * max sim(c, picked), using cosine
+    similarity. relevance, when given, replaces sim(query, c), for example
+    with re-ranker scores scaled to [0, 1]; bonus, when given, is added to
+    each candidate's relevance. A candidate whose similarity to a picked one
+    reaches duplicate_threshold is dropped.
+    """
+    if not len(vectors):
+        return [], []
+    matrix = np.asarray(vectors, dtype=np.float32)
+    matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_vector, dtype=np.float32)
+    query = query / max(np.linalg.norm(query), 1e-12)
+
+    relevance = matrix @ query if relevance is None else np.asarray(relevance, dtype=np.float32)
+    if bonus is not None:
+        relevance = relevance + np.asarray(bonus, dtype=np.float32)
+    pairwise = matrix @ matrix.T
+    redundancy = np.zeros(len(matrix), dtype=np.float32)
+    remaining = list(range(len(matrix)))
+    order, duplicates = [], []
+    while remaining:
+        scores = lambda_ * relevance[remaining] - (1 - lambda_) * redundancy[remaining]
+        best = remaining.pop(int(np.argmax(scores)))
+        if order and redundancy[best] >= duplicate_threshold:
+            duplicates.append(best)
+            continue
+        order.append(best)
+        redundancy = np.maximum(redundancy, pairwise[best])
+    return order, duplicates
+
+def pack_context(hits, max_tokens, separator="\n\n"):
+    """
+    Pack hits, in order, into a context string of at most max_tokens tokens.
+
+    Each snippet is prefixed with a [n] reference. Snippets that do not fit
+    are skipped in favour of later, shorter ones, except that a long snippet
+    is truncated when at least MIN_SNIPPET_TOKENS of the budget remain.
+    Returns (context, citations, tokens used).
+    """
+    separator_tokens = count_tokens(separator)
+    parts, citations, used = [], [], 0
+    for hit in hits:
+        reference = f"[{len(citations) + 1}] "
+        cost = (separator_tokens if parts else 0) + count_tokens(reference)
+        available = max_tokens - used - cost
+        if available <= 0:
+            break
+
+        text = hit["text"]
+        tokens = count_tokens(text)
+        truncated = False
+        if tokens > available:
+            if available < MIN_SNIPPET_TOKENS:
+                continue
+            text = truncate_tokens(text, available - count_tokens(" …")).rstrip() + " …"
+            tokens = count_tokens(text)
+            truncated = True
+
+        parts.append(reference + text)
+        used += cost + tokens
+        metadata = hit["metadata"] or {}
+        citations.append({
+            "ref": len(citations) + 1,
+            "id": hit["id"],
+            "chatId": metadata.get("chatId"),
+            "title": metadata.get("title"),
+            "role": metadata.get("role"),
+            "messageIndex": metadata.get("messageIndex"),
+            "distance": hit["distance"],
+            "tokens": tokens,
+            "truncated": truncated
+        })
+    return separator.join(parts), citations, used
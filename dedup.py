@@ -0,0 +1,157 @@
+"""
+Links from near-duplicate messages to the record that stands in for them.
+
+With deduplication on, a message whose embedding is within the similarity
+threshold of a stored record (its canonical record) is not added to the
+collection. It is linked to that record here instead, keeping its own text
+and metadata, so deleting its chat, filtering by its metadata and
+re-ingesting it still work as if it were stored.
+
+Filters use Chroma's where and where_document syntax, evaluated in Python
+because linked messages are not in the collection.
+"""
+
+import json
+import re
+import sqlite3
+import threading
+
+_COMPARISONS = {
+    "$eq": lambda value, operand: value == operand,
+    "$ne": lambda value, operand: value != operand,
+    "$gt": lambda value, operand: value is not None and value > operand,
+    "$gte": lambda value, operand: value is not None and value >= operand,
+    "$lt": lambda value, operand: value is not None and value < operand,
+    "$lte": lambda value, operand: value is not None and value <= operand,
+    "$in": lambda value, operand: value in operand,
+    "$nin": lambda value, operand: value not in operand
+}
+
+def matches_where(metadata, where):
+    """Return whether metadata satisfies a Chroma where filter."""
+    if not where:
+        return True
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches_where(metadata, clause) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_where(metadata, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict):
+            try:
+                if not all(_COMPARISONS[op](metadata.get(key), operand) for op, operand in condition.items()):
+                    return False
+            except TypeError:
+                # Ordering a string against a number matches nothing, as in Chroma
+                return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+def matches_document(text, where_document):
+    """Return whether text satisfies a Chroma where_document filter."""
+    if not where_document:
+        return True
+    for key, operand in where_document.items():
+        if key == "$and":
+            matched = all(matches_document(text, clause) for clause in operand)
+        elif key == "$or":
+            matched = any(matches_document(text, clause) for clause in operand)
+        elif key == "$contains":
+            matched = operand in text
+        elif key == "$not_contains":
+            matched = operand not in text
+        elif key == "$regex":
+            matched = re.search(operand, text) is not None
+        elif key == "$not_regex":
+            matched = re.search(operand, text) is None
+        else:
+            raise ValueError(f"Unsupported where_document operator {key}")
+        if not matched:
+            return False
+    return True
+
+class DuplicateLinks:
+    """Linked messages of one partition, addressed by message id."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS links "
+                "(id TEXT PRIMARY KEY, canonical TEXT NOT NULL, text TEXT NOT NULL, metadata TEXT NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS links_canonical ON links (canonical)")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM links").fetchone()[0]
+
+    def _select(self, column, values):
+        rows = []
+        values = list(values)
+        # SQLite limits the number of bound parameters per statement
+        for start in range(0, len(values), 500):
+            chunk = values[start:start + 500]
+            rows.extend(self._conn.execute(
+                f"SELECT id, canonical, text, metadata FROM links WHERE {column} IN ({','.join('?' * len(chunk))})",
+                chunk
+            ).fetchall())
+        return {
+            message_id: {"canonical": canonical, "text": text, "metadata": json.loads(metadata)}
+            for message_id, canonical, text, metadata in rows
+        }
+
+    def add(self, links):
+        """Store (message id, canonical record id, text, metadata) links, replacing existing ones."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO links (id, canonical, text, metadata) VALUES (?, ?, ?, ?)",
+                [(message_id, canonical, text, json.dumps(metadata)) for message_id, canonical, text, metadata in links]
+            )
+
+    def get(self, message_ids):
+        """Return {message id: {"canonical", "text", "metadata"}} for the linked ones among message_ids."""
+        with self._lock:
+            return self._select("id", message_ids)
+
+    def linked_to(self, record_ids):
+        """Return the links, as get() does, whose canonical record is one of record_ids."""
+        with self._lock:
+            return self._select("canonical", record_ids)
+
+    def delete(self, message_ids):
+        """Remove the links of message_ids."""
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM links WHERE id = ?", [(message_id,) for message_id in message_ids])
+
+    def repoint(self, message_ids, canonical):
+        """Link message_ids to another canonical record."""
+        with self._lock, self._conn:
+            self._conn.executemany("UPDATE links SET canonical = ? WHERE id = ?",
+                                   [(canonical, message_id) for message_id in message_ids])
+
+    def rows(self):
+        """Return (message id, canonical record id, text, metadata) for every link, as add() takes them."""
+        with self._lock:
+            rows = self._conn.execute("SELECT id, canonical, text, metadata FROM links ORDER BY id").fetchall()
+        return [(message_id, canonical, text, json.loads(metadata)) for message_id, canonical, text, metadata in rows]
+
+    def items(self):
+        """Return (message id, metadata) for every link."""
+        with self._lock:
+            rows = self._conn.execute("SELECT id, metadata FROM links").fetchall()
+        return [(message_id, json.loads(metadata)) for message_id, metadata in rows]
+
+    def matching(self, where=None, where_document=None):
+        """Return the ids of the linked messages that pass the filters."""
+        with self._lock:
+            rows = self._conn.execute("SELECT id, text, metadata FROM links").fetchall()
+        return {
+            message_id for message_id, text, metadata in rows
+            if matches_where(json.loads(metadata), where) and matches_document(text, where_document)
+        }
@@ -0,0 +1,173 @@
+"""
+Content-addressed cache in front of an embedding function.
+
+Texts are keyed by a hash of their content, so a text that has been embedded
+once (a repeated system prompt, a boilerplate reply, a repeated query) is
+never sent to the model again. Lookups go through an in-memory LRU tier and
+then, if a directory is given, an on-disk tier that survives restarts.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+def text_key(text, namespace="default"):
+    """Return the cache key for a text embedded by the model named namespace."""
+    return hashlib.sha256(f"{namespace}\0{text}".encode("utf-8")).hexdigest()
+
+class DiskEmbeddingStore:
+    """
+    Append-only store of float32 vectors backed by a memory-mapped file.
+
+    vectors.f32 holds one row per vector and index.txt holds the key of each
+    row, one per line, so row numbers never need to be written separately.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.dim = None
+        self._rows = {}
+        self._count = 0
+        self._mmap = None
+        self._lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+        self._vectors_path = os.path.join(path, "vectors.f32")
+        self._index_path = os.path.join(path, "index.txt")
+        self._meta_path = os.path.join(path, "meta.json")
+
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                self.dim = json.load(f)["dim"]
+            self._load()
+
+    def _load(self):
+        """Read the index, ignoring any rows left incomplete by a crash."""
+        row_bytes = self.dim * 4
+        stored_rows = os.path.getsize(self._vectors_path) // row_bytes if os.path.exists(self._vectors_path) else 0
+        keys = []
+        if os.path.exists(self._index_path):
+            with open(self._index_path) as f:
+                keys = [line.strip() for line in f]
+        self._count = min(stored_rows, len(keys))
+        self._rows = {key: row for row, key in enumerate(keys[:self._count])}
+
+        # Drop any partial tail so the next append lines up with the index
+        with open(self._vectors_path, "ab") as f:
+            f.truncate(self._count * row_bytes)
+        with open(self._index_path, "w") as f:
+            f.writelines(f"{key}\n" for key in keys[:self._count])
+
+    def __len__(self):
+        return self._count
+
+    def get(self, key):
+        """Return the stored vector for key, or None."""
+        with self._lock:
+            row = self._rows.get(key)
+            if row is None:
+                return None
+            if self._mmap is None or row >= self._mmap.shape[0]:
+                self._mmap = np.memmap(self._vectors_path, dtype=np.float32, mode="r",
+                                       shape=(self._count, self.dim))
+            return np.array(self._mmap[row])
+
+    def put_many(self, keys, vectors):
+        """Append vectors for keys that are not stored yet."""
+        with self._lock:
+            if self.dim is None:
+                self.dim = len(vectors[0])
+                with open(self._meta_path, "w") as f:
+                    json.dump({"dim": self.dim}, f)
+
+            new = [(key, vector) for key, vector in zip(keys, vectors) if key not in self._rows]
+            if not new:
+                return
+            block = np.asarray([vector for _, vector in new], dtype=np.float32)
+            with open(self._vectors_path, "ab") as f:
+                f.write(block.tobytes())
+            with open(self._index_path, "a") as f:
+                f.writelines(f"{key}\n" for key, _ in new)
+            for key, _ in new:
+                self._rows[key] = self._count
+                self._count += 1
+
+class EmbeddingCache:
+    """
+    Callable that returns embeddings for a list of texts, embedding only the
+    texts that are in neither the memory nor the disk tier.
+    """
+
+    def __init__(self, embedding_function, max_size=10000, path=None, namespace="default"):
+        self.embedding_function = embedding_function
+        self.max_size = max_size
+        self.namespace = namespace
+        self.disk = DiskEmbeddingStore(path) if path else None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, key):
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return vector
+        if self.disk is not None:
+            vector = self.disk.get(key)
+            if vector is not None:
+                with self._lock:
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+                return vector
+        return None
+
+    def __call__(self, texts):
+        keys = [text_key(text, self.namespace) for text in texts]
+        vectors = [self._lookup(key) for key in keys]
+
+        # Embed each distinct missing text once, in a single batch
+        missing = {}
+        for key, text, vector in zip(keys, texts, vectors):
+            if vector is None and key not in missing:
+                missing[key] = text
+        if missing:
+            embedded = self.embedding_function(list(missing.values()))
+            embedded = [np.asarray(vector, dtype=np.float32) for vector in embedded]
+            fresh = dict(zip(missing, embedded))
+            with self._lock:
+                self.misses += len(missing)
+                for key, vector in fresh.items():
+                    self._remember(key, vector)
+            if self.disk is not None:
+                self.disk.put_many(list(fresh), embedded)
+            vectors = [fresh[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+
+        return vectors
+
+    def stats(self):
+        """Return hit/miss counters for both tiers."""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_size": len(self._memory),
+                "max_size": self.max_size,
+                "disk_size": len(self.disk) if self.disk is not None else None,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+            }
@@ -0,0 +1,131 @@
+"""
+Embedding backends for the ChromaDB server.
+
+Every backend is a callable that takes a list of texts and returns a list of
+float32 vectors, has a model_id naming the model that produced them and a
+count_tokens method that counts texts in the model's own tokens, which long
+messages are chunked by:
+
+- "onnx": Chroma's default all-MiniLM-L6-v2 ONNX model
+- "onnx-int8": the same model with dynamically quantized int8 weights
+- "sentence-transformers": any sentence-transformers model (optional package)
+
+All of them run batched inference with a configurable batch size and number
+of intra-op CPU threads.
+"""
+
+import os
+from functools import cached_property
+
+import numpy as np
+from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
+
+BACKENDS = ("onnx", "onnx-int8", "sentence-transformers")
+
+# model_id of the model Chroma uses when no embedding function is given
+DEFAULT_MODEL_ID = f"onnx/{ONNXMiniLM_L6_V2.MODEL_NAME}"
+
+class ONNXEmbeddingFunction(ONNXMiniLM_L6_V2):
+    """
+    all-MiniLM-L6-v2 through onnxruntime, optionally quantized to int8.
+
+    The quantized model is written next to Chroma's downloaded model the
+    first time it is needed, which requires the onnx package.
+    """
+
+    def __init__(self, batch_size=32, threads=0, quantized=False):
+        super().__init__()
+        self.batch_size = batch_size
+        self.threads = threads
+        self.quantized = quantized
+        self.model_id = f"{'onnx-int8' if quantized else 'onnx'}/{self.MODEL_NAME}"
+
+    def _model_path(self):
+        model_dir = os.path.join(self.DOWNLOAD_PATH, self.EXTRACTED_FOLDER_NAME)
+        fp32_path = os.path.join(model_dir, "model.onnx")
+        if not self.quantized:
+            return fp32_path
+
+        int8_path = os.path.join(model_dir, "model_int8.onnx")
+        if not os.path.exists(int8_path):
+            try:
+                from onnxruntime.quantization import quantize_dynamic, QuantType
+            except ImportError:
+                raise ValueError(
+                    "The onnx-int8 backend needs the onnx package. Please install it with `pip install onnx`"
+                )
+            partial_path = int8_path + ".partial"
+            quantize_dynamic(fp32_path, partial_path, weight_type=QuantType.QInt8)
+            os.replace(partial_path, int8_path)
+        return int8_path
+
+    @cached_property
+    def model(self):
+        options = self.ort.SessionOptions()
+        options.log_severity_level = 3
+        options.graph_optimization_level = self.ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if self.threads:
+            options.intra_op_num_threads = self.threads
+
+        # CoreML is slower than the CPU provider for this model
+        providers = [provider for provider in self.ort.get_available_providers()
+                     if provider != "CoreMLExecutionProvider"]
+        return self.ort.InferenceSession(self._model_path(), providers=providers, sess_options=options)
+
+    def __call__(self, input):
+        self._download_model_if_not_exists()
+        embeddings = self._forward(input, batch_size=self.batch_size)
+        return [np.array(embedding, dtype=np.float32) for embedding in embeddings]
+
+    def count_tokens(self, texts):
+        """Return the number of wordpieces in each text, not counting [CLS] and [SEP]."""
+        self._download_model_if_not_exists()
+        # The tokenizer pads the batch, so padding is told apart by the attention mask
+        encodings = self.tokenizer.encode_batch(list(texts), add_special_tokens=False)
+        return [sum(encoding.attention_mask) for encoding in encodings]
+
+class SentenceTransformerEmbeddingFunction:
+    """A sentence-transformers model, loaded on first use."""
+
+    def __init__(self, model_name="all-MiniLM-L6-v2", batch_size=32, threads=0):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.threads = threads
+        self.model_id = f"sentence-transformers/{model_name}"
+
+    @cached_property
+    def model(self):
+        try:
+            import torch
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ValueError(
+                "The sentence-transformers backend needs the sentence-transformers package. "
+                "Please install it with `pip install sentence-transformers`"
+            )
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        return SentenceTransformer(self.model_name, device="cpu")
+
+    def __call__(self, input):
+        embeddings = self.model.encode(
+            list(input),
+            batch_size=self.batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True
+        )
+        return [np.asarray(embedding, dtype=np.float32) for embedding in embeddings]
+
+    def count_tokens(self, texts):
+        """Return the number of tokens in each text, not counting special tokens."""
+        return [len(ids) for ids in self.model.tokenizer(list(texts), add_special_tokens=False)["input_ids"]]
+
+def create_embedding_function(backend="onnx", model_name=None, batch_size=32, threads=0):
+    """Build the embedding backend named backend (one of BACKENDS)."""
+    if backend == "onnx":
+        return ONNXEmbeddingFunction(batch_size, threads)
+    if backend == "onnx-int8":
+        return ONNXEmbeddingFunction(batch_size, threads, quantized=True)
+    if backend == "sentence-transformers":
+        return SentenceTransformerEmbeddingFunction(model_name or "all-MiniLM-L6-v2", batch_size, threads)
+    raise ValueError(f"Unknown embedding backend {backend!r}, expected one of {', '.join(BACKENDS)}")
@@ -0,0 +1,225 @@
+"""
+Single-writer job queue for /ingest requests.
+
+Each request becomes an IngestJob, whether the caller waits for it or polls
+it. A single worker thread drains the queue in micro-batches of at most
+batch_size documents, taking documents from several jobs when they are
+small, so concurrent ingests share one embedding call and one upsert, and
+never contend with each other for Chroma's SQLite and HNSW writes.
+Documents submitted under different keys (tenants) are written separately.
+
+The queue holds at most max_pending documents. Beyond that, submit() raises
+QueueFull with an estimate of when there will be room, or with block=True
+waits for it. close() refuses further documents and waits for the queued
+ones to be written, so a server can shut down without losing accepted work.
+"""
+
+import math
+import time
+import uuid
+import threading
+from collections import OrderedDict, deque
+
+class QueueFull(Exception):
+    """Raised by IngestQueue.submit when the documents do not fit in the queue."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"The ingest queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+class QueueClosed(Exception):
+    """Raised by IngestQueue.submit once the queue has been closed."""
+
+    def __init__(self):
+        super().__init__("The server is shutting down and no longer accepts ingests")
+
+class IngestJob:
+    """Progress of one asynchronous ingest request."""
+
+    def __init__(self, total, key=None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.total = total
+        self.processed = 0
+        self.counts = {"inserted": 0, "updated": 0, "skipped": 0, "deduplicated": 0, "failed": 0}
+        self.errors = []
+        self.created = time.time()
+        self.finished = None
+        self.done = threading.Event()
+
+    @property
+    def status(self):
+        if self.done.is_set():
+            return "failed" if self.errors else "done"
+        return "running" if self.processed else "queued"
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "total": self.total,
+            "processed": self.processed,
+            **self.counts,
+            "errors": self.errors,
+            "created": self.created,
+            "finished": self.finished
+        }
+
+class IngestQueue:
+    """
+    Queue of documents waiting to be written by write_fn.
+
+    write_fn takes a list of documents and the key they were submitted with,
+    and returns a dict mapping each id to "inserted", "updated", "skipped" or
+    "deduplicated", as chroma_server.write_documents does.
+    """
+
+    def __init__(self, write_fn, batch_size=64, linger=0.05, max_jobs=1000, max_pending=10000):
+        self.write_fn = write_fn
+        self.batch_size = batch_size
+        self.linger = linger
+        self.max_jobs = max_jobs
+        self.max_pending = max_pending
+        self._pending = deque()  # (job, document) pairs in arrival order
+        self._jobs = OrderedDict()
+        self._cond = threading.Condition()
+        self._worker = None
+        self._closed = False
+        self._in_flight = 0  # documents taken from the queue but not yet written
+        # Exponential moving average of the documents written per second
+        self._rate = None
+
+    def submit(self, documents, key=None, block=False):
+        """
+        Queue documents for writing under key and return the job tracking them.
+
+        Raises QueueFull when they do not fit in the queue, or with block=True
+        waits until they do. More than max_pending documents at once never
+        fit and raise ValueError. A closed queue raises QueueClosed.
+        """
+        if len(documents) > self.max_pending:
+            raise ValueError(f"At most {self.max_pending} documents can be queued at once, "
+                             "split the request or use /ingest/stream")
+        job = IngestJob(len(documents), key)
+        with self._cond:
+            while not self._closed and len(self._pending) + len(documents) > self.max_pending:
+                if not block:
+                    raise QueueFull(self._retry_after(len(documents)))
+                self._cond.wait()
+            if self._closed:
+                raise QueueClosed()
+            self._remember(job)
+            if not documents:
+                self._finish(job)
+                return job
+            self._pending.extend((job, doc) for doc in documents)
+            if self._worker is None:
+                # Started lazily so importing the server never spawns threads
+                self._worker = threading.Thread(target=self._run, name="ingest-worker", daemon=True)
+                self._worker.start()
+            self._cond.notify_all()
+        return job
+
+    def _retry_after(self, count):
+        # Seconds until enough of the queue has been written to fit count more documents
+        backlog = len(self._pending) + count - self.max_pending
+        if not self._rate:
+            return 1
+        return min(max(math.ceil(backlog / self._rate), 1), 60)
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def pending(self):
+        """Return the number of documents waiting to be written."""
+        with self._cond:
+            return len(self._pending)
+
+    def close(self, timeout=None):
+        """
+        Stop accepting documents and wait up to timeout seconds (None waits
+        indefinitely) for those already queued to be written. Returns the
+        number of documents left unwritten.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            worker = self._worker
+        if worker is not None:
+            worker.join(timeout)
+        with self._cond:
+            return len(self._pending) + self._in_flight
+
+    def _remember(self, job):
+        self._jobs[job.id] = job
+        # Forget the oldest finished jobs once the table is full
+        for old_id in list(self._jobs):
+            if len(self._jobs) <= self.max_jobs:
+                break
+            if self._jobs[old_id].done.is_set():
+                del self._jobs[old_id]
+
+    def _finish(self, job):
+        job.finished = time.time()
+        job.done.set()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                if self._closed:
+                    return None
+                self._cond.wait()
+            # Give other small requests a moment to join a partial batch
+            if len(self._pending) < self.batch_size and self.linger and not self._closed:
+                self._cond.wait(self.linger)
+            count = min(self.batch_size, len(self._pending))
+            batch = [self._pending.popleft() for _ in range(count)]
+            self._in_flight = count
+            # Wake submitters waiting for room
+            self._cond.notify_all()
+            return batch
+
+    def _run(self):
+        # Exits once the queue is closed and empty
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            groups = {}
+            for job, doc in batch:
+                groups.setdefault(job.key, []).append((job, doc))
+            for key, group in groups.items():
+                self._write(key, group)
+            with self._cond:
+                self._in_flight = 0
+
+    def _write(self, key, batch):
+        jobs = {job.id for job, _ in batch}
+        documents = [doc for _, doc in batch]
+        started = time.perf_counter()
+        try:
+            outcomes = self.write_fn(documents, key)
+            error = None
+        except Exception as e:
+            if len(jobs) > 1:
+                # One request's bad document should not fail the others it was coalesced with
+                for job_id in jobs:
+                    self._write(key, [(job, doc) for job, doc in batch if job.id == job_id])
+                return
+            outcomes = {}
+            error = str(e)
+        rate = len(batch) / max(time.perf_counter() - started, 1e-6)
+
+        with self._cond:
+            self._rate = rate if self._rate is None else 0.8 * self._rate + 0.2 * rate
+            for job, doc in batch:
+                job.processed += 1
+                if error is None:
+                    job.counts[outcomes[doc["id"]]] += 1
+                else:
+                    job.counts["failed"] += 1
+                    if error not in job.errors:
+                        job.errors.append(error)
+                if job.processed == job.total:
+                    self._finish(job)
@@ -0,0 +1,83 @@
+"""
+On-disk BM25 keyword index kept alongside the Chroma collection.
+
+The index is an SQLite FTS5 table, so inserts and deletes update the inverted
+index in place and ranking uses FTS5's built-in bm25(). Underscores count as
+word characters, so identifiers such as ESP_ERR_TIMEOUT or init_wifi stay
+single searchable terms.
+"""
+
+import json
+import re
+import sqlite3
+import threading
+
+_TERM = re.compile(r"\w+")
+
+class KeywordIndex:
+    """BM25 index of record texts, addressed by Chroma record id."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # records maps Chroma ids to FTS rowids so updates never scan the index
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS records (rowid INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS terms USING fts5(text, tokenize=\"unicode61 tokenchars '_'\")"
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def upsert(self, ids, texts):
+        """Index texts under ids, replacing any text already indexed for an id."""
+        with self._lock, self._conn:
+            for record_id, text in zip(ids, texts):
+                self._conn.execute("INSERT OR IGNORE INTO records (id) VALUES (?)", (record_id,))
+                rowid = self._conn.execute("SELECT rowid FROM records WHERE id = ?", (record_id,)).fetchone()[0]
+                self._conn.execute("DELETE FROM terms WHERE rowid = ?", (rowid,))
+                self._conn.execute("INSERT INTO terms (rowid, text) VALUES (?, ?)", (rowid, text))
+
+    def delete(self, ids):
+        """Remove ids from the index."""
+        with self._lock, self._conn:
+            for record_id in ids:
+                row = self._conn.execute("SELECT rowid FROM records WHERE id = ?", (record_id,)).fetchone()
+                if row is not None:
+                    self._conn.execute("DELETE FROM terms WHERE rowid = ?", row)
+                    self._conn.execute("DELETE FROM records WHERE rowid = ?", row)
+
+    def compact(self):
+        """Merge the FTS5 index segments and give free pages back to the file system."""
+        with self._lock:
+            with self._conn:
+                self._conn.execute("INSERT INTO terms (terms) VALUES ('optimize')")
+            self._conn.execute("VACUUM")
+
+    def search(self, query_text, limit, ids=None):
+        """
+        Return up to limit (id, score) pairs matching any term of query_text,
+        best first. Scores are BM25 scores, higher is better. With ids, only
+        those records are ranked.
+        """
+        terms = {term.lower() for term in _TERM.findall(query_text)}
+        if not terms or limit <= 0 or (ids is not None and not ids):
+            return []
+        # Quoting each term keeps FTS5 query syntax out of user input
+        match = " OR ".join('"' + term.replace('"', '""') + '"' for term in sorted(terms))
+        sql = "SELECT records.id, bm25(terms) FROM terms JOIN records ON records.rowid = terms.rowid WHERE terms MATCH ?"
+        params = [match]
+        if ids is not None:
+            # One JSON parameter, however many ids there are
+            sql += " AND records.id IN (SELECT value FROM json_each(?))"
+            params.append(json.dumps(list(ids)))
+        with self._lock:
+            rows = self._conn.execute(sql + " ORDER BY bm25(terms) LIMIT ?", (*params, limit)).fetchall()
+        # FTS5 reports bm25 as a negative number, lower meaning more relevant
+        return [(record_id, -rank) for record_id, rank in rows]
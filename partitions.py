@@ -0,0 +1,236 @@
+"""
+Per-tenant, optionally sharded, collections for the ChromaDB server.
+
+Every tenant's messages live in their own collections, so a search only
+walks the HNSW graph of that tenant's history. Within a tenant, records can
+further be spread over shard_count collections by hashing one metadata
+field (the shard key, chatId by default); a query whose filter pins the
+shard key is sent to a single shard, any other query to all of them.
+
+Collections are named after the base collection:
+
+- "chat_history" holds the default tenant (shard 0)
+- "chat_history.3" holds shard 3 of the default tenant
+- "chat_history-alice" and "chat_history-alice.3" hold tenant "alice"
+
+so a single-tenant, single-shard server keeps using the original collection.
+Records are only found in the shard their key hashes to, so shard_count is
+fixed for a database: collections record it in their "shard_count" metadata
+and check_shard_count() refuses a different one.
+Each collection has its own BM25 keyword index and table of deduplicated
+messages next to it, and, when the router is created with quantize=True,
+its own int8 vector store.
+"""
+
+import os
+import re
+import zlib
+import threading
+
+from dedup import DuplicateLinks
+from keyword_index import KeywordIndex
+from vector_store import QuantizedVectorStore
+
+DEFAULT_TENANT = "default"
+
+# Letters, digits and inner underscores, which keep collection names unambiguous
+_TENANT = re.compile(r"^[A-Za-z0-9](?:[A-Za-z0-9_]{0,62}[A-Za-z0-9])?$")
+
+def validate_tenant(tenant):
+    """Return tenant if it is a valid tenant id, raise ValueError otherwise."""
+    if not isinstance(tenant, str) or not _TENANT.match(tenant):
+        raise ValueError(
+            "tenant must be 1-64 letters, digits or underscores, starting and ending with a letter or digit"
+        )
+    return tenant
+
+class Partition:
+    """
+    One collection, the keyword index of its records, the messages linked to
+    them as duplicates and optionally their quantized vectors.
+    """
+
+    def __init__(self, name, tenant, shard, collection, keyword_index, duplicate_links, vector_store=None):
+        self.name = name
+        self.tenant = tenant
+        self.shard = shard
+        self.collection = collection
+        self.keyword_index = keyword_index
+        self.duplicate_links = duplicate_links
+        self.vector_store = vector_store
+
+    def backfill_keyword_index(self, batch_size=1000):
+        """Add every record in the collection to the keyword index."""
+        for offset in range(0, self.collection.count(), batch_size):
+            records = self.collection.get(limit=batch_size, offset=offset, include=["documents"])
+            self.keyword_index.upsert(records["ids"], records["documents"])
+
+    def rebuild_vector_store(self, batch_size=1000):
+        """Replace the vector store's contents with the collection's embeddings."""
+        self.vector_store.clear()
+        for offset in range(0, self.collection.count(), batch_size):
+            records = self.collection.get(limit=batch_size, offset=offset, include=["embeddings"])
+            self.vector_store.upsert(records["ids"], records["embeddings"])
+
+class PartitionRouter:
+    """
+    Opens partitions on demand and decides which ones a write or query touches.
+
+    on_open, if given, is called with each collection the first time it is
+    opened, before it is used. With quantize=True every partition also gets
+    a QuantizedVectorStore.
+    """
+
+    def __init__(self, client, db_path, base_name="chat_history", metadata=None,
+                 shard_count=1, shard_key="chatId", on_open=None, quantize=False):
+        if shard_count < 1:
+            raise ValueError("shard_count must be at least 1")
+        self.client = client
+        self.db_path = db_path
+        self.base_name = base_name
+        self.metadata = metadata or {}
+        self.shard_count = shard_count
+        self.shard_key = shard_key
+        self.on_open = on_open
+        self.quantize = quantize
+        self._partitions = {}
+        self._lock = threading.Lock()
+
+    def collection_name(self, tenant, shard):
+        name = self.base_name if tenant == DEFAULT_TENANT else f"{self.base_name}-{tenant}"
+        return name if shard == 0 else f"{name}.{shard}"
+
+    def keyword_index_path(self, name):
+        # The original collection keeps the index file it had before partitioning
+        if name == self.base_name:
+            return os.path.join(self.db_path, "keyword_index.sqlite3")
+        return os.path.join(self.db_path, "keyword_index", f"{name}.sqlite3")
+
+    def duplicate_links_path(self, name):
+        return os.path.join(self.db_path, "duplicates", f"{name}.sqlite3")
+
+    def vector_store_path(self, name):
+        return os.path.join(self.db_path, "vector_store", name)
+
+    def get(self, tenant, shard=0, create=True):
+        """
+        Return the partition for a tenant's shard, opening it if needed.
+
+        With create=False, a partition whose collection does not exist yet
+        is not created and None is returned.
+        """
+        name = self.collection_name(tenant, shard)
+        with self._lock:
+            partition = self._partitions.get(name)
+            if partition is not None:
+                return partition
+            if create:
+                collection = self.client.get_or_create_collection(name=name, metadata=self.metadata)
+            else:
+                try:
+                    collection = self.client.get_collection(name=name)
+                except Exception:
+                    return None
+            if self.on_open is not None:
+                self.on_open(collection)
+            path = self.keyword_index_path(name)
+            links_path = self.duplicate_links_path(name)
+            for directory in (os.path.dirname(path), os.path.dirname(links_path)):
+                os.makedirs(directory, exist_ok=True)
+            vector_store = QuantizedVectorStore(self.vector_store_path(name)) if self.quantize else None
+            partition = Partition(name, tenant, shard, collection, KeywordIndex(path),
+                                  DuplicateLinks(links_path), vector_store)
+            self._partitions[name] = partition
+            return partition
+
+    def named(self, name):
+        """Return the open partition called name."""
+        with self._lock:
+            return self._partitions[name]
+
+    def shard_of(self, value):
+        """Return the shard that records with this shard key value belong to."""
+        if self.shard_count == 1:
+            return 0
+        # crc32 is stable across processes, unlike hash()
+        return zlib.crc32(str(value if value is not None else "").encode("utf-8")) % self.shard_count
+
+    def route_documents(self, documents, tenant=DEFAULT_TENANT):
+        """Group documents by the partition they are written to, as {Partition: [documents]}."""
+        groups = {}
+        for doc in documents:
+            shard = self.shard_of((doc.get("metadata") or {}).get(self.shard_key))
+            groups.setdefault(shard, []).append(doc)
+        return {self.get(tenant, shard): docs for shard, docs in groups.items()}
+
+    def route_query(self, tenants, shard_values=None):
+        """
+        Return the existing partitions a query over tenants has to search.
+
+        shard_values, when given, are the only shard key values the query can
+        match, which limits it to their shards.
+        """
+        if shard_values:
+            shards = sorted({self.shard_of(value) for value in shard_values})
+        else:
+            shards = range(self.shard_count)
+        partitions = [self.get(tenant, shard, create=False) for tenant in tenants for shard in shards]
+        return [partition for partition in partitions if partition is not None]
+
+    def open_partitions(self):
+        """Return the partitions opened so far."""
+        with self._lock:
+            return list(self._partitions.values())
+
+    def open_all(self):
+        """Open every existing collection that belongs to this router and return the partitions."""
+        for collection in self.client.list_collections():
+            name = getattr(collection, "name", collection)
+            parsed = self.parse_name(name)
+            if parsed is not None:
+                self.get(*parsed, create=False)
+        return self.open_partitions()
+
+    def check_shard_count(self):
+        """
+        Raise ValueError if a collection holding records was written with a
+        different shard_count, whose records would be looked for in the
+        wrong shards.
+        """
+        for collection in self.client.list_collections():
+            parsed = self._split_name(collection.name)
+            if parsed is None:
+                continue
+            stored = (collection.metadata or {}).get("shard_count")
+            # Collections from before shard_count was recorded only show it by their shard numbers
+            if stored in (None, self.shard_count) and parsed[1] < self.shard_count:
+                continue
+            if collection.count():
+                raise ValueError(
+                    f"Collection {collection.name} was written with shard_count {stored or f'at least {parsed[1] + 1}'}, "
+                    f"not {self.shard_count}"
+                )
+
+    def parse_name(self, name):
+        """Return (tenant, shard) for a collection name of this router, or None."""
+        parsed = self._split_name(name)
+        if parsed is None or parsed[1] >= self.shard_count:
+            return None
+        return parsed
+
+    def _split_name(self, name):
+        # (tenant, shard) of any collection named by this router, whatever its shard_count
+        if name != self.base_name and not name.startswith((self.base_name + "-", self.base_name + ".")):
+            return None
+        rest = name[len(self.base_name):]
+        tenant, shard = DEFAULT_TENANT, 0
+        if rest.startswith("-"):
+            tenant, _, rest = rest[1:].partition(".")
+            rest = "." + rest if rest else ""
+        if rest:
+            if not rest[1:].isdigit():
+                return None
+            shard = int(rest[1:])
+        if tenant != DEFAULT_TENANT and not _TENANT.match(tenant):
+            return None
+        return tenant, shard
@@ -0,0 +1,89 @@
+"""
+Bounded in-process cache for formatted /query results.
+"""
+
+import json
+import time
+import threading
+from collections import OrderedDict
+
+def normalize_query(query_text):
+    """Collapse case and whitespace so near-identical prompts share an entry."""
+    return " ".join(query_text.lower().split())
+
+class QueryCache:
+    """
+    LRU cache with a per-entry time-to-live.
+
+    Keys include a collection version counter. Writes to the collection call
+    bump_version(), which makes every earlier entry unreachable and drops it.
+    """
+
+    def __init__(self, max_size=256, ttl=300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, version, query_text, n_results, options):
+        return (version, normalize_query(query_text), n_results, json.dumps(options, sort_keys=True))
+
+    def get(self, query_text, n_results, options=None):
+        """
+        Return the cached results, or None on a miss or expired entry.
+
+        options holds any other JSON-serializable request parameters that
+        change the results; they are part of the key.
+        """
+        with self._lock:
+            key = self._key(self.version, query_text, n_results, options)
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, query_text, n_results, results, version, options=None):
+        """
+        Store results, evicting the least recently used entry when full.
+
+        version is the value of self.version read before the search ran, so
+        results computed before a concurrent write are never cached.
+        """
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if version != self.version:
+                return
+            key = self._key(version, query_text, n_results, options)
+            self._entries[key] = (time.monotonic() + self.ttl, results)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def bump_version(self):
+        """Invalidate every cached result after the collection changes."""
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+
+    def stats(self):
+        """Return hit/miss counters and current occupancy."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "version": self.version,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
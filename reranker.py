@@ -0,0 +1,130 @@
+"""
+Cross-encoder re-rankers for the ChromaDB server.
+
+A cross-encoder reads the query and a candidate text together and returns a
+relevance score, which ranks far better than the cosine distance between two
+independently computed embeddings, but costs one model pass per candidate.
+The server therefore only re-ranks the top candidates of a vector search.
+
+Every re-ranker is a callable taking a query and a list of texts and
+returning one float score per text, higher meaning more relevant:
+
+- "onnx": a cross-encoder with an ONNX export on the Hugging Face Hub, run
+  with onnxruntime and tokenizers, which Chroma already depends on
+- "sentence-transformers": any sentence-transformers CrossEncoder (optional
+  package)
+
+Both score in batches and keep a running estimate of the time per pair, so
+callers can skip re-ranking that would not fit in a latency budget.
+"""
+
+import time
+from functools import cached_property
+
+import numpy as np
+
+RERANKERS = ("onnx", "sentence-transformers")
+
+DEFAULT_RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+class CrossEncoder:
+    """Batching, deadlines and timing shared by the re-ranker backends."""
+
+    def __init__(self, model_name, batch_size=16, threads=0, max_length=512):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.threads = threads
+        self.max_length = max_length
+        # Exponential moving average of the seconds spent per (query, text) pair
+        self.seconds_per_pair = None
+
+    def _score_batch(self, query, texts):
+        raise NotImplementedError
+
+    def estimate(self, count):
+        """Return the expected seconds to score count texts, or 0 before the first call."""
+        return (self.seconds_per_pair or 0.0) * count
+
+    def __call__(self, query, texts, deadline=None):
+        """
+        Return one score per text. With a deadline (a time.perf_counter()
+        value), scoring stops once it has passed and None is returned.
+        """
+        scores = []
+        for start in range(0, len(texts), self.batch_size):
+            if deadline is not None and time.perf_counter() > deadline:
+                return None
+            batch = texts[start:start + self.batch_size]
+            started = time.perf_counter()
+            scores.extend(float(score) for score in self._score_batch(query, batch))
+            per_pair = (time.perf_counter() - started) / len(batch)
+            self.seconds_per_pair = per_pair if self.seconds_per_pair is None else (
+                0.8 * self.seconds_per_pair + 0.2 * per_pair)
+        return scores
+
+class ONNXCrossEncoder(CrossEncoder):
+    """A cross-encoder's ONNX export from the Hugging Face Hub, downloaded on first use."""
+
+    @cached_property
+    def tokenizer(self):
+        from huggingface_hub import hf_hub_download
+        from tokenizers import Tokenizer
+
+        tokenizer = Tokenizer.from_file(hf_hub_download(self.model_name, "tokenizer.json"))
+        tokenizer.enable_truncation(max_length=self.max_length)
+        tokenizer.enable_padding()
+        return tokenizer
+
+    @cached_property
+    def model(self):
+        import onnxruntime as ort
+        from huggingface_hub import hf_hub_download
+
+        options = ort.SessionOptions()
+        options.log_severity_level = 3
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if self.threads:
+            options.intra_op_num_threads = self.threads
+        return ort.InferenceSession(hf_hub_download(self.model_name, "onnx/model.onnx"),
+                                    providers=["CPUExecutionProvider"], sess_options=options)
+
+    def _score_batch(self, query, texts):
+        encodings = self.tokenizer.encode_batch([(query, text) for text in texts])
+        inputs = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64),
+            "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64)
+        }
+        # Some exports take no token_type_ids
+        wanted = {model_input.name for model_input in self.model.get_inputs()}
+        logits = self.model.run(None, {name: value for name, value in inputs.items() if name in wanted})[0]
+        return logits[:, 0] if logits.ndim == 2 else logits
+
+class SentenceTransformerCrossEncoder(CrossEncoder):
+    """A sentence-transformers CrossEncoder, loaded on first use."""
+
+    @cached_property
+    def model(self):
+        try:
+            import torch
+            from sentence_transformers import CrossEncoder as STCrossEncoder
+        except ImportError:
+            raise ValueError(
+                "The sentence-transformers re-ranker needs the sentence-transformers package. "
+                "Please install it with `pip install sentence-transformers`"
+            )
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        return STCrossEncoder(self.model_name, device="cpu", max_length=self.max_length)
+
+    def _score_batch(self, query, texts):
+        return self.model.predict([(query, text) for text in texts], batch_size=len(texts),
+                                  show_progress_bar=False)
+
+def create_reranker(backend="onnx", model_name=None, batch_size=16, threads=0):
+    """Build the re-ranker named backend (one of RERANKERS)."""
+    if backend == "onnx":
+        return ONNXCrossEncoder(model_name or DEFAULT_RERANK_MODEL, batch_size, threads)
+    if backend == "sentence-transformers":
+        return SentenceTransformerCrossEncoder(model_name or DEFAULT_RERANK_MODEL, batch_size, threads)
+    raise ValueError(f"Unknown re-ranker {backend!r}, expected one of {', '.join(RERANKERS)}")
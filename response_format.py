@@ -0,0 +1,73 @@
+"""
+Response encodings for the query endpoints.
+
+Clients choose the encoding with standard headers: JSON by default, or
+MessagePack when Accept names application/msgpack (this needs the optional
+msgpack package; without it the server answers in JSON). Either is
+gzip-compressed when Accept-Encoding allows it and the body is large enough
+to benefit.
+
+Embeddings can be sent as packed little-endian float32 buffers instead of
+lists of numbers: raw bytes in MessagePack, base64 text in JSON.
+"""
+
+import base64
+import gzip
+import json
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+
+# Smaller bodies gain less from compression than it costs
+GZIP_MIN_BYTES = 1024
+
+def pack_embedding(vector):
+    """Return vector as a little-endian float32 buffer."""
+    return np.asarray(vector, dtype="<f4").tobytes()
+
+def unpack_embedding(data):
+    """Return the float32 array in a packed buffer, or in its base64 text from a JSON response."""
+    if isinstance(data, str):
+        data = base64.b64decode(data)
+    return np.frombuffer(data, dtype="<f4")
+
+def pack_embeddings(hits):
+    """Return hits with each embedding replaced by its packed buffer."""
+    return [dict(hit, embedding=pack_embedding(hit["embedding"])) if "embedding" in hit else hit for hit in hits]
+
+def _plain(value):
+    # numpy values come from Chroma; neither encoder handles them natively
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+def _json_default(value):
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    return _plain(value)
+
+def negotiate(accept_mimetypes, accept_encodings):
+    """Return (mimetype, gzip) for a request's parsed Accept and Accept-Encoding headers."""
+    offered = ["application/json"] + (list(MSGPACK_TYPES) if msgpack is not None else [])
+    mimetype = accept_mimetypes.best_match(offered) or "application/json"
+    return mimetype, accept_encodings.quality("gzip") > 0
+
+def encode(body, mimetype="application/json", compress=False):
+    """Return (bytes, headers) for body in the given encoding."""
+    if mimetype in MSGPACK_TYPES:
+        data = msgpack.packb(body, default=_plain, use_bin_type=True)
+    else:
+        data = json.dumps(body, default=_json_default, separators=(",", ":")).encode("utf-8")
+    headers = {"Content-Type": mimetype, "Vary": "Accept, Accept-Encoding"}
+    if compress and len(data) >= GZIP_MIN_BYTES:
+        data = gzip.compress(data, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+    return data, headers
@@ -17,8 +17,20 @@ def main():
     parser.add_argument('--browser', default='chrome', choices=['chrome', 'firefox', 'edge'],
                         help='Browser to use for end-to-end testing (default: chrome)')
     parser.add_argument('--api-key', default='', help='API key for the ChatGPT service')
+    parser.add_argument('--bench', action='store_true',
+                        help='Run the ingest/query benchmark instead of the tests; other options '
+                             'are passed to tests/benchmark.py (e.g. --scales 1k,100k --compare old.json)')
     
-    args = parser.parse_args()
+    args, bench_args = parser.parse_known_args()
+    
+    if args.bench:
+        print("="*80)
+        print(" Embedded AI Project - Benchmark")
+        print("="*80)
+        bench_cmd = [sys.executable, "tests/benchmark.py", *bench_args]
+        sys.exit(subprocess.run(bench_cmd).returncode)
+    if bench_args:
+        parser.error(f"unrecognized arguments: {' '.join(bench_args)}")
     
     # Determine which tests to run
     run_backend = not args.e2e_only
@@ -0,0 +1,121 @@
+"""
+Snapshot files of the ChromaDB server's records, embeddings included.
+
+A snapshot is a sequence of frames, each a JSON header followed by the
+columns it lists, so a chunk of records is read and written with a few
+large reads instead of per-record parsing:
+
+- "manifest": the embedding model and vector size the snapshot was made with
+- "records": up to a chunk of a tenant's records, as ids, documents and
+  metadatas columns (gzip-compressed JSON lists) and an embeddings column
+  (little-endian float32, one row per record)
+- "links": messages linked to a record as duplicates, as ids, canonical,
+  texts and metadatas columns
+- "end": the number of records and links written, which marks the file as
+  complete
+
+Every column carries a CRC32 and the reader fails on a damaged or truncated
+frame before returning it. Frames are read one at a time, so a file larger
+than memory can be streamed; an import that stops part way has written the
+frames before the damage, and since imports upsert it can simply be re-run.
+"""
+
+import gzip
+import json
+import struct
+import zlib
+
+import numpy as np
+
+MAGIC = b"CHROMA-SNAPSHOT\n"
+VERSION = 1
+
+_LENGTH = struct.Struct("<I")
+
+def _read_exact(f, size):
+    # Request streams may return fewer bytes than asked for
+    parts = []
+    while size:
+        part = f.read(size)
+        if not part:
+            raise ValueError("Snapshot is truncated")
+        parts.append(part)
+        size -= len(part)
+    return b"".join(parts)
+
+def _encode_column(values):
+    if isinstance(values, np.ndarray):
+        return "f4", np.ascontiguousarray(values, dtype="<f4").tobytes()
+    return "json.gz", gzip.compress(json.dumps(values, separators=(",", ":")).encode("utf-8"), compresslevel=1)
+
+def _decode_column(encoding, data, shape):
+    if encoding == "f4":
+        return np.frombuffer(data, dtype="<f4").reshape(shape)
+    if encoding == "json.gz":
+        return json.loads(gzip.decompress(data))
+    raise ValueError(f"Unknown snapshot column encoding {encoding!r}")
+
+class SnapshotWriter:
+    """Writes a snapshot to a binary file object; call close() to complete it."""
+
+    def __init__(self, f, embedding_model, dimensions=None):
+        self.f = f
+        self.counts = {"records": 0, "links": 0}
+        f.write(MAGIC)
+        self._frame("manifest", {}, version=VERSION, embedding_model=embedding_model, dimensions=dimensions)
+
+    def _frame(self, kind, columns, **fields):
+        encoded = [(name, *_encode_column(values)) for name, values in columns.items()]
+        header = {
+            "kind": kind,
+            **fields,
+            "columns": [[name, encoding, len(data), zlib.crc32(data)] for name, encoding, data in encoded]
+        }
+        if "embeddings" in columns:
+            header["shape"] = list(np.shape(columns["embeddings"]))
+        header = json.dumps(header).encode("utf-8")
+        self.f.write(_LENGTH.pack(len(header)))
+        self.f.write(header)
+        for _, _, data in encoded:
+            self.f.write(data)
+
+    def records(self, tenant, ids, documents, metadatas, embeddings):
+        """Write one chunk of a tenant's records."""
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1)
+        self._frame("records", {"ids": list(ids), "documents": list(documents), "metadatas": list(metadatas),
+                                "embeddings": embeddings}, tenant=tenant)
+        self.counts["records"] += len(ids)
+
+    def links(self, tenant, ids, canonical, texts, metadatas):
+        """Write one chunk of a tenant's duplicate links."""
+        self._frame("links", {"ids": list(ids), "canonical": list(canonical), "texts": list(texts),
+                              "metadatas": list(metadatas)}, tenant=tenant)
+        self.counts["links"] += len(ids)
+
+    def close(self):
+        """Write the end frame; the file object is left open."""
+        self._frame("end", {}, **self.counts)
+
+def read_snapshot(f):
+    """
+    Yield (header, columns) for each frame of a snapshot read from a binary
+    file object, the manifest first. Raises ValueError for a file that is not
+    a complete, intact snapshot.
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a snapshot file")
+    first = True
+    while True:
+        header = json.loads(_read_exact(f, _LENGTH.unpack(_read_exact(f, _LENGTH.size))[0]))
+        if first and (header["kind"] != "manifest" or header.get("version") != VERSION):
+            raise ValueError(f"Unsupported snapshot version {header.get('version')!r}")
+        first = False
+        columns = {}
+        for name, encoding, length, crc in header.pop("columns"):
+            data = _read_exact(f, length)
+            if zlib.crc32(data) != crc:
+                raise ValueError(f"Snapshot column {name!r} is corrupted")
+            columns[name] = _decode_column(encoding, data, header.get("shape"))
+        yield header, columns
+        if header["kind"] == "end":
+            return
@@ -1,13 +1,23 @@
 # PowerShell script to start the application on Windows
+# Pass -production to serve the ChromaDB server through waitress
+param(
+    [switch]$production
+)
 
 # Navigate to the script directory
 Set-Location $PSScriptRoot
 
 # Start the ChromaDB Flask server in the background
 Write-Host "Starting ChromaDB Flask server..."
-$flask_job = Start-Job -ScriptBlock {
-    python chroma_server.py
+$server_args = @()
+if ($production) {
+    $server_args += "--production"
 }
+$flask_job = Start-Job -ScriptBlock {
+    param($root, $serverArgs)
+    Set-Location $root
+    python chroma_server.py @serverArgs
+} -ArgumentList $PSScriptRoot, $server_args
 
 # Change to the BetterChatGPT directory
 Set-Location BetterChatGPT
@@ -1,8 +1,14 @@
 #!/bin/bash
 
+# Pass --production to serve the ChromaDB server through waitress
+SERVER_ARGS=""
+if [ "$1" == "--production" ]; then
+    SERVER_ARGS="--production"
+fi
+
 # Start the ChromaDB Flask server in the background
 echo "Starting ChromaDB Flask server..."
-python3 chroma_server.py &
+python3 chroma_server.py $SERVER_ARGS &
 FLASK_PID=$!
 
 # Change to the BetterChatGPT directory
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+Load-test and benchmark suite for the ChromaDB server.
+
+For each scale, a fresh server is started in a temporary directory (so every
+run begins with an empty database), a synthetic set of chat histories is
+streamed to /ingest/stream, and /query is then hammered at several levels of
+concurrency and n_results. The synthetic data is generated from a fixed seed,
+so two runs with the same options send exactly the same requests.
+
+Results are written as JSON. Pass --compare with an earlier result file to
+print the differences and fail when throughput or tail latency regressed by
+more than --tolerance.
+
+Usage:
+    python tests/benchmark.py --scales 1k,100k --output bench.json
+    python tests/benchmark.py --compare bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+from bulk_load import gzip_ndjson
+
+SERVER_READY_TIMEOUT = 300  # seconds; the first start downloads the embedding model
+
+TOPICS = {
+    "power": ["deep", "sleep", "current", "battery", "microamps", "wakeup", "RTC", "regulator", "brownout"],
+    "ml": ["TinyML", "quantization", "int8", "model", "inference", "tensor", "arena", "accuracy", "latency"],
+    "network": ["WiFi", "MQTT", "broker", "TLS", "reconnect", "socket", "BLE", "advertising", "throughput"],
+    "storage": ["flash", "NVS", "partition", "SPIFFS", "wear", "levelling", "OTA", "bootloader", "sector"],
+    "debug": ["watchdog", "panic", "backtrace", "JTAG", "heap", "stack", "overflow", "assert", "core"],
+}
+FILLER = ["the", "a", "with", "when", "after", "before", "on", "is", "should", "we", "can", "it",
+          "this", "that", "using", "because", "then", "set", "check", "enable", "disable", "try"]
+IDENTIFIERS = ["ESP_ERR_TIMEOUT", "ESP_ERR_NO_MEM", "CONFIG_FREERTOS_HZ", "esp_deep_sleep_start",
+               "xTaskCreatePinnedToCore", "nvs_flash_init", "TfLiteStatus", "kTensorArenaSize"]
+
+def parse_scale(text):
+    """Turn "1k", "100k" or "1M" into a message count."""
+    text = text.strip()
+    multiplier = {"k": 1_000, "m": 1_000_000}.get(text[-1].lower(), 1)
+    return int(float(text.rstrip("kKmM")) * multiplier)
+
+def sentence(rng, topic, words):
+    vocabulary = TOPICS[topic]
+    tokens = [rng.choice(vocabulary) if rng.random() < 0.4 else rng.choice(FILLER) for _ in range(words)]
+    if rng.random() < 0.1:
+        tokens.insert(rng.randrange(len(tokens) + 1), rng.choice(IDENTIFIERS))
+    return " ".join(tokens).capitalize() + "."
+
+def message_text(rng, topic, role):
+    # Users ask short questions; a few assistant answers are long enough to be chunked
+    if role == "user":
+        words = rng.randint(5, 40)
+    elif rng.random() < 0.05:
+        words = rng.randint(300, 800)
+    else:
+        words = rng.randint(30, 200)
+    sentences = []
+    while words > 0:
+        length = min(words, rng.randint(6, 24))
+        sentences.append(sentence(rng, topic, length))
+        words -= length
+    return " ".join(sentences)
+
+def iter_messages(count, seed=0):
+    """Yield count synthetic ingest documents, grouped into chats of 4-40 messages."""
+    rng = random.Random(seed)
+    base_time = datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
+    produced = chat_number = 0
+    while produced < count:
+        chat_id = f"bench_{seed}_{chat_number}"
+        topic = rng.choice(sorted(TOPICS))
+        length = min(rng.randint(4, 40), count - produced)
+        started = base_time + chat_number * 3600
+        for index in range(length):
+            role = "user" if index % 2 == 0 else "assistant"
+            yield {
+                "id": f"{chat_id}_{index}",
+                "text": message_text(rng, topic, role),
+                "metadata": {
+                    "role": role,
+                    "chatId": chat_id,
+                    "title": f"{topic} chat {chat_number}",
+                    "timestamp": datetime.fromtimestamp(started + index * 30, timezone.utc).isoformat(),
+                    "messageIndex": index
+                }
+            }
+        produced += length
+        chat_number += 1
+
+def query_texts(count, seed=0):
+    """Return count distinct synthetic queries, so none are answered by the query cache."""
+    rng = random.Random(seed + 1)
+    return [f"{sentence(rng, rng.choice(sorted(TOPICS)), rng.randint(4, 12))} #{i}" for i in range(count)]
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    position = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[position]
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def process_memory(pid):
+    """Return the resident and peak resident memory of a process in bytes, where available."""
+    memory = {"rss_bytes": None, "peak_rss_bytes": None}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    memory["rss_bytes"] = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    memory["peak_rss_bytes"] = int(line.split()[1]) * 1024
+    except OSError:
+        # Not Linux; psutil, when installed, still reports the current size
+        try:
+            import psutil
+            memory["rss_bytes"] = psutil.Process(pid).memory_info().rss
+        except Exception:
+            pass
+    return memory
+
+def server_metrics(server_url):
+    """Return the collection size and total seconds spent per processing stage, from /metrics."""
+    records, stages = 0, {}
+    for line in requests.get(f"{server_url}/metrics").text.splitlines():
+        if line.startswith("chroma_collection_records{"):
+            records += int(float(line.rsplit(" ", 1)[1]))
+        elif line.startswith("chroma_stage_duration_seconds_sum{"):
+            labels, value = line.rsplit(" ", 1)
+            stages[labels.split('stage="', 1)[1].split('"', 1)[0]] = round(float(value), 3)
+    return {"records": records, "stage_seconds": stages}
+
+class BenchmarkServer:
+    """A production-mode chroma_server.py running on a free port in a temporary directory."""
+
+    def __init__(self, threads):
+        self.threads = threads
+        self.workdir = tempfile.mkdtemp(prefix="chroma-bench-")
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.process = None
+
+    def __enter__(self):
+        self.log = open(os.path.join(self.workdir, "server.log"), "w")
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(PROJECT_ROOT, "chroma_server.py"), "--production",
+             "--host", "127.0.0.1", "--port", str(self.port), "--threads", str(self.threads)],
+            cwd=self.workdir, stdout=self.log, stderr=subprocess.STDOUT
+        )
+        try:
+            self._wait_until_ready()
+        except Exception:
+            # The log is kept in the temporary directory for inspection
+            self.process.kill()
+            self.log.close()
+            raise
+        return self
+
+    def _wait_until_ready(self):
+        deadline = time.time() + SERVER_READY_TIMEOUT
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Benchmark server exited, see {self.log.name}")
+            try:
+                response = requests.get(f"{self.url}/readyz", timeout=1)
+                if response.status_code == 200:
+                    return
+                if response.json().get("error"):
+                    raise RuntimeError(f"Benchmark server warm-up failed: {response.json()['error']}")
+            except requests.exceptions.ConnectionError:
+                pass
+            time.sleep(0.5)
+        raise RuntimeError("Benchmark server did not become ready")
+
+    def __exit__(self, *exc):
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    @property
+    def db_path(self):
+        return os.path.join(self.workdir, "db")
+
+def run_ingest(server_url, count, seed):
+    started = time.perf_counter()
+    response = requests.post(
+        f"{server_url}/ingest/stream",
+        data=gzip_ndjson(iter_messages(count, seed)),
+        headers={"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"}
+    )
+    seconds = time.perf_counter() - started
+    response.raise_for_status()
+    summary = response.json()
+    return {
+        "documents": summary["count"],
+        "inserted": summary["inserted"],
+        "seconds": round(seconds, 3),
+        "docs_per_second": round(summary["count"] / seconds, 1)
+    }
+
+def run_queries(server_url, queries, concurrency, n_results):
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+    def timed_query(text):
+        started = time.perf_counter()
+        response = session.post(f"{server_url}/query", json={"query": text, "n_results": n_results})
+        elapsed = time.perf_counter() - started
+        return elapsed, response.status_code == 200
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(timed_query, queries))
+    seconds = time.perf_counter() - started
+
+    latencies_ms = [elapsed * 1000 for elapsed, ok in outcomes if ok]
+    return {
+        "concurrency": concurrency,
+        "n_results": n_results,
+        "queries": len(queries),
+        "errors": sum(1 for _, ok in outcomes if not ok),
+        "queries_per_second": round(len(queries) / seconds, 1),
+        "p50_ms": round(percentile(latencies_ms, 0.50), 2) if latencies_ms else None,
+        "p95_ms": round(percentile(latencies_ms, 0.95), 2) if latencies_ms else None,
+        "p99_ms": round(percentile(latencies_ms, 0.99), 2) if latencies_ms else None,
+        "mean_ms": round(sum(latencies_ms) / len(latencies_ms), 2) if latencies_ms else None
+    }
+
+def benchmark_scale(label, args):
+    count = parse_scale(label)
+    print(f"\n== {label} messages ({count}) ==", flush=True)
+    with BenchmarkServer(args.threads) as server:
+        result = {"scale": label, "messages": count}
+        result["startup_memory"] = process_memory(server.process.pid)
+
+        result["ingest"] = run_ingest(server.url, count, args.seed)
+        print(f"ingest: {result['ingest']['docs_per_second']} docs/s "
+              f"({result['ingest']['seconds']}s)", flush=True)
+        result["disk_bytes"] = directory_size(server.db_path)
+
+        result["query"] = []
+        batch_number = 0
+        for n_results in args.n_results:
+            for concurrency in args.concurrency:
+                # Every run gets unseen queries, so latency excludes the query cache
+                batch_number += 1
+                queries = query_texts(args.queries, args.seed * 1000 + batch_number)
+                stats = run_queries(server.url, queries, concurrency, n_results)
+                result["query"].append(stats)
+                print(f"query: n_results={n_results} concurrency={concurrency} "
+                      f"p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms p99={stats['p99_ms']}ms "
+                      f"{stats['queries_per_second']} q/s", flush=True)
+
+        result["memory"] = process_memory(server.process.pid)
+        result.update(server_metrics(server.url))
+        return result
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(baseline, current, tolerance):
+    """Print per-metric changes against a baseline run and return the regressions."""
+    regressions = []
+    baseline_scales = {result["scale"]: result for result in baseline["results"]}
+    for result in current["results"]:
+        previous = baseline_scales.get(result["scale"])
+        if previous is None:
+            continue
+        print(f"\n== {result['scale']} vs baseline {baseline['meta'].get('commit')} ==")
+
+        old_rate, new_rate = previous["ingest"]["docs_per_second"], result["ingest"]["docs_per_second"]
+        change = (new_rate - old_rate) / old_rate if old_rate else 0.0
+        print(f"ingest docs/s: {old_rate} -> {new_rate} ({change:+.1%})")
+        if change < -tolerance:
+            regressions.append(f"{result['scale']} ingest docs/s {change:+.1%}")
+
+        previous_queries = {(q["concurrency"], q["n_results"]): q for q in previous["query"]}
+        for stats in result["query"]:
+            old = previous_queries.get((stats["concurrency"], stats["n_results"]))
+            if not old or not old["p95_ms"] or not stats["p95_ms"]:
+                continue
+            change = (stats["p95_ms"] - old["p95_ms"]) / old["p95_ms"]
+            print(f"query c={stats['concurrency']} n={stats['n_results']} p95: "
+                  f"{old['p95_ms']}ms -> {stats['p95_ms']}ms ({change:+.1%})")
+            if change > tolerance:
+                regressions.append(f"{result['scale']} query c={stats['concurrency']} "
+                                   f"n={stats['n_results']} p95 {change:+.1%}")
+    return regressions
+
+def int_list(text):
+    return [int(value) for value in text.split(",")]
+
+def main():
+    """Main function to run the benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark ChromaDB server ingest and query performance')
+    parser.add_argument('--scales', default='1k',
+                        help='Comma-separated message counts to benchmark (default: 1k; e.g. 1k,100k,1M)')
+    parser.add_argument('--concurrency', type=int_list, default=[1, 4, 16],
+                        help='Comma-separated numbers of concurrent query clients (default: 1,4,16)')
+    parser.add_argument('--n-results', type=int_list, default=[3, 10],
+                        help='Comma-separated n_results values to query with (default: 3,10)')
+    parser.add_argument('--queries', type=int, default=200,
+                        help='Queries per concurrency/n_results combination (default: 200)')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='Request threads of the benchmarked server (default: 8)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic data (default: 0)')
+    parser.add_argument('--output', default=None,
+                        help='Where to write the JSON results (default: bench-results/<timestamp>.json)')
+    parser.add_argument('--compare', default=None, help='Earlier JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed relative regression before --compare fails (default: 0.2)')
+
+    args = parser.parse_args()
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "started": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "embedding_backend": os.environ.get("EMBEDDING_BACKEND", "onnx"),
+            "options": {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+        },
+        "results": [benchmark_scale(label, args) for label in args.scales.split(",")]
+    }
+
+    output = args.output or os.path.join(
+        PROJECT_ROOT, "bench-results", datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.tolerance)
+        if regressions:
+            print("\n❌ Regressions beyond tolerance:")
+            for regression in regressions:
+                print(f"  - {regression}")
+            sys.exit(1)
+        print("\n✅ No regressions beyond tolerance.")
+
+if __name__ == "__main__":
+    main()
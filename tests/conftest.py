@@ -12,14 +12,32 @@ import threading
 # Constants
 SERVER_URL = "http://localhost:8000"
 FRONTEND_URL = "http://localhost:5173"
+SERVER_READY_TIMEOUT = 120  # seconds; the first start downloads the embedding model
+
+def wait_until_ready(timeout=SERVER_READY_TIMEOUT):
+    """Poll /readyz until the ChromaDB server has finished warming up."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            response = requests.get(f"{SERVER_URL}/readyz", timeout=1)
+            # Servers without /readyz answer 404 and are ready once they answer
+            if response.status_code != 503:
+                return
+            if response.json().get("error"):
+                pytest.fail(f"ChromaDB server warm-up failed: {response.json()['error']}")
+        except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout):
+            pass
+        time.sleep(1)
+    pytest.fail("Failed to start ChromaDB server")
 
 @pytest.fixture(scope="session")
 def chroma_server():
     """Start ChromaDB Flask server for the test session if it's not already running."""
     # Check if server is already running
     try:
-        requests.get(f"{SERVER_URL}/query", timeout=1)
+        requests.get(f"{SERVER_URL}/healthz", timeout=1)
         print("ChromaDB server is already running.")
+        wait_until_ready()
         yield SERVER_URL
         # Don't stop the server if it was already running
         return
@@ -33,16 +51,9 @@ def chroma_server():
     server_thread = threading.Thread(target=run_server, daemon=True)
     server_thread.start()
     
-    # Wait for server to start
-    for _ in range(5):
-        try:
-            requests.get(f"{SERVER_URL}/query", timeout=1)
-            print("ChromaDB server started successfully.")
-            break
-        except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout):
-            time.sleep(1)
-    else:
-        pytest.fail("Failed to start ChromaDB server")
+    # Wait for the server to load the embedding model and open the index
+    wait_until_ready()
+    print("ChromaDB server started successfully.")
     
     yield SERVER_URL
     
@@ -5,13 +5,24 @@ of ChromaDB using the BetterChatGPT framework.
 """
 
 import os
+import io
+import sys
 import json
+import hashlib
 import time
 import unittest
 import requests
 import uuid
 from datetime import datetime
 
+import numpy as np
+
+# The server's own modules, for packed embeddings, snapshots and backend names
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from embeddings import create_embedding_function
+from response_format import unpack_embedding
+from snapshot import SnapshotWriter, read_snapshot
+
 # Flask server URL
 SERVER_URL = "http://localhost:8000"
 
@@ -23,7 +34,7 @@ class RAGIntegrationTest(unittest.TestCase):
         """Start the Flask server if it's not already running."""
         try:
             # Check if server is running
-            requests.get(f"{SERVER_URL}/query")
+            requests.get(f"{SERVER_URL}/healthz")
             print("Server is already running.")
         except:
             print("Starting the server...")
@@ -37,15 +48,16 @@ class RAGIntegrationTest(unittest.TestCase):
             cls.server_thread = threading.Thread(target=run_server)
             cls.server_thread.daemon = True
             cls.server_thread.start()
-            
-            # Wait for server to start
-            for _ in range(5):
-                try:
-                    requests.get(f"{SERVER_URL}/query")
-                    print("Server started successfully.")
+        
+        # Wait for the server to load the embedding model and open the index
+        for _ in range(120):
+            try:
+                if requests.get(f"{SERVER_URL}/readyz").status_code == 200:
+                    print("Server is ready.")
                     break
-                except:
-                    time.sleep(1)
+            except:
+                pass
+            time.sleep(1)
     
     def setUp(self):
         """Prepare test data."""
@@ -110,6 +122,19 @@ class RAGIntegrationTest(unittest.TestCase):
             ]
         }
     
+    def unique_documents(self):
+        """
+        Return the test documents in chats of their own, with texts no other
+        test stores, so a server with DEDUP_THRESHOLD set does not link them
+        to earlier copies.
+        """
+        run = uuid.uuid4().hex
+        return {"documents": [
+            dict(doc, text=f"{doc['text']} Run {run}.",
+                 metadata=dict(doc["metadata"], chatId=f"{doc['metadata']['chatId']}_{run}"))
+            for doc in self.test_documents["documents"]
+        ]}
+    
     def test_ingest_and_query(self):
         """Test ingestion of documents and subsequent querying."""
         
@@ -171,6 +196,781 @@ class RAGIntegrationTest(unittest.TestCase):
         if len(irrelevant_results["results"]) > 0:
             for result in irrelevant_results["results"]:
                 print(f"Distance for irrelevant query: {result['distance']}")
+    
+    def test_reingest_skips_unchanged(self):
+        """Test that re-ingesting a chat only writes new or edited messages."""
+        
+        # Step 1: Ingest the documents for the first time
+        documents = self.unique_documents()
+        first_response = requests.post(
+            f"{SERVER_URL}/ingest",
+            json=documents
+        )
+        self.assertEqual(first_response.status_code, 200)
+        first_data = first_response.json()
+        self.assertEqual(first_data["inserted"], len(documents["documents"]))
+        
+        # Step 2: Edit one message and ingest the same chat again
+        documents["documents"][0]["text"] += " It runs offline."
+        second_response = requests.post(
+            f"{SERVER_URL}/ingest",
+            json=documents
+        )
+        
+        self.assertEqual(second_response.status_code, 200)
+        second_data = second_response.json()
+        self.assertTrue(second_data["success"])
+        self.assertEqual(second_data["inserted"], 0)
+        self.assertEqual(second_data["updated"], 1)
+        self.assertEqual(second_data["skipped"], len(documents["documents"]) - 1)
+    
+    def test_batch_query(self):
+        """Test that a batch query returns one result list per query, in order."""
+        
+        # Step 1: Ingest test documents
+        ingest_response = requests.post(
+            f"{SERVER_URL}/ingest",
+            json=self.test_documents
+        )
+        self.assertEqual(ingest_response.status_code, 200)
+        
+        # Step 2: Send two queries in one request
+        batch_response = requests.post(
+            f"{SERVER_URL}/query/batch",
+            json={"queries": ["What is ChromaDB?", "What is edge computing?"], "n_results": 1}
+        )
+        
+        self.assertEqual(batch_response.status_code, 200)
+        batch_results = batch_response.json()
+        self.assertTrue(batch_results["success"])
+        self.assertEqual(len(batch_results["results"]), 2)
+        
+        # Verify each result list answers its own query
+        self.assertIn("chromadb", batch_results["results"][0][0]["text"].lower())
+        self.assertIn("edge computing", batch_results["results"][1][0]["text"].lower())
+        
+        # Every query must be a string
+        bad_response = requests.post(f"{SERVER_URL}/query/batch", json={"queries": [1, None]})
+        self.assertEqual(bad_response.status_code, 400)
+        
+        # n_results must be a positive integer on every query route
+        for route, body in (("/query", {"query": "What is ChromaDB?"}),
+                            ("/query/batch", {"queries": ["What is ChromaDB?"]})):
+            for n_results in ("5", 0):
+                bad_response = requests.post(f"{SERVER_URL}{route}", json=dict(body, n_results=n_results))
+                self.assertEqual(bad_response.status_code, 400)
+    
+    def test_repeated_query_hits_cache(self):
+        """Test that a repeated query is served from the query cache."""
+        
+        query = {"query": f"Cache probe {uuid.uuid4()}", "n_results": 1}
+        before = requests.get(f"{SERVER_URL}/cache/stats").json()["query_cache"]
+        
+        # The first query misses, the second, differently spaced one hits
+        first_response = requests.post(f"{SERVER_URL}/query", json=query)
+        query["query"] = "  " + query["query"].upper() + "  "
+        second_response = requests.post(f"{SERVER_URL}/query", json=query)
+        
+        self.assertEqual(first_response.status_code, 200)
+        self.assertEqual(second_response.status_code, 200)
+        self.assertEqual(first_response.json()["results"], second_response.json()["results"])
+        
+        after = requests.get(f"{SERVER_URL}/cache/stats").json()["query_cache"]
+        self.assertEqual(after["misses"] - before["misses"], 1)
+        self.assertEqual(after["hits"] - before["hits"], 1)
+    
+    def test_identical_text_embedded_once(self):
+        """Test that identical texts are served from the embedding cache."""
+        
+        text = f"Repeated system prompt {uuid.uuid4()}"
+        documents = {
+            "documents": [
+                {"id": str(uuid.uuid4()), "text": text, "metadata": {"role": "system", "chatId": "test_chat_4"}},
+                {"id": str(uuid.uuid4()), "text": text, "metadata": {"role": "system", "chatId": "test_chat_5"}}
+            ]
+        }
+        before = requests.get(f"{SERVER_URL}/cache/stats").json()["embedding_cache"]
+        
+        ingest_response = requests.post(f"{SERVER_URL}/ingest", json=documents)
+        self.assertEqual(ingest_response.status_code, 200)
+        self.assertEqual(ingest_response.json()["inserted"], 2)
+        
+        # Querying with the same text reuses the stored embedding
+        query_response = requests.post(f"{SERVER_URL}/query", json={"query": text, "n_results": 1})
+        self.assertEqual(query_response.status_code, 200)
+        self.assertEqual(query_response.json()["results"][0]["text"], text)
+        
+        after = requests.get(f"{SERVER_URL}/cache/stats").json()["embedding_cache"]
+        self.assertEqual(after["misses"] - before["misses"], 1)
+        self.assertGreaterEqual(after["memory_hits"] - before["memory_hits"], 1)
+    
+    def test_async_ingest_job(self):
+        """Test that an asynchronous ingest returns a job that completes."""
+        
+        # Step 1: Queue the documents
+        ingest_response = requests.post(
+            f"{SERVER_URL}/ingest?async=1",
+            json=self.test_documents
+        )
+        self.assertEqual(ingest_response.status_code, 202)
+        job_id = ingest_response.json()["job_id"]
+        
+        # Step 2: Poll the job until the worker has written every document
+        for _ in range(30):
+            job = requests.get(f"{SERVER_URL}/ingest/jobs/{job_id}").json()["job"]
+            if job["status"] in ("done", "failed"):
+                break
+            time.sleep(1)
+        
+        self.assertEqual(job["status"], "done")
+        self.assertEqual(job["processed"], len(self.test_documents["documents"]))
+        self.assertEqual(job["inserted"], len(self.test_documents["documents"]))
+
+    def test_concurrent_ingest(self):
+        """Test that concurrent ingests are all written by the shared ingest worker."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        chat_ids = [f"test_concurrent_{uuid.uuid4().hex}" for _ in range(4)]
+
+        def ingest(chat_id):
+            documents = [
+                {"id": f"{chat_id}_{index}", "text": f"Concurrent ingest check {index} for {chat_id}.",
+                 "metadata": {"role": "user", "chatId": chat_id, "timestamp": datetime.now().isoformat(),
+                              "messageIndex": index}}
+                for index in range(3)
+            ]
+            return requests.post(f"{SERVER_URL}/ingest", json={"documents": documents})
+
+        with ThreadPoolExecutor(max_workers=len(chat_ids)) as pool:
+            responses = list(pool.map(ingest, chat_ids))
+        for response in responses:
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["inserted"], 3)
+
+        # Every write has landed by the time its request returns
+        query_response = requests.post(
+            f"{SERVER_URL}/query",
+            json={"query": "Concurrent ingest check", "n_results": 20, "chatId": chat_ids}
+        )
+        self.assertEqual(len(query_response.json()["results"]), 3 * len(chat_ids))
+
+        bad_response = requests.post(f"{SERVER_URL}/ingest", json={"documents": [{"id": "missing text"}]})
+        self.assertEqual(bad_response.status_code, 400)
+        for chat_id in chat_ids:
+            requests.delete(f"{SERVER_URL}/chats/{chat_id}")
+
+    def test_stream_ingest(self):
+        """Test bulk ingestion of newline-delimited JSON with an invalid line."""
+        
+        documents = self.unique_documents()["documents"]
+        lines = [json.dumps(doc) for doc in documents]
+        lines.insert(2, "not json")
+        stream_response = requests.post(
+            f"{SERVER_URL}/ingest/stream",
+            data="\n".join(lines).encode("utf-8"),
+            headers={"Content-Type": "application/x-ndjson"}
+        )
+        
+        self.assertEqual(stream_response.status_code, 200)
+        summary = stream_response.json()
+        self.assertTrue(summary["success"])
+        self.assertEqual(summary["count"], len(documents))
+        self.assertEqual(summary["inserted"], len(documents))
+        self.assertEqual(summary["invalid_lines"], [3])
+    
+    def test_long_message_chunking(self):
+        """Test that a long message is chunked and can be stitched back together."""
+        
+        message_id = str(uuid.uuid4())
+        sentences = [f"Sentence {i} explains part {i} of the ESP32 deep sleep guide." for i in range(60)]
+        long_text = " ".join(sentences)
+        documents = {
+            "documents": [{
+                "id": message_id,
+                "text": long_text,
+                "metadata": {"role": "assistant", "chatId": "test_chat_6", "title": "ESP32", "messageIndex": 0}
+            }]
+        }
+        
+        ingest_response = requests.post(f"{SERVER_URL}/ingest", json=documents)
+        self.assertEqual(ingest_response.status_code, 200)
+        
+        # Unmerged hits are chunks pointing back at the message
+        query = {"query": "ESP32 deep sleep guide sentence", "n_results": 2}
+        chunk_results = requests.post(f"{SERVER_URL}/query", json=query).json()["results"]
+        self.assertTrue(all(result["metadata"]["parentId"] == message_id for result in chunk_results))
+        self.assertTrue(all(len(result["text"]) < len(long_text) for result in chunk_results))
+        
+        # Merged hits come back as the message itself
+        query["merge_chunks"] = True
+        merged_results = requests.post(f"{SERVER_URL}/query", json=query).json()["results"]
+        self.assertEqual(merged_results[0]["id"], message_id)
+        self.assertGreater(len(merged_results[0]["chunks"]), 1)
+        self.assertIn(merged_results[0]["text"], long_text)
+    
+    def test_chat_scoped_query(self):
+        """Test that chatId and roles filters restrict the searched messages."""
+        
+        ingest_response = requests.post(
+            f"{SERVER_URL}/ingest",
+            json=self.test_documents
+        )
+        self.assertEqual(ingest_response.status_code, 200)
+        
+        # Only messages from test_chat_2 can be returned
+        query_response = requests.post(
+            f"{SERVER_URL}/query",
+            json={"query": "What is embedded AI?", "n_results": 5, "chatId": "test_chat_2", "roles": ["assistant"]}
+        )
+        
+        self.assertEqual(query_response.status_code, 200)
+        query_results = query_response.json()["results"]
+        self.assertTrue(len(query_results) > 0)
+        for result in query_results:
+            self.assertEqual(result["metadata"]["chatId"], "test_chat_2")
+            self.assertEqual(result["metadata"]["role"], "assistant")
+
+        # Epoch-second timestamps are filtered like ISO ones
+        chat_id = f"epoch_chat_{uuid.uuid4().hex}"
+        requests.post(f"{SERVER_URL}/ingest", json={"documents": [
+            {"id": str(uuid.uuid4()), "text": "A message stamped in 2020 with epoch seconds.",
+             "metadata": {"chatId": chat_id, "timestamp": 1577836800}},
+            {"id": str(uuid.uuid4()), "text": "A message stamped in 2023 with an ISO string.",
+             "metadata": {"chatId": chat_id, "timestamp": "2023-01-01T00:00:00Z"}}
+        ]})
+        for bound, year in (({"until": "2021-01-01T00:00:00Z"}, "2020"), ({"since": 1609459200}, "2023")):
+            dated_response = requests.post(
+                f"{SERVER_URL}/query",
+                json={"query": "message stamped", "n_results": 5, "chatId": chat_id, **bound}
+            )
+            self.assertEqual([year in result["text"] for result in dated_response.json()["results"]], [True])
+
+        # An unparseable since timestamp is rejected
+        bad_response = requests.post(
+            f"{SERVER_URL}/query",
+            json={"query": "What is embedded AI?", "since": "yesterday"}
+        )
+        self.assertEqual(bad_response.status_code, 400)
+    
+    def test_health_endpoints(self):
+        """Test the liveness and readiness probes."""
+        
+        health_response = requests.get(f"{SERVER_URL}/healthz")
+        self.assertEqual(health_response.status_code, 200)
+        self.assertEqual(health_response.json()["status"], "ok")
+        
+        ready_response = requests.get(f"{SERVER_URL}/readyz")
+        self.assertEqual(ready_response.status_code, 200)
+        ready_data = ready_response.json()
+        self.assertTrue(ready_data["ready"])
+        self.assertIn("load_model", ready_data["timings"])
+    
+    def test_keyword_and_hybrid_query(self):
+        """Test that keyword and hybrid modes find exact identifiers."""
+        
+        keyword_id = str(uuid.uuid4())
+        documents = self.test_documents["documents"] + [{
+            "id": keyword_id,
+            "text": "The flash write failed with ESP_ERR_FLASH_OP_TIMEOUT after the watchdog fired.",
+            "metadata": {"role": "assistant", "chatId": "test_chat_3", "timestamp": datetime.now().isoformat()}
+        }]
+        ingest_response = requests.post(f"{SERVER_URL}/ingest", json={"documents": documents})
+        self.assertEqual(ingest_response.status_code, 200)
+        
+        for mode in ("keyword", "hybrid"):
+            query_response = requests.post(
+                f"{SERVER_URL}/query",
+                json={"query": "ESP_ERR_FLASH_OP_TIMEOUT", "n_results": 3, "mode": mode}
+            )
+            self.assertEqual(query_response.status_code, 200)
+            query_results = query_response.json()["results"]
+            self.assertEqual(query_results[0]["id"], keyword_id)
+            self.assertIn("score", query_results[0])
+        
+        # Filters apply to keyword hits too
+        filtered_response = requests.post(
+            f"{SERVER_URL}/query",
+            json={"query": "ESP_ERR_FLASH_OP_TIMEOUT", "mode": "keyword", "chatId": "test_chat_1"}
+        )
+        self.assertEqual(filtered_response.status_code, 200)
+        self.assertEqual(filtered_response.json()["results"], [])
+
+        # A filtered hit is found however many better hits other chats have
+        term = f"term_{uuid.uuid4().hex}"
+        busy_chat, quiet_chat = f"busy_{uuid.uuid4().hex}", f"quiet_{uuid.uuid4().hex}"
+        busy = [{"id": str(uuid.uuid4()), "text": f"{term} {term} note {i} {uuid.uuid4().hex}",
+                 "metadata": {"chatId": busy_chat}} for i in range(8)]
+        quiet_id = str(uuid.uuid4())
+        quiet = {"id": quiet_id, "text": f"Only a passing mention of {term} in a much longer message about other things.",
+                 "metadata": {"chatId": quiet_chat}}
+        requests.post(f"{SERVER_URL}/ingest", json={"documents": busy + [quiet]})
+        quiet_response = requests.post(
+            f"{SERVER_URL}/query",
+            json={"query": term, "mode": "keyword", "n_results": 1, "chatId": quiet_chat}
+        )
+        self.assertEqual([result["id"] for result in quiet_response.json()["results"]], [quiet_id])
+
+        bad_response = requests.post(
+            f"{SERVER_URL}/query",
+            json={"query": "ESP_ERR_FLASH_OP_TIMEOUT", "mode": "fuzzy"}
+        )
+        self.assertEqual(bad_response.status_code, 400)
+    
+    def test_query_with_history(self):
+        """Test that earlier turns steer a short follow-up and that a chat boost favours its chat."""
+        
+        ingest_response = requests.post(f"{SERVER_URL}/ingest", json=self.test_documents)
+        self.assertEqual(ingest_response.status_code, 200)
+        
+        query = {"query": "tell me more", "n_results": 1, "where": {"role": "assistant"}}
+        history = [
+            {"role": "user", "content": "What is a vector database like ChromaDB used for?"},
+            {"role": "system", "content": "ignored"}
+        ]
+        response = requests.post(f"{SERVER_URL}/query", json=dict(query, history=history))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("chromadb", response.json()["results"][0]["text"].lower())
+        
+        # Of two candidate chats, a large enough boost puts the boosted one first
+        chat_ids = [f"test_boost_{uuid.uuid4().hex}" for _ in range(2)]
+        documents = [
+            {"id": f"{chat_id}_0", "text": text,
+             "metadata": {"role": "user", "chatId": chat_id, "timestamp": datetime.now().isoformat(),
+                          "messageIndex": 0}}
+            for chat_id, text in zip(chat_ids, ["Boost check: flashing firmware over USB.",
+                                                "Boost check: flashing firmware over the air."])
+        ]
+        ingest_response = requests.post(f"{SERVER_URL}/ingest", json={"documents": documents})
+        self.assertEqual(ingest_response.status_code, 200)
+        query = {"query": "flashing firmware", "n_results": 1, "chatId": chat_ids}
+        first = requests.post(f"{SERVER_URL}/query", json=query).json()["results"][0]["metadata"]["chatId"]
+        other = chat_ids[1] if first == chat_ids[0] else chat_ids[0]
+        boosted_response = requests.post(f"{SERVER_URL}/query", json=dict(query, boost_chat_id=other, chat_boost=2))
+        self.assertEqual(boosted_response.status_code, 200)
+        self.assertEqual(boosted_response.json()["results"][0]["metadata"]["chatId"], other)
+        
+        bad_response = requests.post(f"{SERVER_URL}/query", json=dict(query, history="not a list"))
+        self.assertEqual(bad_response.status_code, 400)
+    
+    def test_search_ef_and_exact_query(self):
+        """Test that a larger search_ef and an exact search agree on the best matches."""
+        
+        ingest_response = requests.post(f"{SERVER_URL}/ingest", json=self.test_documents)
+        self.assertEqual(ingest_response.status_code, 200)
+        
+        query = {"query": "How do I configure my ESP32 for WiFi?", "n_results": 3, "chatId": "test_chat_1"}
+        hnsw_response = requests.post(f"{SERVER_URL}/query", json=dict(query, search_ef=200))
+        exact_response = requests.post(f"{SERVER_URL}/query", json=dict(query, exact=True))
+        self.assertEqual(hnsw_response.status_code, 200)
+        self.assertEqual(exact_response.status_code, 200)
+        
+        hnsw_results = hnsw_response.json()["results"]
+        exact_results = exact_response.json()["results"]
+        self.assertLessEqual(len(hnsw_results), 3)
+        self.assertEqual([hit["id"] for hit in hnsw_results], [hit["id"] for hit in exact_results])
+        for hnsw_hit, exact_hit in zip(hnsw_results, exact_results):
+            self.assertAlmostEqual(hnsw_hit["distance"], exact_hit["distance"], places=4)
+        
+        bad_response = requests.post(f"{SERVER_URL}/query", json=dict(query, search_ef=0))
+        self.assertEqual(bad_response.status_code, 400)
+
+    def test_query_fields_and_encoding(self):
+        """Test that /query returns only the included fields and negotiates compact encodings."""
+
+        ingest_response = requests.post(f"{SERVER_URL}/ingest", json=self.test_documents)
+        self.assertEqual(ingest_response.status_code, 200)
+
+        query = {"query": "How do I configure my ESP32 for WiFi?", "n_results": 3, "chatId": "test_chat_1"}
+        distance_response = requests.post(f"{SERVER_URL}/query", json=dict(query, include=["distance"]))
+        self.assertEqual(distance_response.status_code, 200)
+        hits = distance_response.json()["results"]
+        self.assertGreater(len(hits), 0)
+        for hit in hits:
+            self.assertEqual(set(hit), {"id", "distance"})
+
+        # requests decompresses the body transparently
+        embedding_response = requests.post(
+            f"{SERVER_URL}/query",
+            json=dict(query, include=["embedding"], embedding_format="float32"),
+            headers={"Accept-Encoding": "gzip"}
+        )
+        self.assertEqual(embedding_response.status_code, 200)
+        self.assertEqual(embedding_response.headers.get("Content-Encoding"), "gzip")
+        hit = embedding_response.json()["results"][0]
+        self.assertEqual(set(hit), {"id", "embedding"})
+
+        # The packed vector round-trips to the one returned as a list
+        vector = unpack_embedding(hit["embedding"])
+        self.assertEqual(vector.shape, (384,))
+        list_response = requests.post(f"{SERVER_URL}/query", json=dict(query, include=["embedding"]))
+        listed = {result["id"]: result["embedding"] for result in list_response.json()["results"]}
+        np.testing.assert_array_equal(vector, np.asarray(listed[hit["id"]], dtype=np.float32))
+
+        bad_response = requests.post(f"{SERVER_URL}/query", json=dict(query, include=["score"]))
+        self.assertEqual(bad_response.status_code, 400)
+
+    def test_index_stats_and_recall(self):
+        """Test that /index/stats reports every partition and measures recall against exact search."""
+        
+        ingest_response = requests.post(f"{SERVER_URL}/ingest", json=self.test_documents)
+        self.assertEqual(ingest_response.status_code, 200)
+        
+        stats_response = requests.get(f"{SERVER_URL}/index/stats", params={"recall": "1", "sample": 5, "k": 3})
+        self.assertEqual(stats_response.status_code, 200)
+        stats = stats_response.json()
+        self.assertIn(stats["vector_store"], ("hnsw", "int8"))
+        
+        # With SHARD_COUNT above 1 the fixture may land in any of the default tenant's shards
+        partition = max(stats["partitions"].values(), key=lambda partition: partition["records"])
+        self.assertGreater(partition["records"], 0)
+        recall = partition["recall"]
+        self.assertEqual(recall["k"], 3)
+        for key in ("hnsw", "int8", "int8_reranked"):
+            if key in recall:
+                self.assertGreaterEqual(recall[key], 0.0)
+                self.assertLessEqual(recall[key], 1.0)
+        if stats["vector_store"] == "int8":
+            self.assertLess(partition["memory_bytes"], partition["float32_bytes"])
+            self.assertEqual(partition["search_memory_saved_bytes"],
+                             partition["float32_bytes"] - partition["memory_bytes"])
+        
+        bad_response = requests.get(f"{SERVER_URL}/index/stats", params={"k": 0})
+        self.assertEqual(bad_response.status_code, 400)
+    
+    def test_ingest_deduplication(self):
+        """Test that near-duplicate messages are linked instead of stored when deduplication is on."""
+        
+        stats = requests.get(f"{SERVER_URL}/index/stats").json()
+        chat_id = f"dedup_{uuid.uuid4().hex}"
+        text = "Regenerated answer: flash the bootloader first, then the partition table."
+        documents = [
+            {"id": str(uuid.uuid4()), "text": text,
+             "metadata": {"role": "assistant", "chatId": chat_id, "messageIndex": index}}
+            for index in range(2)
+        ]
+        ingest_response = requests.post(f"{SERVER_URL}/ingest", json={"documents": documents})
+        self.assertEqual(ingest_response.status_code, 200)
+        ingest_data = ingest_response.json()
+        
+        query_response = requests.post(
+            f"{SERVER_URL}/query", json={"query": text, "n_results": 5, "chatId": chat_id})
+        self.assertEqual(query_response.status_code, 200)
+        query_results = query_response.json()["results"]
+        
+        if stats["dedup_threshold"]:
+            self.assertEqual(ingest_data["inserted"], 1)
+            self.assertEqual(ingest_data["deduplicated"], 1)
+            self.assertEqual([hit["id"] for hit in query_results], [documents[0]["id"]])
+        else:
+            self.assertEqual(ingest_data["inserted"], 2)
+            self.assertEqual(ingest_data["deduplicated"], 0)
+            self.assertEqual(len(query_results), 2)
+        
+        # Re-ingesting is a no-op and deleting the chat removes linked messages too
+        second_response = requests.post(f"{SERVER_URL}/ingest", json={"documents": documents})
+        self.assertEqual(second_response.json()["skipped"], 2)
+        delete_response = requests.delete(f"{SERVER_URL}/chats/{chat_id}")
+        self.assertEqual(delete_response.json()["messages"], 2)
+    
+    def test_rerank(self):
+        """Test that results are re-ranked by score when a cross-encoder is configured, and refused otherwise."""
+        
+        ingest_response = requests.post(f"{SERVER_URL}/ingest", json=self.test_documents)
+        self.assertEqual(ingest_response.status_code, 200)
+        
+        query = {"query": "How do I configure my ESP32 for WiFi?", "n_results": 3}
+        query_response = requests.post(f"{SERVER_URL}/query", json=query)
+        self.assertEqual(query_response.status_code, 200)
+        query_data = query_response.json()
+        
+        if query_data["reranked"]:
+            scores = [hit["rerank_score"] for hit in query_data["results"]]
+            self.assertEqual(scores, sorted(scores, reverse=True))
+            bad_response = requests.post(f"{SERVER_URL}/query", json=dict(query, rerank_candidates=0))
+        else:
+            self.assertTrue(all("rerank_score" not in hit for hit in query_data["results"]))
+            bad_response = requests.post(f"{SERVER_URL}/query", json=dict(query, rerank=True))
+        self.assertEqual(bad_response.status_code, 400)
+    
+    def test_context_assembly(self):
+        """Test that /context packs deduplicated snippets into the token budget."""
+        
+        documents = self.test_documents["documents"]
+        duplicate = dict(documents[0], id=str(uuid.uuid4()))
+        ingest_response = requests.post(f"{SERVER_URL}/ingest", json={"documents": documents + [duplicate]})
+        self.assertEqual(ingest_response.status_code, 200)
+        
+        context_response = requests.post(
+            f"{SERVER_URL}/context",
+            json={"query": "What is embedded AI?", "max_tokens": 60, "chatId": "test_chat_1"}
+        )
+        
+        self.assertEqual(context_response.status_code, 200)
+        context_data = context_response.json()
+        self.assertTrue(context_data["context"].startswith("[1] "))
+        self.assertLessEqual(context_data["tokens"], 60)
+        self.assertTrue(len(context_data["citations"]) > 0)
+        
+        # The copy of the first message is never cited next to the original
+        texts = {doc["id"]: doc["text"] for doc in documents + [duplicate]}
+        cited_texts = [texts[citation["id"]] for citation in context_data["citations"] if citation["id"] in texts]
+        self.assertEqual(len(cited_texts), len(set(cited_texts)))
+        
+        bad_response = requests.post(f"{SERVER_URL}/context", json={"query": "What is embedded AI?", "n_candidates": 0})
+        self.assertEqual(bad_response.status_code, 400)
+    
+    def test_metrics_and_server_timing(self):
+        """Test the Prometheus metrics endpoint and the Server-Timing header."""
+        
+        query_response = requests.post(
+            f"{SERVER_URL}/query?timing=1",
+            json={"query": f"metrics probe {uuid.uuid4()}"}
+        )
+        self.assertEqual(query_response.status_code, 200)
+        server_timing = query_response.headers.get("Server-Timing", "")
+        self.assertIn("embed;dur=", server_timing)
+        self.assertIn("total;dur=", server_timing)
+        
+        metrics_response = requests.get(f"{SERVER_URL}/metrics")
+        self.assertEqual(metrics_response.status_code, 200)
+        self.assertTrue(metrics_response.headers["Content-Type"].startswith("text/plain"))
+        metrics_text = metrics_response.text
+        self.assertIn('chroma_requests_total{route="/query",method="POST",status="200"}', metrics_text)
+        self.assertIn('chroma_stage_duration_seconds_count{stage="search"}', metrics_text)
+        self.assertIn("chroma_collection_records", metrics_text)
+        self.assertIn('chroma_cache_hit_ratio{cache="query"}', metrics_text)
+    
+    def test_tenant_partitioning(self):
+        """Test that tenants only see their own messages unless several are queried."""
+        
+        tenant_documents = {}
+        for tenant in ("test_tenant_a", "test_tenant_b"):
+            tenant_documents[tenant] = {
+                "id": str(uuid.uuid4()),
+                "text": f"Partition check: {tenant} keeps its sensor calibration notes here.",
+                "metadata": {"role": "user", "chatId": f"{tenant}_chat", "timestamp": datetime.now().isoformat()}
+            }
+            ingest_response = requests.post(
+                f"{SERVER_URL}/ingest",
+                json={"documents": [tenant_documents[tenant]]},
+                headers={"X-Tenant-Id": tenant}
+            )
+            self.assertEqual(ingest_response.status_code, 200)
+        
+        query_response = requests.post(
+            f"{SERVER_URL}/query",
+            json={"query": "sensor calibration notes", "n_results": 10, "tenant": "test_tenant_a"}
+        )
+        self.assertEqual(query_response.status_code, 200)
+        result_ids = {result["id"] for result in query_response.json()["results"]}
+        self.assertIn(tenant_documents["test_tenant_a"]["id"], result_ids)
+        self.assertNotIn(tenant_documents["test_tenant_b"]["id"], result_ids)
+        
+        # Querying both tenants merges their results
+        query_response = requests.post(
+            f"{SERVER_URL}/query",
+            json={"query": "Partition check sensor calibration notes", "n_results": 10,
+                  "tenants": ["test_tenant_a", "test_tenant_b"]}
+        )
+        self.assertEqual(query_response.status_code, 200)
+        result_ids = {result["id"] for result in query_response.json()["results"]}
+        self.assertIn(tenant_documents["test_tenant_a"]["id"], result_ids)
+        self.assertIn(tenant_documents["test_tenant_b"]["id"], result_ids)
+        
+        bad_response = requests.post(f"{SERVER_URL}/query", json={"query": "x", "tenant": "../etc"})
+        self.assertEqual(bad_response.status_code, 400)
+    
+    def test_retention_on_new_tenant(self):
+        """Test that retention expires messages of a tenant created after startup."""
+        
+        tenant = f"test_retention_{uuid.uuid4().hex[:12]}"
+        # Several chats, so a sharded server spreads them over new shards too
+        documents = [
+            {"id": str(uuid.uuid4()), "text": f"Retention check {index}: notes from an old project.",
+             "metadata": {"role": "user", "chatId": f"{tenant}_chat_{index}", "timestamp": "1990-01-01T00:00:00Z"}}
+            for index in range(4)
+        ]
+        ingest_response = requests.post(
+            f"{SERVER_URL}/ingest", json={"documents": documents}, headers={"X-Tenant-Id": tenant}
+        )
+        self.assertEqual(ingest_response.status_code, 200)
+        
+        retention_response = requests.post(f"{SERVER_URL}/retention", json={"max_age_days": 7300})
+        self.assertEqual(retention_response.status_code, 200)
+        self.assertGreaterEqual(retention_response.json()["expired"], len(documents))
+        
+        query_response = requests.post(
+            f"{SERVER_URL}/query",
+            json={"query": "notes from an old project", "n_results": 10, "tenant": tenant}
+        )
+        self.assertEqual(query_response.json()["results"], [])
+    
+    def test_delete_chat_and_filter(self):
+        """Test deleting a chat and deleting messages by filter."""
+        
+        chat_id = f"test_delete_{uuid.uuid4().hex}"
+        documents = [
+            {
+                "id": f"{chat_id}_{index}",
+                "text": f"Deletion check message {index} about flash wear levelling.",
+                "metadata": {"role": role, "chatId": chat_id, "timestamp": datetime.now().isoformat(),
+                             "messageIndex": index}
+            }
+            for index, role in enumerate(["user", "assistant", "user", "assistant"])
+        ]
+        ingest_response = requests.post(f"{SERVER_URL}/ingest", json={"documents": documents})
+        self.assertEqual(ingest_response.status_code, 200)
+        
+        # A dry run counts without deleting
+        dry_response = requests.post(
+            f"{SERVER_URL}/delete",
+            json={"chatId": chat_id, "roles": ["assistant"], "dry_run": True}
+        )
+        self.assertEqual(dry_response.status_code, 200)
+        self.assertEqual(dry_response.json()["messages"], 2)
+        
+        delete_response = requests.post(f"{SERVER_URL}/delete", json={"chatId": chat_id, "roles": ["assistant"]})
+        self.assertEqual(delete_response.status_code, 200)
+        self.assertEqual(delete_response.json()["messages"], 2)
+        
+        query_response = requests.post(
+            f"{SERVER_URL}/query",
+            json={"query": "flash wear levelling", "n_results": 10, "chatId": chat_id}
+        )
+        self.assertEqual({result["metadata"]["role"] for result in query_response.json()["results"]}, {"user"})
+        
+        chat_response = requests.delete(f"{SERVER_URL}/chats/{chat_id}")
+        self.assertEqual(chat_response.status_code, 200)
+        self.assertEqual(chat_response.json()["messages"], 2)
+        
+        query_response = requests.post(
+            f"{SERVER_URL}/query",
+            json={"query": "flash wear levelling", "n_results": 10, "chatId": chat_id}
+        )
+        self.assertEqual(query_response.json()["results"], [])
+        
+        # Deleting without a filter is refused
+        self.assertEqual(requests.post(f"{SERVER_URL}/delete", json={"dry_run": True}).status_code, 400)
+
+    def test_delete_chat_across_shards(self):
+        """Test that deleting a chat removes its messages whatever SHARD_KEY spreads them by."""
+        
+        # With SHARD_KEY=role these land in different shards
+        chat_id = f"test_delete_shards_{uuid.uuid4().hex}"
+        documents = [
+            {"id": f"{chat_id}_{index}", "text": f"Shard deletion check {index} about {role} messages.",
+             "metadata": {"role": role, "chatId": chat_id, "messageIndex": index}}
+            for index, role in enumerate(["user", "assistant", "system", "tool", "function", "developer"])
+        ]
+        ingest_response = requests.post(f"{SERVER_URL}/ingest", json={"documents": documents})
+        self.assertEqual(ingest_response.status_code, 200)
+        
+        chat_response = requests.delete(f"{SERVER_URL}/chats/{chat_id}")
+        self.assertEqual(chat_response.status_code, 200)
+        self.assertEqual(chat_response.json()["messages"], len(documents))
+    
+    def test_snapshot_export_and_import(self):
+        """Test that a snapshot restores deleted messages without re-ingesting them."""
+        
+        chat_id = f"test_snapshot_{uuid.uuid4().hex}"
+        documents = [
+            {
+                "id": f"{chat_id}_{index}",
+                "text": text,
+                "metadata": {"role": "user", "chatId": chat_id, "timestamp": datetime.now().isoformat(),
+                             "messageIndex": index}
+            }
+            for index, text in enumerate(["Snapshot check about solder paste stencils.",
+                                          "Snapshot check about reflow oven profiles."])
+        ]
+        ingest_response = requests.post(f"{SERVER_URL}/ingest", json={"documents": documents})
+        self.assertEqual(ingest_response.status_code, 200)
+        
+        export_response = requests.get(f"{SERVER_URL}/snapshot")
+        self.assertEqual(export_response.status_code, 200)
+        snapshot = export_response.content
+        
+        # The manifest records the size of the embeddings the snapshot holds
+        frames = list(read_snapshot(io.BytesIO(snapshot)))
+        dimensions = frames[0][0]["dimensions"]
+        self.assertIsNotNone(dimensions)
+        self.assertTrue(all(columns["embeddings"].shape[1] == dimensions
+                            for header, columns in frames if header["kind"] == "records"))
+        
+        delete_response = requests.delete(f"{SERVER_URL}/chats/{chat_id}")
+        self.assertEqual(delete_response.status_code, 200)
+        
+        import_response = requests.post(f"{SERVER_URL}/snapshot", data=snapshot)
+        self.assertEqual(import_response.status_code, 200)
+        self.assertGreaterEqual(import_response.json()["records"], len(documents))
+        
+        query_response = requests.post(
+            f"{SERVER_URL}/query",
+            json={"query": "reflow oven profiles", "n_results": 5, "chatId": chat_id}
+        )
+        self.assertEqual({result["id"] for result in query_response.json()["results"]},
+                         {doc["id"] for doc in documents})
+        
+        # A truncated snapshot is refused
+        bad_response = requests.post(f"{SERVER_URL}/snapshot", data=snapshot[:len(snapshot) // 2])
+        self.assertEqual(bad_response.status_code, 400)
+        
+        # So is one whose embeddings are not the size of those stored
+        mismatched = io.BytesIO()
+        writer = SnapshotWriter(mismatched, frames[0][0]["embedding_model"], dimensions + 1)
+        writer.records("default", [f"{chat_id}_wide"], ["Wider embedding"], [{"chatId": chat_id}],
+                       np.ones((1, dimensions + 1), dtype=np.float32))
+        writer.close()
+        bad_response = requests.post(f"{SERVER_URL}/snapshot", data=mismatched.getvalue())
+        self.assertEqual(bad_response.status_code, 400)
+        requests.delete(f"{SERVER_URL}/chats/{chat_id}")
+    
+    def test_embedding_model_change(self):
+        """Test that messages embedded by another backend are re-embedded, and their snapshots refused."""
+        
+        # Each backend stamps records with its own model id
+        self.assertEqual(create_embedding_function("onnx").model_id, "onnx/all-MiniLM-L6-v2")
+        self.assertEqual(create_embedding_function("onnx-int8").model_id, "onnx-int8/all-MiniLM-L6-v2")
+        with self.assertRaises(ValueError):
+            create_embedding_function("word2vec")
+        
+        # Store a message as a server running another backend would have
+        model = requests.get(f"{SERVER_URL}/readyz").json()["embedding_model"]
+        chat_id = f"test_model_change_{uuid.uuid4().hex}"
+        document = {
+            "id": f"{chat_id}_0",
+            "text": "Model change check about crystal oscillator load capacitors.",
+            "metadata": {"role": "user", "chatId": chat_id, "messageIndex": 0}
+        }
+        snapshot = io.BytesIO()
+        writer = SnapshotWriter(snapshot, model)
+        writer.records("default", [document["id"]], [document["text"]], [{
+            **document["metadata"],
+            "parentId": document["id"],
+            "contentHash": hashlib.sha256(document["text"].encode("utf-8")).hexdigest(),
+            "embeddingModel": "other/previous-model"
+        }], np.ones((1, 384), dtype=np.float32))
+        writer.close()
+        import_response = requests.post(f"{SERVER_URL}/snapshot", data=snapshot.getvalue())
+        self.assertEqual(import_response.status_code, 200)
+        
+        # Re-ingesting the unchanged message embeds it with the current backend, once
+        for outcome in ("updated", "skipped"):
+            ingest_response = requests.post(f"{SERVER_URL}/ingest", json={"documents": [document]})
+            self.assertEqual(ingest_response.status_code, 200)
+            self.assertEqual(ingest_response.json()[outcome], 1)
+        query_response = requests.post(
+            f"{SERVER_URL}/query",
+            json={"query": document["text"], "n_results": 1, "chatId": chat_id}
+        )
+        self.assertEqual(query_response.json()["results"][0]["metadata"]["embeddingModel"], model)
+        
+        # Vectors from another model cannot be imported
+        foreign = io.BytesIO()
+        SnapshotWriter(foreign, "other/previous-model").close()
+        refused_response = requests.post(f"{SERVER_URL}/snapshot", data=foreign.getvalue())
+        self.assertEqual(refused_response.status_code, 400)
+        requests.delete(f"{SERVER_URL}/chats/{chat_id}")
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
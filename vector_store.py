@@ -0,0 +1,295 @@
+"""
+Compact int8 copy of a collection's embeddings for first-pass search.
+
+Each vector is normalized and scalar-quantized to int8 with one float32 scale
+per row, about a quarter of the float32 size, and only these codes are kept
+in memory. A query scores every row against the codes, then re-ranks the best
+candidates with the full-precision vectors, which stay on disk in a
+memory-mapped file, so the distances returned are exact cosine distances.
+
+Rows are append-only: re-adding an id writes a new row and marks the old
+one dead until compact() rewrites the files.
+"""
+
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+# Rows scored per matrix product, bounding the float32 temporaries
+_BLOCK_ROWS = 16384
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+def _append(buffer, data, used):
+    # Grow by doubling, so appending n rows costs O(n) amortized
+    if used + len(data) > len(buffer):
+        grown = np.empty((max(2 * len(buffer), used + len(data), 64),) + buffer.shape[1:], dtype=buffer.dtype)
+        grown[:used] = buffer[:used]
+        buffer = grown
+    buffer[used:used + len(data)] = data
+    return buffer
+
+def quantize(vectors):
+    """Return (int8 codes, float32 scales) such that codes * scales approximates vectors."""
+    scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+class QuantizedVectorStore:
+    """int8 vectors in memory and float32 vectors on disk, addressed by Chroma record id."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(path, "rows.sqlite3"), check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS records (id TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value INTEGER)")
+        self._load()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        settings = dict(self._conn.execute("SELECT key, value FROM settings"))
+        self.dim = settings.get("dim")
+        # Rows past the committed count belong to a write that did not finish
+        self._rows = settings.get("rows", 0)
+        self._ids = [None] * self._rows
+        for record_id, row in self._conn.execute("SELECT id, row FROM records"):
+            self._ids[row] = record_id
+        self._row_of = {record_id: row for row, record_id in enumerate(self._ids) if record_id is not None}
+        self._alive = np.array([record_id is not None for record_id in self._ids], dtype=bool)
+
+        if self.dim:
+            codes = np.fromfile(self._file("codes.i8"), dtype=np.int8, count=self._rows * self.dim)
+            self._codes = codes.reshape(self._rows, self.dim)
+            self._scales = np.fromfile(self._file("scales.f32"), dtype=np.float32, count=self._rows)
+        else:
+            self._codes = np.zeros((0, 0), dtype=np.int8)
+            self._scales = np.zeros(0, dtype=np.float32)
+        self._vectors = None
+        for name in ("codes.i8", "scales.f32", "vectors.f32"):
+            self._truncate(name)
+
+    def _truncate(self, name):
+        # Drop the tail of an interrupted append so new rows line up
+        path = self._file(name)
+        if not os.path.exists(path):
+            return
+        width = {"codes.i8": self.dim or 0, "scales.f32": 4, "vectors.f32": 4 * (self.dim or 0)}[name]
+        if os.path.getsize(path) > self._rows * width:
+            os.truncate(path, self._rows * width)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._row_of)
+
+    def _full_vectors(self):
+        # The memory map is reopened after appends, which it does not see
+        if self._vectors is None or len(self._vectors) < self._rows:
+            self._vectors = np.memmap(self._file("vectors.f32"), dtype=np.float32, mode="r",
+                                      shape=(self._rows, self.dim)) if self._rows else None
+        return self._vectors
+
+    def upsert(self, ids, embeddings):
+        """Store embeddings under ids, replacing any vector already stored for an id."""
+        if not len(ids):
+            return
+        vectors = _normalize(embeddings)
+        codes, scales = quantize(vectors)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._codes = np.zeros((0, self.dim), dtype=np.int8)
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"expected {self.dim}-dimensional embeddings, got {vectors.shape[1]}")
+
+            first = self._rows
+            for name, data in (("vectors.f32", vectors), ("codes.i8", codes), ("scales.f32", scales)):
+                with open(self._file(name), "ab") as f:
+                    f.write(data.tobytes())
+            rows = range(first, first + len(ids))
+            with self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO records (id, row) VALUES (?, ?)", zip(ids, rows))
+                self._conn.executemany("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                                       [("dim", self.dim), ("rows", first + len(ids))])
+
+            new_ids = list(ids)
+            alive = np.ones(len(ids), dtype=bool)
+            for record_id, row in zip(ids, rows):
+                previous = self._row_of.get(record_id)
+                if previous is not None and previous >= first:
+                    # The same id twice in one call: the later vector wins
+                    alive[previous - first] = False
+                    new_ids[previous - first] = None
+                elif previous is not None:
+                    self._alive[previous] = False
+                    self._ids[previous] = None
+                self._row_of[record_id] = row
+            self._ids.extend(new_ids)
+            self._codes = _append(self._codes, codes, first)
+            self._scales = _append(self._scales, scales, first)
+            self._alive = _append(self._alive, alive, first)
+            self._rows += len(ids)
+
+    def delete(self, ids):
+        """Remove ids from the store; their rows are reclaimed by compact()."""
+        with self._lock, self._conn:
+            for record_id in ids:
+                row = self._row_of.pop(record_id, None)
+                if row is not None:
+                    self._alive[row] = False
+                    self._ids[row] = None
+                    self._conn.execute("DELETE FROM records WHERE id = ?", (record_id,))
+
+    def clear(self):
+        """Remove every vector."""
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM records")
+                self._conn.execute("DELETE FROM settings")
+            self._vectors = None
+            for name in ("codes.i8", "scales.f32", "vectors.f32"):
+                if os.path.exists(self._file(name)):
+                    os.remove(self._file(name))
+            self._load()
+
+    def compact(self):
+        """Rewrite the files without the rows of deleted or replaced vectors."""
+        with self._lock:
+            live = np.flatnonzero(self._alive[:self._rows])
+            if self.dim is None or len(live) == self._rows:
+                return
+            vectors = np.asarray(self._full_vectors()[live]) if len(live) else np.zeros((0, self.dim), np.float32)
+            ids = [self._ids[row] for row in live]
+            self._vectors = None
+            for name, data in (("vectors.f32", vectors), ("codes.i8", self._codes[live]),
+                               ("scales.f32", self._scales[live])):
+                with open(self._file(name + ".tmp"), "wb") as f:
+                    f.write(np.ascontiguousarray(data).tobytes())
+            with self._conn:
+                self._conn.execute("DELETE FROM records")
+                self._conn.executemany("INSERT INTO records (id, row) VALUES (?, ?)",
+                                       zip(ids, range(len(ids))))
+                self._conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('rows', ?)", (len(ids),))
+                for name in ("vectors.f32", "codes.i8", "scales.f32"):
+                    os.replace(self._file(name + ".tmp"), self._file(name))
+            self._conn.execute("VACUUM")
+            self._load()
+
+    def _rows_for(self, ids):
+        return np.array([self._row_of[record_id] for record_id in ids if record_id in self._row_of], dtype=np.int64)
+
+    def search(self, query_embeddings, n_results, candidates, ids=None, rerank=True):
+        """
+        Return, per query, up to n_results (id, cosine distance) pairs, best first.
+
+        The candidates best rows by int8 score are re-ranked with the
+        full-precision vectors; with rerank=False the approximate distances
+        of the first pass are returned instead. ids, when given, limits the
+        search to those records.
+        """
+        queries = _normalize(query_embeddings)
+        with self._lock:
+            rows = self._rows
+            codes, scales, alive = self._codes[:rows], self._scales[:rows], self._alive[:rows]
+            record_ids = self._ids
+            allowed = self._rows_for(ids) if ids is not None else None
+            vectors = self._full_vectors() if rerank else None
+        if not rows or n_results <= 0:
+            return [[] for _ in queries]
+
+        candidates = max(candidates, n_results)
+        if allowed is not None:
+            # A filtered search only scores the rows it may return
+            codes, scales, row_ids = codes[allowed], scales[allowed], allowed
+            searchable = len(row_ids)
+        else:
+            row_ids = np.arange(rows)
+            searchable = int(alive.sum())
+        if not searchable:
+            return [[] for _ in queries]
+
+        # Approximate cosine similarity of every row, block by block
+        scores = np.empty((len(queries), len(row_ids)), dtype=np.float32)
+        for start in range(0, len(row_ids), _BLOCK_ROWS):
+            block = codes[start:start + _BLOCK_ROWS].astype(np.float32)
+            scores[:, start:start + _BLOCK_ROWS] = (queries @ block.T) * scales[start:start + _BLOCK_ROWS]
+        if allowed is None and searchable < rows:
+            scores[:, ~alive] = -np.inf
+
+        results = []
+        for query, query_scores in zip(queries, scores):
+            keep = min(candidates if rerank else n_results, searchable)
+            best = np.argpartition(-query_scores, keep - 1)[:keep]
+            if rerank:
+                best_rows = np.sort(row_ids[best])
+                distances = 1.0 - np.asarray(vectors[best_rows]) @ query
+            else:
+                best_rows = row_ids[best]
+                distances = 1.0 - query_scores[best]
+            order = np.argsort(distances, kind="stable")[:n_results]
+            # A row deleted while this search ran has lost its id
+            results.append([(record_ids[best_rows[i]], float(distances[i])) for i in order
+                            if record_ids[best_rows[i]] is not None])
+        return results
+
+    def exact_search(self, query_embeddings, n_results):
+        """Return, per query, the n_results nearest ids by brute force over the full-precision vectors."""
+        queries = _normalize(query_embeddings)
+        with self._lock:
+            live = np.flatnonzero(self._alive[:self._rows])
+            record_ids = self._ids
+            vectors = self._full_vectors()
+        results = [[] for _ in queries]
+        if not len(live):
+            return results
+        distances = np.empty((len(queries), len(live)), dtype=np.float32)
+        for start in range(0, len(live), _BLOCK_ROWS):
+            block = np.asarray(vectors[live[start:start + _BLOCK_ROWS]])
+            distances[:, start:start + _BLOCK_ROWS] = 1.0 - queries @ block.T
+        for position, query_distances in enumerate(distances):
+            order = np.argsort(query_distances, kind="stable")[:n_results]
+            results[position] = [record_ids[live[i]] for i in order]
+        return results
+
+    def sample(self, count, seed=0):
+        """Return up to count stored full-precision vectors, chosen at random."""
+        with self._lock:
+            live = np.flatnonzero(self._alive[:self._rows])
+            vectors = self._full_vectors()
+        if not len(live):
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        rows = np.random.default_rng(seed).choice(live, size=min(count, len(live)), replace=False)
+        return np.asarray(vectors[np.sort(rows)])
+
+    def stats(self):
+        """
+        Return row counts and the bytes the first-pass search holds in memory,
+        compared with the same vectors as float32. Only this search path shrinks:
+        the collection's own HNSW index is not affected.
+        """
+        with self._lock:
+            live, rows, dim = len(self._row_of), self._rows, self.dim or 0
+        # Codes, scales and the liveness flag of each row, as against a float32 vector
+        memory = rows * (dim + 4 + 1)
+        float32 = rows * dim * 4
+        return {
+            "records": live,
+            "dead_rows": rows - live,
+            "dimensions": dim,
+            "memory_bytes": memory,
+            "float32_bytes": float32,
+            "search_memory_saved_bytes": float32 - memory,
+            "disk_bytes": sum(os.path.getsize(self._file(name))
+                              for name in ("codes.i8", "scales.f32", "vectors.f32", "rows.sqlite3")
+                              if os.path.exists(self._file(name)))
+        }